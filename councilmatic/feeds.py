@@ -1,15 +1,21 @@
 import json
 import logging
 from datetime import date, time, datetime
+from django.db.models import Max
+from django.db.models.query import QuerySet
 from django.http import QueryDict
 from collections import defaultdict
 from itertools import chain
 from itertools import product
 from urllib import urlencode
 
+from django.contrib.contenttypes.models import ContentType
 from councilmatic.subscriptions.feeds import ContentFeed
 from councilmatic.subscriptions.feeds import ContentFeedLibrary
+from phillyleg.metadata import chunked
+from phillyleg.models import LegAction
 from phillyleg.models import LegFile
+from phillyleg.models import LegFileMetaData
 from phillyleg.models import LegMinutes
 from haystack.query import SearchQuerySet
 
@@ -17,6 +23,37 @@ from haystack.query import SearchQuerySet
 log = logging.getLogger(__name__)
 library = ContentFeedLibrary()
 
+
+def changed_legfiles(changed_content):
+    return [item for item in changed_content if isinstance(item, LegFile)]
+
+
+def get_search_facets(legfile):
+    """
+    Return the values of a legfile's search index fields that search feeds
+    filter on, as { field : [values] }.  The result is kept on the legfile, so
+    it's only looked up once however many feeds ask.
+    """
+    if not hasattr(legfile, '_search_facets'):
+        sponsors = legfile.sponsors.all().prefetch_related('aliases')
+        sponsor_names = list(chain(*([sponsor.real_name] +
+                                     [alias.name for alias in sponsor.aliases.all()]
+                                     for sponsor in sponsors)))
+        try:
+            topics = [topic.topic for topic in legfile.metadata.topics.all()]
+        except LegFileMetaData.DoesNotExist:
+            topics = []
+
+        legfile._search_facets = {
+            'sponsors': sponsor_names,
+            'topics': topics,
+            'status': [legfile.status],
+            'file_type': [legfile.type],
+            'controlling_body': [legfile.controlling_body],
+        }
+    return legfile._search_facets
+
+
 class NewLegislationFeed (ContentFeed):
     def get_content(self):
         return LegFile.objects.all().order_by('-intro_date')
@@ -34,6 +71,10 @@ class NewLegislationFeed (ContentFeed):
         legfiles = self.get_content()
         return legfiles[0].intro_date
 
+    def could_match(self, changed_content, last_updated):
+        return any(legfile.intro_date > last_updated.date()
+                   for legfile in changed_legfiles(changed_content))
+
     def get_params(self):
         return {}
 
@@ -54,18 +95,53 @@ class LegislationUpdatesFeed (ContentFeed):
             return self.manager.all()
 
     def get_updates_since(self, datetime):
-        return [content_item for content_item in self.get_content()
-                if self.get_last_updated_time_for_file(content_item) > datetime.date()]
+        content = self.get_content()
+        if isinstance(content, QuerySet):
+            legfiles = list(content.filter(last_activity__gt=datetime.date()))
+        else:
+            legfiles = [content_item for content_item in content
+                        if self.get_last_updated_time_for_file(content_item) > datetime.date()]
+
+        self.attach_new_actions(legfiles, datetime)
+        return legfiles
+
+    def attach_new_actions(self, legfiles, since_datetime):
+        """
+        Fetch the actions taken since the given time on all of the legfiles at
+        once, and attach them to the legfiles for ``get_changes_to``.
+        """
+        since_date = since_datetime.date()
+        legfiles = [legfile for legfile in legfiles if isinstance(legfile, LegFile)]
+
+        new_actions = defaultdict(list)
+        for chunk in chunked([legfile.pk for legfile in legfiles], 500):
+            actions = LegAction.objects\
+                .filter(file__in=chunk, date_taken__gt=since_date)\
+                .order_by('date_taken', 'pk')
+            for action in actions:
+                new_actions[action.file_id].append(action)
+
+        for legfile in legfiles:
+            legfile._new_actions = (since_date, new_actions[legfile.pk])
 
     def get_changes_to(self, legfile, since_datetime):
+        since_date = since_datetime.date()
+
+        # Use the actions attached in get_updates_since, if there are any.
+        attached = getattr(legfile, '_new_actions', None)
+        if attached is not None and attached[0] == since_date:
+            actions = attached[1]
+        else:
+            actions = legfile.actions.filter(date_taken__gt=since_date)\
+                                     .order_by('date_taken', 'pk')
+
         changes = defaultdict(unicode)
         dates = set()
-        for action in legfile.actions.all():
-            if action.date_taken > since_datetime.date():
-                if 'Actions' in changes:
-                    changes['Actions'] += u'\n'
-                changes['Actions'] += unicode(action)
-                dates.add(action.date_taken)
+        for action in actions:
+            if 'Actions' in changes:
+                changes['Actions'] += u'\n'
+            changes['Actions'] += unicode(action)
+            dates.add(action.date_taken)
 
         if changes:
             return changes, datetime.combine(max(dates), time())
@@ -73,13 +149,20 @@ class LegislationUpdatesFeed (ContentFeed):
             return {}, datetime.min
 
     def get_last_updated_time(self):
+        content = self.get_content()
+        if isinstance(content, QuerySet):
+            return content.aggregate(Max('last_activity'))['last_activity__max']
+
         dates = set()
-        for legfile in self.get_content():
+        for legfile in content:
             dates.add(self.get_last_updated_time_for_file(legfile))
 
         return max(dates)
 
     def get_last_updated_time_for_file(self, legfile):
+        if legfile.last_activity is not None:
+            return legfile.last_activity
+
         legfile_date = max(legfile.intro_date,
                            legfile.final_date or date(1970, 1, 1))
         action_dates = [action.date_taken
@@ -87,6 +170,15 @@ class LegislationUpdatesFeed (ContentFeed):
 
         return max([legfile_date] + action_dates)
 
+    def could_match(self, changed_content, last_updated):
+        legfiles = changed_legfiles(changed_content)
+
+        # Most of these feeds follow a single file.
+        if self.selectors.keys() == ['pk']:
+            return any(unicode(legfile.pk) == unicode(self.selectors['pk'])
+                       for legfile in legfiles)
+        return bool(legfiles)
+
     def get_params(self):
         return self.selectors
 
@@ -136,6 +228,15 @@ class BookmarkedContentFeed (LegislationUpdatesFeed):
         # Should probably be optimized.
         return [bookmark.content for bookmark in self.user.bookmarks.all()]
 
+    def could_match(self, changed_content, last_updated):
+        keys = [legfile.pk for legfile in changed_legfiles(changed_content)]
+        if not keys:
+            return False
+
+        legfile_type = ContentType.objects.get_for_model(LegFile)
+        return self.user.bookmarks.filter(content_type=legfile_type,
+                                          content_id__in=keys).exists()
+
     def get_params(self):
         return {'user': self.user.pk}
 
@@ -161,18 +262,33 @@ class SearchResultsFeed (ContentFeed):
         else:
             self.filter = {}
 
+        self._search = None
+
+    search_fields = {
+        'q': 'text',
+        'controlling_bodies': 'controlling_body',
+        'statuses': 'status',
+        'file_types': 'file_type',
+    }
+    """Map of { filter name : search index field }, where they differ"""
+
     @property
     def filter_query(self):
         return urlencode(self.filter)
 
-    def get_content(self):
+    def get_search(self):
+        """
+        Return the search for the feed's filter, unordered.  The filter is
+        only translated into a search once per feed; the search query set is
+        cloned by each further filter or ordering, so it can be reused.
+        """
+        if self._search is None:
+            self._search = self.build_search()
+        return self._search
+
+    def build_search(self):
         qs = SearchQuerySet()
-        search_fields = {
-            'q': 'text',
-            'controlling_bodies': 'controlling_body',
-            'statuses': 'status',
-            'file_types': 'file_type',
-        }
+        search_fields = self.search_fields
 
         for key, val in self.filter.iteritems():
             if key in search_fields:
@@ -189,7 +305,10 @@ class SearchResultsFeed (ContentFeed):
             else:
                 qs = qs.filter(**{field: val})
 
-        return qs.order_by('order_date')
+        return qs
+
+    def get_content(self):
+        return self.get_search().order_by('order_date')
 
     def get_changes_to(self, item, datetime):
         if item.object is None: return {}, item.order_date
@@ -199,14 +318,55 @@ class SearchResultsFeed (ContentFeed):
         elif item.model_name == 'legminutes':
             return {'Minutes': str(item.object)}, item.order_date
 
+    def has_content(self):
+        # Finding the last updated time already finds whether there are any
+        # results, so don't ask the search backend twice.
+        return True
+
     def get_last_updated_time(self):
-        content = self.get_content()
-        return (list(content))[-1].order_date
+        # Only ask the search backend for the latest result.
+        latest = list(self.get_search().order_by('-order_date')[:1])
+        if not latest:
+            return None
+        return latest[0].order_date
 
     def get_updates_since(self, datetime):
-        new_content = self.get_content().filter(order_date__gt=datetime).order_by('order_date')
+        new_content = self.get_search().filter(order_date__gt=datetime).order_by('order_date')
         return new_content
 
+    def could_match(self, changed_content, last_updated):
+        """
+        Check the changed files against the parts of the search that are easy
+        to check without the search engine: the sponsors, topics, status,
+        type, and controlling body.
+        """
+        constraints = []
+        for key, val in self.filter.iteritems():
+            field = self.search_fields.get(key, key)
+            if val in ([], {}, '', (), None):
+                continue
+            if field not in ('sponsors', 'topics', 'status', 'file_type', 'controlling_body'):
+                continue
+            for item in (val if isinstance(val, list) else [val]):
+                constraints.append((field, unicode(item).lower()))
+
+        # Keyword searches also cover minutes, which aren't checked here.
+        if not constraints:
+            return True
+
+        for legfile in changed_legfiles(changed_content):
+            # Results are ordered by introduction date, so an older file
+            # can't change when the feed was last updated.
+            if legfile.intro_date <= last_updated.date():
+                continue
+
+            facets = get_search_facets(legfile)
+            if all(any(wanted in unicode(value).lower() for value in facets[field])
+                   for field, wanted in constraints):
+                return True
+
+        return False
+
     def get_params(self):
         return {'search_filter': json.dumps(self.filter)}
 
@@ -0,0 +1,276 @@
+"""
+Benchmarks for the expensive parts of keeping the legislation data up to date.
+Run them with the ``benchmark`` management command, e.g.::
+
+    councilmatic/manage.py benchmark metadata --size=10000
+
+Any database work that a benchmark does is rolled back when it finishes.
+
+"""
+import glob
+import json
+import multiprocessing
+import os
+import random
+import resource
+import time
+from contextlib import contextmanager
+from itertools import islice
+from django.db import transaction
+
+from phillyleg.management.scraper_wrappers.sources.insite_scraper import PDF_BACKENDS
+from phillyleg.metadata import BulkMetaDataWriter, chunked
+from phillyleg.models import CouncilMember, LegFile, LegFileMetaData, MetaData_Word
+
+
+@contextmanager
+def rolled_back():
+    """Run the enclosed block in a transaction that is always rolled back."""
+    with transaction.commit_manually():
+        try:
+            yield
+        finally:
+            transaction.rollback()
+
+
+@contextmanager
+def timed(label, results):
+    start = time.time()
+    yield
+    results.append((label, time.time() - start))
+
+
+def report(title, results, size, unit, stdout):
+    stdout.write('%s (%s %s)\n' % (title, size, unit))
+    for label, seconds in results:
+        stdout.write('  %-30s %8.2fs  %10.1f %s/s\n' %
+                     (label, seconds, size / seconds if seconds else 0, unit))
+
+
+def synthetic_titles(count, vocabulary_size=20000, length=(10, 60), seed=0):
+    """
+    Generate ``count`` legislation titles made of words drawn from a fixed
+    vocabulary, so that words are shared between files like they are in the
+    real corpus.
+    """
+    rand = random.Random(seed)
+    vocabulary = ['word%d' % i for i in xrange(vocabulary_size)]
+    for _ in xrange(count):
+        yield ' '.join(rand.choice(vocabulary)
+                       for _ in xrange(rand.randint(*length)))
+
+
+def create_synthetic_legfiles(size):
+    """
+    Insert ``size`` legislative files (and empty metadata records) with
+    synthetic titles.  Return a list of (metadata, unique words) pairs.
+    """
+    first_key = (LegFile.objects.order_by('-key').values_list('key', flat=True)[:1] or [0])[0] + 1
+    keys = range(first_key, first_key + size)
+    legfiles = [LegFile(key=key, id='BENCH-%s' % key, title=title)
+                for key, title in zip(keys, synthetic_titles(size))]
+    LegFile.objects.bulk_create(legfiles, batch_size=1000)
+    LegFileMetaData.objects.bulk_create(
+        [LegFileMetaData(legfile_id=key) for key in keys], batch_size=1000)
+
+    words = dict((legfile.key, legfile.unique_words()) for legfile in legfiles)
+    return [(metadata, words[metadata.legfile_id]) for metadata in
+            LegFileMetaData.objects.filter(legfile__key__gte=first_key)]
+
+
+def set_words_one_at_a_time(metadata, words):
+    """The per-word strategy that LegFile.save used to use."""
+    metadata.words.clear()
+    for word in words:
+        md_word = MetaData_Word.objects.get_or_create(value=word)[0]
+        metadata.words.add(md_word)
+
+
+def bench_metadata(stdout, size=None):
+    """
+    Compare per-word metadata writes against the bulk metadata writer, both
+    one file at a time (as in LegFile.save) and in batches (as in reclassify).
+    """
+    size = size or 10000
+    results = []
+    writer = BulkMetaDataWriter(LegFileMetaData)
+
+    with rolled_back():
+        corpus = create_synthetic_legfiles(size)
+        with timed('one word at a time', results):
+            for metadata, words in corpus:
+                set_words_one_at_a_time(metadata, words)
+
+    with rolled_back():
+        corpus = create_synthetic_legfiles(size)
+        with timed('bulk, one file at a time', results):
+            for metadata, words in corpus:
+                writer.set_values('words', {metadata: words})
+
+    with rolled_back():
+        corpus = create_synthetic_legfiles(size)
+        with timed('bulk, 500 files at a time', results):
+            for batch in chunked(corpus, 500):
+                writer.set_values('words', dict(batch))
+
+    report('Metadata word indexing', results, size, 'files', stdout)
+
+
+PDF_FIXTURES = os.path.join(os.path.dirname(__file__), 'tests', 'pdfs', '*.pdf')
+
+SYNTHETIC_PDF_PAGES = (1, 4, 16, 64)
+"""The page counts of the generated documents that the PDF backends are
+   compared on, along with the fixtures"""
+
+
+def synthetic_pdf(pages, lines_per_page=50, seed=0):
+    """
+    Generate a PDF of ``pages`` pages of text lines, made of the same kind of
+    words as ``synthetic_titles``.
+    """
+    titles = synthetic_titles(pages * lines_per_page, length=(5, 12), seed=seed)
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>',
+               None,  # The page tree, once the pages are numbered
+               '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    page_ids = []
+    for _ in xrange(pages):
+        lines = ['(%s) Tj T*' % title for title in islice(titles, lines_per_page)]
+        stream = 'BT /F1 10 Tf 12 TL 40 760 Td\n%s\nET' % '\n'.join(lines)
+        objects.append('<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream))
+        objects.append('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                       '/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>'
+                       % len(objects))
+        page_ids.append(len(objects))
+    objects[1] = '<< /Type /Pages /Kids [%s] /Count %d >>' % (
+        ' '.join('%d 0 R' % page_id for page_id in page_ids), pages)
+
+    pdf = '%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += '%d 0 obj\n%s\nendobj\n' % (number, body)
+    xref = len(pdf)
+    pdf += 'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    pdf += ''.join('%010d 00000 n \n' % offset for offset in offsets)
+    pdf += 'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (
+        len(objects) + 1, xref)
+    return pdf
+
+
+def _extract_pdfs(backend, pdfs, size, results):
+    """
+    Extract the text of ``size`` documents (cycling through ``pdfs``) with the
+    given backend.  Runs in its own process, so that peak RSS is measured for
+    the one backend only.
+    """
+    extract = PDF_BACKENDS[backend]
+    start = time.time()
+    num_bytes = 0
+    for i in xrange(size):
+        pdf_data = pdfs[i % len(pdfs)]
+        extract(pdf_data)
+        num_bytes += len(pdf_data)
+    seconds = time.time() - start
+
+    # ru_maxrss is in kilobytes on Linux.
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    results.put((backend, seconds, num_bytes, self_rss, child_rss))
+
+
+def bench_pdftext(stdout, size=None):
+    """
+    Compare the throughput and peak memory use of the PDF text extraction
+    backends over the council PDFs in the test fixtures, and generated
+    documents of a range of lengths.
+    """
+    size = size or 200
+    pdfs = [open(path, 'rb').read() for path in sorted(glob.glob(PDF_FIXTURES))]
+    pdfs += [synthetic_pdf(pages, seed=pages) for pages in SYNTHETIC_PDF_PAGES]
+    results = multiprocessing.Queue()
+
+    stdout.write('PDF text extraction (%s documents, cycling through %s of '
+                 '%s to %s KB)\n' %
+                 (size, len(pdfs), min(map(len, pdfs)) // 1024,
+                  max(map(len, pdfs)) // 1024))
+    for backend in sorted(PDF_BACKENDS):
+        worker = multiprocessing.Process(target=_extract_pdfs,
+                                         args=(backend, pdfs, size, results))
+        worker.start()
+        backend, seconds, num_bytes, self_rss, child_rss = results.get()
+        worker.join()
+
+        stdout.write('  %-10s %8.2fs  %8.1f docs/s  %8.1f KB/s  '
+                     'peak RSS %s KB (converter %s KB)\n' %
+                     (backend, seconds, size / seconds, num_bytes / 1024.0 / seconds,
+                      self_rss, child_rss))
+
+
+def synthetic_search_filters(count, seed=0):
+    """
+    Generate ``count`` search feed filters like the ones subscribers save,
+    from the sponsors, statuses, and title words in the database.
+    """
+    rand = random.Random(seed)
+    sponsors = list(CouncilMember.objects.values_list('real_name', flat=True)) or ['Nobody']
+    statuses = list(LegFile.objects.order_by().values_list('status', flat=True).distinct()[:50]) or ['Adopted']
+    words = [word for title in LegFile.objects.values_list('title', flat=True)[:1000]
+             for word in title.split() if len(word) > 4] or ['ordinance']
+
+    for i in xrange(count):
+        search_filter = {}
+        if rand.random() < 0.7:
+            search_filter['q'] = [rand.choice(words)]
+        if rand.random() < 0.4:
+            search_filter['sponsors'] = [rand.choice(sponsors)]
+        if rand.random() < 0.3 or not search_filter:
+            search_filter['statuses'] = rand.choice(statuses)
+        yield search_filter
+
+
+def bench_searchfeeds(stdout, size=None):
+    """
+    Compare finding the last updated time of stored search feeds by reading
+    every result against asking the search backend for the latest one.  Uses
+    the configured search index, so results depend on how much is indexed.
+    """
+    from councilmatic.feeds import SearchResultsFeed
+    from councilmatic.subscriptions.feeds import ContentFeedLibrary
+
+    size = size or 300
+    results = []
+    library = ContentFeedLibrary(shared=False)
+    library.register(SearchResultsFeed, 'results of a search query')
+
+    with rolled_back():
+        records = [library.get_record(SearchResultsFeed(search_filter))
+                   for search_filter in synthetic_search_filters(size)]
+
+        def feeds():
+            # Fresh feeds each time, so no run benefits from another's work.
+            return [SearchResultsFeed(json.loads(record.feed_params.get().value))
+                    for record in records]
+
+        all_feeds = feeds()
+        with timed('every result', results):
+            full = []
+            for feed in all_feeds:
+                content = list(feed.get_content())
+                full.append(content[-1].order_date if content else None)
+
+        all_feeds = feeds()
+        with timed('latest result only', results):
+            top = [feed.get_last_updated_time() for feed in all_feeds]
+
+    report('Search feed last updated times', results, size, 'feeds', stdout)
+    mismatches = sum(1 for a, b in zip(full, top) if a != b)
+    if mismatches:
+        stdout.write('  WARNING: %s feeds got different times\n' % mismatches)
+
+
+benchmarks = {
+    'metadata': bench_metadata,
+    'pdftext': bench_pdftext,
+    'searchfeeds': bench_searchfeeds,
+}
+"""Map of { benchmark name : benchmark function }"""
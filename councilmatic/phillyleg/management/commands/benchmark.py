@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+import optparse
+
+from phillyleg.benchmarks import benchmarks
+
+
+class Command(BaseCommand):
+    help = "Run one or more of the named benchmarks (default: all of them)."
+    args = '<benchmark benchmark ...>'
+    option_list = BaseCommand.option_list + (
+            optparse.make_option('--size',
+                action='store',
+                type='int',
+                dest='size',
+                default=None,
+                help='The size of the data set to benchmark against (each '
+                     'benchmark has its own default)'),
+            )
+
+    def handle(self, *names, **options):
+        names = names or sorted(benchmarks.keys())
+
+        for name in names:
+            if name not in benchmarks:
+                raise CommandError('No benchmark named %r. Choose from: %s' %
+                                   (name, ', '.join(sorted(benchmarks.keys()))))
+
+        for name in names:
+            benchmarks[name](self.stdout, options['size'])
@@ -45,12 +45,15 @@ class Command(BaseCommand):
         # Get the latest filings
         curr_key = ds.get_latest_key()
 
-        while True:
-            curr_key, source_obj = source.check_for_new_content(curr_key, force_download)
+        try:
+            while True:
+                curr_key, source_obj = source.check_for_new_content(curr_key, force_download)
 
-            if source_obj is None:
-                break
+                if source_obj is None:
+                    break
 
-            record, attachments, actions, minutes = \
-                source.scrape_legis_file(curr_key, source_obj)
-            ds.save_legis_file(record, attachments, actions, minutes)
+                record, attachments, actions, minutes = \
+                    source.scrape_legis_file(curr_key, source_obj)
+                ds.save_legis_file(record, attachments, actions, minutes)
+        finally:
+            ds.recount_topic_trends()
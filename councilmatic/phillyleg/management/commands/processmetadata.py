@@ -0,0 +1,154 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+import datetime
+import logging
+import multiprocessing
+import optparse
+import os
+import socket
+
+from phillyleg.models import MetaDataJob
+from utils import TooManyGeocodeRequests
+
+log = logging.getLogger(__name__)
+
+
+def drain_queue(worker, max_attempts, claim_timeout, limit=None):
+    """
+    Claim and run metadata jobs until there are none left (or ``limit`` jobs
+    have been run).  Returns the number of jobs that succeeded and failed.
+    """
+    succeeded = failed = 0
+
+    while limit is None or succeeded + failed < limit:
+        # Grab a handful of candidates at a time; other workers are doing the
+        # same, so some of them will already be gone when we try to claim them.
+        candidates = list(MetaDataJob.available(max_attempts, claim_timeout)
+                          .select_related('legfile')[:20])
+        if not candidates:
+            break
+
+        for job in candidates:
+            if not job.claim(worker):
+                continue
+
+            if job.run():
+                succeeded += 1
+            else:
+                failed += 1
+
+            if limit is not None and succeeded + failed >= limit:
+                break
+
+    return succeeded, failed
+
+
+def run_worker(worker, max_attempts, claim_timeout, limit, results):
+    # Each worker process needs its own database connection.
+    connection.close()
+    try:
+        results.put(drain_queue(worker, max_attempts, claim_timeout, limit))
+    except TooManyGeocodeRequests:
+        log.warning('%s: out of geocoding requests for today' % worker)
+        results.put((0, 0))
+    except:
+        # Always report back, so the parent doesn't wait on us forever.
+        log.exception('%s: stopped unexpectedly' % worker)
+        results.put((0, 0))
+        raise
+
+
+class Command(BaseCommand):
+    help = "Update the metadata of the legislative files that are waiting in the metadata queue."
+    option_list = BaseCommand.option_list + (
+            optparse.make_option('--processes',
+                action='store',
+                type='int',
+                dest='processes',
+                default=1,
+                help='The number of worker processes to drain the queue with'),
+            optparse.make_option('--max-attempts',
+                action='store',
+                type='int',
+                dest='max_attempts',
+                default=5,
+                help='Give up on a job after it has failed this many times'),
+            optparse.make_option('--claim-timeout',
+                action='store',
+                type='int',
+                dest='claim_timeout',
+                default=30,
+                help='Consider a worker dead if it has had a job for this '
+                     'many minutes, and let another worker take it'),
+            optparse.make_option('--limit',
+                action='store',
+                type='int',
+                dest='limit',
+                default=None,
+                help='Run at most this many jobs per process'),
+            optparse.make_option('--status',
+                action='store_true',
+                dest='status',
+                default=False,
+                help='Show the state of the queue instead of draining it'),
+            )
+
+    def handle(self, *args, **options):
+        max_attempts = options['max_attempts']
+        claim_timeout = datetime.timedelta(minutes=options['claim_timeout'])
+
+        if options['status']:
+            self.show_status(max_attempts, claim_timeout)
+            return
+
+        processes = options['processes']
+        if processes < 1:
+            raise CommandError('--processes must be at least 1')
+
+        name = '%s:%s' % (socket.gethostname(), os.getpid())
+        if processes == 1:
+            try:
+                succeeded, failed = drain_queue(name, max_attempts, claim_timeout,
+                                                options['limit'])
+            except TooManyGeocodeRequests:
+                raise CommandError('Out of geocoding requests for today')
+        else:
+            # Don't share this process' database connection with the workers.
+            connection.close()
+
+            results = multiprocessing.Queue()
+            workers = [multiprocessing.Process(
+                           target=run_worker,
+                           args=('%s/%s' % (name, i), max_attempts, claim_timeout,
+                                 options['limit'], results))
+                       for i in range(processes)]
+            for worker in workers:
+                worker.start()
+
+            totals = [results.get() for worker in workers]
+            for worker in workers:
+                worker.join()
+
+            succeeded = sum(s for s, f in totals)
+            failed = sum(f for s, f in totals)
+
+        self.stdout.write('Updated the metadata for %s files (%s failed)\n' %
+                          (succeeded, failed))
+
+    def show_status(self, max_attempts, claim_timeout):
+        jobs = MetaDataJob.objects.all()
+        waiting = MetaDataJob.available(max_attempts, claim_timeout)
+        stale = datetime.datetime.now() - claim_timeout
+        in_progress = jobs.filter(claimed_datetime__gte=stale)
+        failed = jobs.filter(attempts__gte=max_attempts)
+
+        self.stdout.write('Waiting:     %s\n' % waiting.count())
+        self.stdout.write('In progress: %s\n' % in_progress.count())
+        self.stdout.write('Failed:      %s\n' % failed.count())
+
+        oldest = waiting.values_list('enqueued_datetime', flat=True)[:1]
+        if oldest:
+            self.stdout.write('Oldest job waiting since %s\n' % oldest[0])
+
+        for job in failed.order_by('legfile')[:20]:
+            self.stdout.write('  %s: %s\n' % (job.legfile_id, job.last_error))
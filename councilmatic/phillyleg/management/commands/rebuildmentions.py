@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+import optparse
+
+from phillyleg.metadata import rebuild_mentions
+
+
+class Command(BaseCommand):
+    help = "Recalculate which files mention which other files, for every legislative file."
+    option_list = BaseCommand.option_list + (
+            optparse.make_option('--batch-size',
+                action='store',
+                type='int',
+                dest='batch_size',
+                default=500,
+                help='The number of files to read and write at a time'),
+            )
+
+    def handle(self, *args, **options):
+        def progress(done):
+            self.stdout.write('%s files done\n' % done)
+
+        mentions = rebuild_mentions(options['batch_size'], progress)
+        self.stdout.write('Found %s mentions\n' % mentions)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from phillyleg.models import TopicTrend
+
+
+class Command(BaseCommand):
+    help = "Recount the topics of every legislative file, by sponsor and week."
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        rows = TopicTrend.recalculate()
+        self.stdout.write('Stored %s topic trends\n' % rows)
@@ -1,19 +1,33 @@
+import datetime
 from django.core.management.base import BaseCommand, CommandError
-from phillyleg.models import LegFile, LegFileMetaData, MetaData_Topic
+from django.db import transaction
+from phillyleg.metadata import BulkMetaDataWriter, chunked
+from phillyleg.models import LegFile, LegFileMetaData, MetaData_Topic, TopicTrend
 
 
 class Command(BaseCommand):
     help = "python manage.py reclassify"
+    batch_size = 500
+
     def handle(self,  *args, **options):
-        legs = LegFile.objects.all()
-        for i, leg in enumerate(legs) :
-            if i % 100 == 0 :
-                print i
-            metadata = LegFileMetaData.objects.get_or_create(legfile=leg)[0]
-            metadata.topics.clear()
+        writer = BulkMetaDataWriter(LegFileMetaData)
+        legs = LegFile.objects.all().select_related('metadata').iterator()
+
+        for i, batch in enumerate(chunked(legs, self.batch_size)):
+            print i * self.batch_size
+
+            topics_by_metadata = {}
+            for leg in batch:
+                try:
+                    metadata = leg.metadata
+                except LegFileMetaData.DoesNotExist:
+                    metadata = LegFileMetaData.objects.get_or_create(legfile=leg)[0]
+                topics_by_metadata[metadata] = leg.topics()
 
-            for topic in leg.topics():
-                t = MetaData_Topic.objects.get_or_create(topic=topic)[0]
-                metadata.topics.add(t)
+            writer.set_values('topics', topics_by_metadata)
+            LegFileMetaData.objects\
+                .filter(pk__in=[metadata.pk for metadata in topics_by_metadata])\
+                .update(updated_datetime=datetime.datetime.now())
 
-            metadata.save()
+        with transaction.commit_on_success():
+            TopicTrend.recalculate()
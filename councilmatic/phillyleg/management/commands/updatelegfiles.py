@@ -9,22 +9,51 @@
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
 from django.utils.importlib import import_module
 import django
 import logging
+import multiprocessing
 import optparse
+import Queue
 import sys
+import threading
+from multiprocessing.pool import ThreadPool
 
 from phillyleg.management.scraper_wrappers import CouncilmaticDataStoreWrapper
 from phillyleg.management.scraper_wrappers import PhillyLegistarSiteWrapper
+from phillyleg.management.scraper_wrappers.fetcher import NOT_MODIFIED
 from utils import TooManyGeocodeRequests
 
-def import_leg_files(start_key, source, ds, save_key=False):
+log = logging.getLogger(__name__)
+
+def save_leg_file(curr_key, scraped, source, ds, save_key=False):
+    """
+    Save a scraped file, or skip it if the source found that it hasn't
+    changed since it was last saved.  Lets the source know once the file is
+    saved (so that it need not be scraped again until it changes).
+    """
+    if scraped is NOT_MODIFIED:
+        ds.skipped_count += 1
+    else:
+        record, attachments, actions, minutes = scraped
+        ds.save_legis_file(record, attachments, actions, minutes)
+        if hasattr(source, 'file_saved'):
+            source.file_saved(curr_key)
+
+    if save_key:
+        ds.save_continuation_key(curr_key)
+
+
+def import_leg_files(start_key, source, ds, save_key=False, workers=0):
     """
     Imports the legislative filings starting at the given key, and going either
     until there it reaches the end of the available records, or the script times
     out.
     """
+    if workers:
+        return import_leg_files_pipelined(start_key, source, ds, save_key, workers)
+
     curr_key = start_key
     while True:
         curr_key, source_obj = source.check_for_new_content(curr_key)
@@ -32,11 +61,93 @@ def import_leg_files(start_key, source, ds, save_key=False):
         if source_obj is None:
             break
 
-        record, attachments, actions, minutes = \
-            source.scrape_legis_file(curr_key, source_obj)
-        ds.save_legis_file(record, attachments, actions, minutes)
-        if save_key:
-            ds.save_continuation_key(curr_key)
+        if source_obj is NOT_MODIFIED:
+            scraped = NOT_MODIFIED
+        else:
+            scraped = source.scrape_legis_file(curr_key, source_obj)
+        save_leg_file(curr_key, scraped, source, ds, save_key)
+
+
+def import_leg_files_pipelined(start_key, source, ds, save_key=False, workers=4):
+    """
+    Imports the legislative filings like ``import_leg_files``, but as a
+    pipeline: a feeder thread looks for new content, up to ``workers`` files
+    are scraped at a time in a thread pool (with PDF text extracted in a
+    process pool, if the source supports it), and the scraped files are saved
+    in key order from the calling thread, the only one that writes to the
+    datastore.  The continuation key is only ever saved after the file with
+    that key has been saved.
+
+    The source's ``scrape_legis_file`` must be safe to call from several
+    threads at once.
+    """
+    # Fork the PDF processes before starting any threads.  Close the database
+    # connection first, so that the children don't share its socket with us;
+    # it's reopened on the next query.
+    pdf_pool = None
+    if hasattr(source, 'pdf_pool'):
+        connection.close()
+        pdf_pool = source.pdf_pool = multiprocessing.Pool(workers)
+    scrape_pool = ThreadPool(workers)
+
+    # A bounded queue of (key, pending scrape result) pairs, in key order.
+    # Bounding the queue keeps the feeder from running too far ahead of the
+    # writer.
+    pending = Queue.Queue(maxsize=workers * 2)
+    finished = object()
+    stopping = threading.Event()
+
+    def enqueue(item):
+        while not stopping.is_set():
+            try:
+                pending.put(item, timeout=1)
+                return
+            except Queue.Full:
+                continue
+
+    def feed():
+        try:
+            curr_key = start_key
+            while not stopping.is_set():
+                curr_key, source_obj = source.check_for_new_content(curr_key)
+
+                if source_obj is None:
+                    break
+
+                if source_obj is NOT_MODIFIED:
+                    enqueue((curr_key, NOT_MODIFIED))
+                    continue
+
+                scraped = scrape_pool.apply_async(
+                    source.scrape_legis_file, (curr_key, source_obj))
+                enqueue((curr_key, scraped))
+            enqueue((None, finished))
+        except Exception, e:
+            log.exception('Failed while checking for new content')
+            enqueue((None, e))
+
+    feeder = threading.Thread(target=feed, name='updatelegfiles-feeder')
+    feeder.daemon = True
+    feeder.start()
+
+    try:
+        while True:
+            curr_key, scraped = pending.get()
+
+            if scraped is finished:
+                break
+            elif isinstance(scraped, Exception):
+                raise scraped
+
+            if scraped is not NOT_MODIFIED:
+                scraped = scraped.get()
+            save_leg_file(curr_key, scraped, source, ds, save_key)
+    finally:
+        stopping.set()
+        scrape_pool.terminate()
+        if pdf_pool is not None:
+            source.pdf_pool = None
+            pdf_pool.terminate()
 
 
 def load_scraper():
@@ -65,6 +176,26 @@ class Command(BaseCommand):
                 dest='update_files',
                 default=False,
                 help='Update existing files as well'),
+            optparse.make_option('--workers',
+                action='store',
+                type='int',
+                dest='workers',
+                default=0,
+                help='Scrape this many files at a time while saving them '
+                     '(default: scrape and save one file at a time)'),
+            optparse.make_option('--defer-metadata',
+                action='store_true',
+                dest='defer_metadata',
+                default=False,
+                help='Queue the metadata (words, locations, mentions, '
+                     'topics) updates for the processmetadata command instead '
+                     'of doing them while saving each file'),
+            optparse.make_option('--force',
+                action='store_true',
+                dest='force',
+                default=False,
+                help='Save every scraped file, even those that are unchanged '
+                     'since they were last saved'),
             )
 
 
@@ -74,6 +205,8 @@ class Command(BaseCommand):
 
         # Create a datastore wrapper object
         ds = self.ds = CouncilmaticDataStoreWrapper()
+        ds.defer_metadata = options['defer_metadata']
+        ds.skip_unchanged = not options['force']
         source = self.source = load_scraper()
 
         # Seed the PDF cache with already-downloaded content.
@@ -81,13 +214,13 @@ class Command(BaseCommand):
         # Downloading and parsing PDF content really slows down the scraping
         # process.  If we had to redownload all of them every time we scraped,
         # it would take a really long time to refresh all of the old stuff.  So
-        # that PDFs that have already been downloaded won't be again, seed the
-        # source cache with that data.
-        #
-        # Hopefully this won't be too much of a burden on memory :).
+        # that PDFs that have already been downloaded won't be again, let the
+        # source fall back on the text in the datastore (looked up one URL at
+        # a time) when a PDF isn't in its cache.
         source.init_pdf_cache(ds.pdf_mapping)
 
         update_files = options['update_files']
+        self.workers = options['workers']
 
         try:
             self._get_new_files()
@@ -95,6 +228,23 @@ class Command(BaseCommand):
                 self._get_updated_files()
         except TooManyGeocodeRequests:
             sys.exit(0)
+        finally:
+            ds.recount_topic_trends()
+            log.info('Saved %s changed files; skipped %s unchanged files' %
+                     (ds.changed_count, ds.skipped_count))
+
+            fetcher = getattr(source, 'fetcher', None)
+            if fetcher is not None:
+                stats = fetcher.stats()
+                log.info('HTTP: %s fetched (%s not modified), %s retries' %
+                         (stats['fetched'], stats['not_modified'], stats['retried']))
+
+            pdf_cache = getattr(source, 'pdf_cache', None)
+            if pdf_cache is not None:
+                stats = pdf_cache.stats()
+                log.info('PDF text cache: %s hits, %s misses (%.0f%%), %s bytes' %
+                         (stats['hits'], stats['misses'],
+                          100 * stats['hit_rate'], stats['size']))
 
     def _get_updated_files(self):
         ds = self.ds
@@ -102,7 +252,8 @@ class Command(BaseCommand):
 
         # Continue updating the entire datastore
         cont_key = ds.get_continuation_key()
-        import_leg_files(cont_key, source, ds, save_key=True)
+        import_leg_files(cont_key, source, ds, save_key=True,
+                         workers=self.workers)
 
         # If we've made it here, then we have all the latest filings, and we have gone
         # through and updated the entire datastore.  Now, reset the continuation key to
@@ -117,4 +268,4 @@ class Command(BaseCommand):
 
         # Get the latest filings
         curr_key = ds.get_latest_key()
-        import_leg_files(curr_key, source, ds)
+        import_leg_files(curr_key, source, ds, workers=self.workers)
@@ -0,0 +1,156 @@
+import logging
+import sqlite3
+import threading
+import time
+
+import requests
+
+log = logging.getLogger(__name__)
+
+
+NOT_MODIFIED = object()
+"""Returned by a source in place of a document that hasn't changed since it
+   was last saved"""
+
+
+class HttpValidatorStore (object):
+    """
+    A persistent record of the ETag and Last-Modified validators that servers
+    sent with the documents at each URL, kept in a sqlite database.
+    """
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.text_factory = str
+        self._conn.executescript('''
+            create table if not exists http_validators (
+                url text primary key,
+                etag text,
+                last_modified text);
+        ''')
+
+    def get(self, url):
+        """
+        Return the conditional request headers for the URL (empty if we have
+        no validators for it).
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'select etag, last_modified from http_validators where url = ?',
+                (url,)).fetchone()
+
+        headers = {}
+        if row is not None:
+            etag, last_modified = row
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def put(self, url, etag=None, last_modified=None):
+        with self._lock:
+            if etag or last_modified:
+                self._conn.execute(
+                    'insert or replace into http_validators (url, etag, last_modified) '
+                    'values (?, ?, ?)', (url, etag, last_modified))
+            else:
+                self._conn.execute(
+                    'delete from http_validators where url = ?', (url,))
+
+    def discard(self, url):
+        self.put(url)
+
+
+class HttpFetcher (object):
+    """
+    Fetches documents for the scrapers over a pooled, keep-alive HTTP
+    session.  Connection errors, timeouts, and 5xx responses are retried up
+    to ``tries`` times in all, waiting ``backoff`` seconds after the first
+    failure and twice as long after each one after that (up to
+    ``max_backoff``).  Other error responses raise ``requests.HTTPError``
+    right away.
+
+    Conditional requests are made with the validators that have been
+    ``remember``-ed for a URL; when the document is unchanged, the response
+    is a 304 with no content.
+    """
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(self, validators_path=':memory:', tries=10, backoff=0.5,
+                 max_backoff=60, timeout=60, pool_size=10):
+        self.tries = tries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.validators = HttpValidatorStore(validators_path)
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.fetched = 0
+        self.not_modified = 0
+        self.retried = 0
+
+    def fetch(self, url, conditional=False):
+        """
+        Return the response for the URL.  If ``conditional``, the response
+        may be a 304 (with no content) when the document hasn't changed since
+        its validators were remembered.
+        """
+        headers = self.validators.get(url) if conditional else {}
+
+        for attempt in range(self.tries):
+            if attempt:
+                self.retried += 1
+                time.sleep(min(self.backoff * 2 ** (attempt - 1), self.max_backoff))
+
+            try:
+                response = self.session.get(url, headers=headers,
+                                            timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                log.warning('Received %r for url %r' % (e, url))
+                error = e
+                continue
+
+            if response.status_code in self.RETRY_STATUSES:
+                log.warning('Received status %s for url %r' % (response.status_code, url))
+                error = requests.HTTPError('%s Server Error for url %s' %
+                                           (response.status_code, url),
+                                           response=response)
+                continue
+
+            self.fetched += 1
+            if response.status_code == 304:
+                self.not_modified += 1
+            else:
+                response.raise_for_status()
+            return response
+
+        log.error('Ran out of tries for %r' % (url,))
+        raise error
+
+    def remember(self, url, headers):
+        """
+        Keep the validators from the headers of a response, to make the next
+        request for the URL conditional.
+        """
+        self.validators.put(url, headers.get('ETag'), headers.get('Last-Modified'))
+
+    def forget(self, url):
+        self.validators.discard(url)
+
+    def stats(self):
+        """Return a dictionary of the fetch, 304, and retry counts."""
+        return {
+            'fetched': self.fetched,
+            'not_modified': self.not_modified,
+            'retried': self.retried,
+        }
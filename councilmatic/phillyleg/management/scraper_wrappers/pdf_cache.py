@@ -0,0 +1,152 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+
+class PdfTextCache (object):
+    """
+    A persistent cache of the text extracted from PDF documents.
+
+    Text is stored (zlib-compressed) in a sqlite database, keyed by the SHA-1
+    digest of the PDF data, so that a document that is re-posted under a new
+    URL never has to be parsed again.  A second table maps URLs to digests, so
+    that documents we have already seen don't even have to be downloaded.
+
+    When the compressed text grows beyond ``max_size`` bytes, the least
+    recently used entries are evicted.
+
+    An optional ``seed`` mapping of { url : text } is consulted on URL misses
+    (e.g., the text that is already stored in the datastore).
+
+    A document may be looked up by URL and then by digest, so the lookup
+    methods don't keep score themselves; ``count`` each document once.
+    """
+
+    def __init__(self, path=':memory:', max_size=512 * 1024 * 1024, seed=None):
+        self.path = path
+        self.max_size = max_size
+        self.seed = seed
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.text_factory = str
+        self._conn.executescript('''
+            create table if not exists pdf_urls (
+                url text primary key,
+                digest text not null);
+            create table if not exists pdf_texts (
+                digest text primary key,
+                text blob not null,
+                size integer not null,
+                last_used real not null);
+            create index if not exists pdf_texts_last_used
+                on pdf_texts (last_used);
+        ''')
+        self._size = self._execute(
+            'select coalesce(sum(size), 0) from pdf_texts').fetchone()[0]
+
+    def _execute(self, sql, params=()):
+        return self._conn.execute(sql, params)
+
+    def digest(self, pdf_data):
+        """Return the key under which text for the given PDF data is stored."""
+        return hashlib.sha1(pdf_data).hexdigest()
+
+    def get_by_url(self, url):
+        """
+        Return the text for the document at the given URL, or None if we
+        haven't seen the URL.
+        """
+        with self._lock:
+            row = self._execute(
+                'select digest from pdf_urls where url = ?', (url,)).fetchone()
+            text = self._get_text(row[0]) if row else None
+
+        if text is None and self.seed is not None:
+            text = self.seed.get(url)
+
+        return text
+
+    def get_by_digest(self, digest):
+        """
+        Return the text for the document with the given digest, or None if we
+        haven't seen the document.
+        """
+        with self._lock:
+            return self._get_text(digest)
+
+    def put(self, digest, text, url=None):
+        """
+        Store the text for the document with the given digest (and, if given,
+        remember that the document lives at the given URL).
+        """
+        compressed = zlib.compress(unicode(text).encode('utf-8'))
+
+        with self._lock:
+            old = self._execute(
+                'select size from pdf_texts where digest = ?', (digest,)).fetchone()
+            self._execute(
+                'insert or replace into pdf_texts (digest, text, size, last_used) '
+                'values (?, ?, ?, ?)',
+                (digest, sqlite3.Binary(compressed), len(compressed), time.time()))
+            self._size += len(compressed) - (old[0] if old else 0)
+
+            if url is not None:
+                self._execute(
+                    'insert or replace into pdf_urls (url, digest) values (?, ?)',
+                    (url, digest))
+
+            self._evict()
+
+    def stats(self):
+        """Return a dictionary of the cache's hit and miss counts and size."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'size': self._size,
+        }
+
+    def count(self, found):
+        """Count a document as a hit or a miss in the ``stats``."""
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def _get_text(self, digest):
+        row = self._execute(
+            'select text from pdf_texts where digest = ?', (digest,)).fetchone()
+        if row is None:
+            return None
+
+        self._execute('update pdf_texts set last_used = ? where digest = ?',
+                      (time.time(), digest))
+        return zlib.decompress(str(row[0])).decode('utf-8')
+
+    def _evict(self):
+        if self._size <= self.max_size:
+            return
+
+        rows = self._execute(
+            'select digest, size from pdf_texts order by last_used, rowid').fetchall()
+        evicted = []
+        for digest, size in rows:
+            if self._size <= self.max_size:
+                break
+            evicted.append((digest,))
+            self._size -= size
+
+        self._conn.executemany('delete from pdf_texts where digest = ?', evicted)
+        self._conn.executemany('delete from pdf_urls where digest = ?', evicted)
+        log.debug('Evicted %s documents from the PDF text cache' % len(evicted))
@@ -1,15 +1,56 @@
 import datetime
-import httplib
 import logging
 import re
-import urllib2
+import requests
 import utils
 from bs4 import BeautifulSoup
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from multiprocessing.pool import ThreadPool
+
+from phillyleg.management.scraper_wrappers.fetcher import HttpFetcher, NOT_MODIFIED
+from phillyleg.management.scraper_wrappers.pdf_cache import PdfTextCache
 
 log = logging.getLogger(__name__)
 
 STARTING_KEY = 72 # The highest key was 11001 as of 5 Apr 2011
 
+
+def extract_xml_text(xml_data, root_node_name):
+    soup = BeautifulSoup(xml_data)
+    root_node = soup.find(root_node_name)
+
+    if root_node:
+        xml_text = root_node.text
+        return xml_text
+    # Some PDFs are images
+    else:
+        return ''
+
+
+def extract_pdf_xml_text(pdf_data, timeout=None):
+    """
+    Convert the PDF data to XML and pull out its text.  This is a module-level
+    function so that it can be sent to a process pool.
+    """
+    xml_data = utils.pdftoxml(pdf_data, timeout=timeout or 60)
+    return extract_xml_text(xml_data, 'pdf2xml')
+
+
+def extract_pdf_plain_text(pdf_data, timeout=None):
+    """
+    Stream the PDF data through pdftotext.  Skips the XML and soup round trip,
+    but the text is laid out a little differently than pdftohtml's.
+    """
+    return utils.pdftotxt(pdf_data, timeout=timeout or 60)
+
+
+PDF_BACKENDS = {
+    'pdftohtml': extract_pdf_xml_text,
+    'pdftotext': extract_pdf_plain_text,
+}
+"""Map of { backend name : function(pdf_data, timeout) returning text }"""
+
 class PhillyLegistarSiteWrapper (object):
     """
     A facade over the Philadelphia city council legistar site data.  It is
@@ -17,14 +58,63 @@ class PhillyLegistarSiteWrapper (object):
     of interaction is scrape_legis_file.
     """
 
-    def __init__(self, root_url):
+    pdf_pool = None
+    """An optional multiprocessing pool in which to extract PDF text"""
+
+    probe_pool = None
+    """The thread pool in which a window of keys is probed, created with the
+       first window"""
+
+    def __init__(self, root_url, pdf_cache_path=None,
+                 pdf_cache_size=512 * 1024 * 1024,
+                 pdf_backend='pdftotext', pdf_timeout=60,
+                 http_cache_path=':memory:', http_tries=10, http_backoff=0.5,
+                 http_timeout=60, probe_window=1):
+        if pdf_backend not in PDF_BACKENDS:
+            raise ValueError('Unknown PDF backend %r; choose from %s' %
+                             (pdf_backend, ', '.join(sorted(PDF_BACKENDS))))
+
+        # Without somewhere to keep it, the text of every PDF would be
+        # extracted again on every run.
+        if pdf_cache_path is None:
+            pdf_cache_path = getattr(settings, 'PDF_CACHE_PATH', None)
+        if not pdf_cache_path:
+            raise ImproperlyConfigured(
+                'Set PDF_CACHE_PATH (or the pdf_cache_path scraper option) to '
+                'the file in which to keep the text extracted from PDFs.')
+
         self.root_url = root_url
+        self.pdf_cache = PdfTextCache(pdf_cache_path, pdf_cache_size)
+        self.pdf_backend = pdf_backend
+        self.pdf_timeout = pdf_timeout
+        self.fetcher = HttpFetcher(http_cache_path, tries=http_tries,
+                                   backoff=http_backoff, timeout=http_timeout,
+                                   pool_size=max(10, probe_window))
+
+        # The number of keys to look for new content at at a time, and the
+        # responses for keys that have been probed but not looked at yet.
+        self.probe_window = max(1, probe_window)
+        self.probed = {}
+
+        # The validators of detail pages that have been scraped, but whose
+        # files haven't been saved yet, by key.
+        self.unsaved_validators = {}
 
     def get_legfile_url(self, key):
         return self.root_url + 'detailreport/?key=' + str(key)
 
-    def urlopen(self, *args, **kwargs):
-        return urllib2.urlopen(*args, **kwargs)
+    def fetch(self, url, conditional=False):
+        return self.fetcher.fetch(url, conditional=conditional)
+
+    def file_saved(self, key):
+        """
+        Note that the file with the given key has been saved, so its detail
+        page need not be scraped again until it changes.
+        """
+        validated = self.unsaved_validators.pop(key, None)
+        if validated is not None:
+            url, headers = validated
+            self.fetcher.remember(url, headers)
 
     def scrape_legis_file(self, key, soup):
         '''Extract a record from the given document (soup). The key is for the
@@ -201,66 +291,94 @@ class PhillyLegistarSiteWrapper (object):
 
         return actions
 
-    __pdf_cache = None
     def init_pdf_cache(self, seed=None):
-        if seed is None:
-            seed = {}
-        self.__pdf_cache = self.__pdf_cache or seed
+        """
+        Set a mapping of { url : text } to fall back on when a PDF URL isn't in
+        the PDF text cache (e.g., the text already stored in the datastore).
+        The mapping is only consulted one URL at a time.
+        """
+        self.pdf_cache.seed = seed
 
-    def extract_pdf_text(self, pdf_data, tries_left=5):
+    def extract_pdf_text(self, pdf_data):
         """
         Given an http[s] URL, a file URL, or a file-like object containing
         PDF data, return the text from the PDF.  Cache URLs or data that have
         already been seen.
         """
 
-        self.init_pdf_cache()
-
-        pdf_key = pdf_data
-        if pdf_key in self.__pdf_cache:
-            pdf_content = unicode(self.__pdf_cache[pdf_key])
-            if pdf_content not in [None, 'None']:
+        pdf_url = None
+        if pdf_data.startswith(('file://', 'http://', 'https://')):
+            pdf_url = pdf_data
+            pdf_content = self.pdf_cache.get_by_url(pdf_url)
+            if pdf_content is not None:
+                self.pdf_cache.count(True)
                 return pdf_content
 
-        if pdf_key.startswith('file://'):
-            path = pdf_key[7:]
+        if pdf_data.startswith('file://'):
+            path = pdf_url[7:]
             pdf_data = open(path).read()
-        elif pdf_key.startswith('http://') or pdf_key.startswith('https://'):
-            url = pdf_key
+        elif pdf_data.startswith('http://') or pdf_data.startswith('https://'):
+            url = pdf_url
             try:
-                pdf_data = self.urlopen(url).read()
+                pdf_data = self.fetch(url).content
 
             # Protect against removed PDFs (ones that result in 404 HTTP
             # response code).  I don't know why they've removed some PDFs
             # but they have.
-            except urllib2.HTTPError, err:
-                if err.code == 404:
-                    self.__pdf_cache[pdf_key] = ''
+            except requests.HTTPError, err:
+                if err.response is not None and err.response.status_code == 404:
+                    self.pdf_cache.count(False)
+                    self.pdf_cache.put(self.pdf_cache.digest(''), '', url=url)
                     return ''
                 else:
                     raise
 
-            # Been getting timeout exceptions every so often, so try again
-            # if timed out.
-            except urllib2.URLError, err:
-                if tries_left:
-                    return self.extract_pdf_text(pdf_key, tries_left-1)
-
-        xml_data = utils.pdftoxml(pdf_data)
+            # The fetcher has already retried; leave the text out, and try
+            # again on the next scrape.
+            except requests.RequestException, err:
+                log.error('Could not download the PDF at %r: %r' % (url, err))
+                self.pdf_cache.count(False)
+                return ''
 
-        self.__pdf_cache[pdf_key] = self.extract_xml_text(xml_data, 'pdf2xml')
-        return self.__pdf_cache[pdf_key]
+        # Identical documents are often posted under different URLs, so check
+        # whether we've seen this content before parsing it.
+        pdf_digest = self.pdf_cache.digest(pdf_data)
+        if self.pdf_backend != 'pdftohtml':
+            # Different backends produce different text for the same document.
+            # Text from pdftohtml (the only backend there used to be) is kept
+            # under the bare digest, so caches from before still work.
+            pdf_digest += ':' + self.pdf_backend
+        pdf_text = self.pdf_cache.get_by_digest(pdf_digest)
+        self.pdf_cache.count(pdf_text is not None)
+
+        if pdf_text is None:
+            try:
+                pdf_text = unicode(self.extract_pdf_data_text(pdf_data))
+
+            # Don't let one pathological PDF stop the scrape (on this run or
+            # any other); remember it as having no text.
+            except utils.PdfConversionTimeout, err:
+                log.warning('Could not extract the text from %s: %s' %
+                            (pdf_url or 'a PDF', err))
+                pdf_text = u''
+
+        self.pdf_cache.put(pdf_digest, pdf_text, url=pdf_url)
+        return pdf_text
+
+    def extract_pdf_data_text(self, pdf_data):
+        """Extract the text from raw PDF data with the configured backend."""
+        extract = PDF_BACKENDS[self.pdf_backend]
+
+        if self.pdf_pool is not None:
+            return self.pdf_pool.apply(extract, (pdf_data, self.pdf_timeout))
+        elif self.pdf_backend == 'pdftohtml':
+            xml_data = utils.pdftoxml(pdf_data, timeout=self.pdf_timeout)
+            return self.extract_xml_text(xml_data, 'pdf2xml')
+        else:
+            return extract(pdf_data, self.pdf_timeout)
 
     def extract_xml_text(self, xml_data, root_node_name):
-        soup = BeautifulSoup(xml_data)
-        root_node = soup.find(root_node_name)
-
-        if root_node:
-            xml_text = root_node.text
-            return xml_text
-        # Some PDFs are images
-        else:
-            return ''
+        return extract_xml_text(xml_data, root_node_name)
 
     def convert_date(self, orig_date):
         if orig_date:
@@ -276,44 +394,77 @@ class PhillyLegistarSiteWrapper (object):
         if error_p is None: return False
         else: return True
 
+    def might_be_error_page(self, content):
+        '''Check the raw page for the error text class, so that pages that
+           are certainly not error pages can skip a closer look.'''
+        return 'errorText' in content
+
+    def probe_keys(self, keys):
+        '''Fetch the detail pages for the given keys, a window's worth at a
+           time in the probe pool.  Returns { key : response }, where a
+           failed fetch's response is the exception it raised.'''
+
+        def probe(key):
+            try:
+                return self.fetch(self.get_legfile_url(key), conditional=True)
+            except Exception, ex:
+                return ex
+
+        if self.probe_window > 1:
+            if self.probe_pool is None:
+                self.probe_pool = ThreadPool(self.probe_window)
+            responses = self.probe_pool.map(probe, keys)
+        else:
+            responses = [probe(key) for key in keys]
+        return dict(zip(keys, responses))
+
     def check_for_new_content(self, last_key):
         '''Look through the next 100 keys to see if there are any more files.
            100 is arbitrary, but I feel like it's large enough to be safe.  I
-           tried 10, but 12544 through 12568 are missing for Philly :('''
-
-        curr_key = last_key
-        for _ in xrange(100):
-            curr_key = curr_key + 1
-
-            url = self.get_legfile_url(curr_key)
-            more_tries = 10
-            while True:
-                try:
-                    html = self.urlopen(url)
-                    break
-
-                # Sometimes the server will respond with a status line that httplib
-                # does not understand (an empty status line, in particular).  When
-                # this happens, keep trying to access the page.  Give up after 10
-                # tries.
-                except httplib.BadStatusLine, ex:
-                    more_tries -= 1;
-                    log.warning('Received BadStatusLine exception %r for url %r' % (ex, url))
-                    if not more_tries:
-                        log.error('Ran out of tries for new content')
-                        raise
-
-                # Sometimes the server will do things like just take too long to
-                # respond.  When it does, try again 10 times.
-                except urllib2.URLError, ex:
-                    more_tries -= 1;
-                    log.warning('Received URLError exception %r for url %r' % (ex, url))
-                    if not more_tries:
-                        log.error('Ran out of tries for new content')
-                        raise
-            soup = BeautifulSoup(html)
-
-            if not self.is_error_page(soup):
+           tried 10, but 12544 through 12568 are missing for Philly :(
+
+           The keys are fetched probe_window at a time, and looked at in key
+           order.  Pages fetched past the file that's found are kept for the
+           next call.  If the detail page for the next file hasn't changed
+           since the file was last saved, NOT_MODIFIED is returned in place of
+           its soup.'''
+
+        keys = range(last_key + 1, last_key + 101)
+
+        # Forget anything probed before the last key.
+        for key in self.probed.keys():
+            if key <= last_key:
+                del self.probed[key]
+
+        for start in xrange(0, len(keys), self.probe_window):
+            window = keys[start:start + self.probe_window]
+            unprobed = [key for key in window if key not in self.probed]
+            if unprobed:
+                self.probed.update(self.probe_keys(unprobed))
+
+            for curr_key in window:
+                # Sometimes the server will respond with a status line that
+                # httplib does not understand (an empty status line, in
+                # particular), or just take too long to respond.  The fetcher
+                # keeps trying, and gives up after http_tries tries.
+                response = self.probed.pop(curr_key)
+                if isinstance(response, Exception):
+                    raise response
+
+                if response.status_code == 304:
+                    return curr_key, NOT_MODIFIED
+
+                soup = None
+                if self.might_be_error_page(response.content):
+                    soup = BeautifulSoup(response.content)
+                    if self.is_error_page(soup):
+                        continue
+
+                if soup is None:
+                    soup = BeautifulSoup(response.content)
+
+                url = self.get_legfile_url(curr_key)
+                self.unsaved_validators[curr_key] = (url, response.headers)
                 return curr_key, soup
 
-        return curr_key, None
+        return keys[-1], None
@@ -1,8 +1,11 @@
 import datetime
+import hashlib
+import json
 import phillyleg
-from django.db import transaction
+from django.db import models, transaction
 from django.db.utils import IntegrityError
 
+from councilmatic.subscriptions.models import ContentChange
 from phillyleg.models import *
 
 identity = lambda x: x
@@ -17,6 +20,76 @@ def unique(iterable, key=None):
             yield elem
 
 
+class StoredPdfTextMapping (object):
+    """
+    A read-only mapping from the URLs of attachment and minutes PDFs to the
+    text that has already been extracted from them and stored.
+    """
+
+    def get(self, url, default=None):
+        for Model in (LegFileAttachment, LegMinutes):
+            # PDFs that couldn't be downloaded used to be stored with the
+            # text 'None'; leave them out so that they're tried again.
+            texts = Model.objects.filter(url=url).exclude(fulltext='None')\
+                .values_list('fulltext', flat=True)[:1]
+            if texts:
+                return texts[0]
+        return default
+
+    def __getitem__(self, url):
+        text = self.get(url)
+        if text is None:
+            raise KeyError(url)
+        return text
+
+    def __contains__(self, url):
+        return self.get(url) is not None
+
+
+class CouncilMemberIndex (object):
+    """
+    A mapping from the names by which council members are referred to in
+    legislation to the members themselves.  The aliases are all loaded with
+    the first lookup, and members are created for names that have not been
+    seen before, so that a scrape only queries for a member once.
+    """
+
+    def __init__(self):
+        self.members_by_name = None
+
+    def load(self):
+        self.members_by_name = {}
+        aliases = CouncilMemberAlias.objects.select_related('member').order_by('-pk')
+        for alias in aliases:
+            # Where a name is used by more than one member, the earliest
+            # alias wins.
+            self.members_by_name[alias.name] = alias.member
+
+    def clear(self):
+        self.members_by_name = None
+
+    def get_or_create(self, name):
+        if self.members_by_name is None:
+            self.load()
+
+        try:
+            return self.members_by_name[name]
+        except KeyError:
+            pass
+
+        # The alias may have been added since the index was loaded.
+        aliases = CouncilMemberAlias.objects.filter(name=name)\
+            .select_related('member').order_by('pk')[:1]
+        if aliases:
+            member = aliases[0].member
+        else:
+            member = CouncilMember.objects.create(real_name=name)
+            CouncilMemberAlias.objects.create(member=member, name=name)
+
+        self.members_by_name[name] = member
+        return member
+
+
 class CouncilmaticDataStoreWrapper (object):
     """
     This is the interface over an arbitrary database where the information is
@@ -28,6 +101,21 @@ class CouncilmaticDataStoreWrapper (object):
     """
     STARTING_KEY = 72
 
+    defer_metadata = False
+    """Queue metadata updates for the processmetadata command, instead of
+       doing them as each file is saved"""
+
+    skip_unchanged = True
+    """Don't save files that are scraped exactly as they were last saved"""
+
+    def __init__(self):
+        self.changed_count = 0
+        self.skipped_count = 0
+
+        # The intro dates of the saved files whose weeks' topic trends are
+        # yet to be recounted.
+        self.trend_dates = set()
+
     def get_latest_key(self):
         '''Check the datastore for the key of the most recent filing.'''
 
@@ -53,6 +141,17 @@ class CouncilmaticDataStoreWrapper (object):
         keys.continuation_key = key
         keys.save()
 
+    __members = None
+    @property
+    def members(self):
+        """
+        The index of council members by name, shared by every file saved
+        through this store.
+        """
+        if self.__members is None:
+            self.__members = CouncilMemberIndex()
+        return self.__members
+
     def has_text_changed(self, key, new_legfile):
         """
         Check if the legfile text has changed to determine whether the metadata
@@ -68,13 +167,48 @@ class CouncilmaticDataStoreWrapper (object):
         except LegFile.DoesNotExist:
             return True
 
-    @transaction.commit_on_success
+    @staticmethod
+    def make_content_hash(file_record, attachment_records,
+                          action_records, minutes_records):
+        """
+        Make a hash of everything scraped for a file (including the votes on
+        its actions), to tell whether any of it has changed.
+        """
+        canonical = json.dumps([file_record, attachment_records,
+                                action_records, minutes_records],
+                               sort_keys=True, default=unicode)
+        return hashlib.sha1(canonical).hexdigest()
+
     def save_legis_file(self, file_record, attachment_records,
                         action_records, minutes_records):
         """
         Take a legislative file record and do whatever needs to be
-        done to get it into the database.
+        done to get it into the database.  Returns whether the file was saved;
+        files that haven't changed since they were last saved are skipped.
         """
+        # Hash the records before they're modified for saving.
+        content_hash = self.make_content_hash(
+            file_record, attachment_records, action_records, minutes_records)
+
+        if self.skip_unchanged and LegFile.objects.filter(
+                key=file_record['key'], content_hash=content_hash).exists():
+            self.skipped_count += 1
+            return False
+
+        try:
+            self._save_legis_file(file_record, attachment_records,
+                                  action_records, minutes_records, content_hash)
+        except:
+            # Any members created for the file were rolled back with it.
+            self.members.clear()
+            raise
+
+        self.changed_count += 1
+        return True
+
+    @transaction.commit_on_success
+    def _save_legis_file(self, file_record, attachment_records,
+                         action_records, minutes_records, content_hash=''):
         file_record = self.__convert_or_delete_date(file_record, 'intro_date')
         file_record = self.__convert_or_delete_date(file_record, 'final_date')
 
@@ -94,14 +228,18 @@ class CouncilmaticDataStoreWrapper (object):
             legfile = LegFile(key=file_record['key'])
 
         legfile.update(file_record, commit=False)
+        legfile.content_hash = content_hash
 
         # Changing the text in a legfile is an expensive operation.  Not only
         # do we save the file, but also a record for each unique word in the
         # file.  So, if we can avoid updating that metadata we should.
         changed = self.has_text_changed(legfile.key, legfile)
-        legfile.save(update_words=changed, update_mentions=changed, update_locations=changed)
+        # The mentioned files are found in the attachments' text as well as
+        # the title, so they're updated once the attachments are saved
+        # (below).
+        legfile.save(update_words=changed, update_mentions=False, update_locations=changed,
+                     defer_metadata=self.defer_metadata)
 
-        existing_sponsors = legfile.sponsors.all().prefetch_related('aliases')
         existing_topics = legfile.metadata.topics.all()
 
         if isinstance(sponsor_names, basestring):
@@ -109,28 +247,21 @@ class CouncilmaticDataStoreWrapper (object):
 
         # Only consider unique councilmember names. This protects against 
         # errors in the source data such as at http://phila.legistar.com/LegislationDetail.aspx?ID=1448369&GUID=854AA05E-BE3F-4ED4-A7D4-D7CFF00987FE
-        for sponsor_name in unique(sponsor_names):
-            if sponsor_name is None or len(sponsor_name) == 0:
-                continue
+        sponsors = [self.members.get_or_create(sponsor_name)
+                    for sponsor_name in unique(sponsor_names)
+                    if sponsor_name]
 
+        # Adding the sponsors all at once only inserts the ones the file
+        # doesn't already have.
+        if sponsors:
             try:
-                sponsor = CouncilMember.objects.get(aliases__name=sponsor_name)
-            except CouncilMember.DoesNotExist:
-                sponsor = CouncilMember.objects.create(real_name=sponsor_name)
-                alias = CouncilMemberAlias.objects.create(member=sponsor, name=sponsor_name)
-
-            # Add the legislation to the sponsor and save, instead of the other
-            # way around, because saving legislation can be expensive.
-            if sponsor not in existing_sponsors :
-                try:
-                    sid = transaction.savepoint()
-                    sponsor.legislation.add(legfile)
-                    sponsor.save()
-                    transaction.savepoint_commit(sid)
-                except IntegrityError:
-                    # If by some fluke we still end up inserting a duplicate,
-                    # handle gracefully.
-                    transaction.savepoint_rollback(sid)
+                sid = transaction.savepoint()
+                legfile.sponsors.add(*sponsors)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # If by some fluke we still end up inserting a duplicate,
+                # handle gracefully.
+                transaction.savepoint_rollback(sid)
 
         for topic_name in topic_names:
             topic, created = MetaData_Topic.objects.get_or_create(topic=topic_name)
@@ -138,64 +269,146 @@ class CouncilmaticDataStoreWrapper (object):
                 legfile.metadata.topics.add(topic)
 
         # Create notes attached to the record
+        added_attachments = False
         for attachment_record in attachment_records:
             attachment_record = self.__replace_key_with_legfile(attachment_record)
-            self._save_or_ignore(LegFileAttachment, attachment_record)
+            if self._save_or_ignore(LegFileAttachment, attachment_record) is not None:
+                added_attachments = True
+
+        # Find the files mentioned in the title and attachments.
+        if changed or added_attachments:
+            if self.defer_metadata:
+                MetaDataJob.enqueue(legfile, update_mentions=True)
+            else:
+                legfile.update_metadata(update_words=False, update_mentions=True,
+                                        update_locations=False, update_topics=False)
 
         # Create minutes
         for minutes_record in minutes_records:
             self._save_or_ignore(LegMinutes, minutes_record)
 
         # Create actions attached to the record
+        self._save_actions(legfile, action_records)
+
+        # Let the subscription feeds know that the file may have changed.
+        ContentChange.record(legfile)
+
+        # The file may have a new status, type, sponsor, etc. to search by.
+        invalidate_search_choices()
+
+        # Recount the topics for the week the file was introduced in, once
+        # the run is over.  Files whose metadata is deferred are recounted
+        # when the job runs.
+        if not self.defer_metadata:
+            self.trend_dates.add(legfile.intro_date)
+
+    @transaction.commit_on_success
+    def recount_topic_trends(self):
+        """
+        Recount the topic trends for the weeks of the files saved since the
+        last recount.  Returns the number of trend rows.
+        """
+        dates, self.trend_dates = self.trend_dates, set()
+        return TopicTrend.recalculate(dates)
+
+    @staticmethod
+    def _action_fingerprint(date_taken, description, notes):
+        """
+        The values that identify an action among a file's actions (the
+        action's unique fields, other than the file).
+        """
+        date_taken = LegAction._meta.get_field('date_taken').to_python(date_taken)
+        if isinstance(date_taken, datetime.datetime):
+            date_taken = date_taken.date()
+        return (date_taken, description, notes)
+
+    def _save_actions(self, legfile, action_records):
+        """
+        Save the actions on the file that are not already stored, along with
+        the votes taken on them.  The stored actions are read once and
+        compared in memory, and the new actions and votes are each inserted
+        all at once.  Returns the new actions.
+        """
+        stored = set(
+            self._action_fingerprint(*values) for values in
+            LegAction.objects.filter(file=legfile)
+                             .values_list('date_taken', 'description', 'notes'))
+
+        new_actions = []
+        votes_by_fingerprint = {}
         for action_record in action_records:
             action_record = self.__replace_key_with_legfile(action_record)
             action_record = self.__replace_url_with_minutes(action_record)
             votes = action_record.pop('votes', [])
-            action = None
-            if not self.is_duplicate_action(action_record):
-                action = self._save_or_ignore(LegAction, action_record)
 
-            if action is None:
+            action = LegAction(**action_record)
+            fingerprint = self._action_fingerprint(
+                action.date_taken, action.description, action.notes)
+
+            # Actions without a date can't be stored.
+            if fingerprint[0] is None or fingerprint in stored:
                 continue
 
-            for vote_record in votes:
-                vote_record['action'] = action
-                voter_name = vote_record['voter']
-                voter, created = CouncilMember.objects.get_or_create(name=voter_name)
-                vote_record['voter'] = voter
-                vote = self._save_or_ignore(LegVote, vote_record)
-                
-    def is_duplicate_action(self, action_record):
-        """
-        Check whether the given action_record data already exists in the
-        database.
-        """
-        date_taken = action_record.get('date_taken')
-        legfile = action_record.get('file')
-        actions = LegAction.objects.filter(date_taken=date_taken, file=legfile)
+            action.date_taken = fingerprint[0]
+            stored.add(fingerprint)
+            new_actions.append(action)
+            votes_by_fingerprint[fingerprint] = votes
 
-        for action in actions:
-            if action.description == action_record.get('description') and \
-               action.notes == action_record.get('notes'):
-                return True
+        if not new_actions:
+            return []
 
-        return False
+        try:
+            sid = transaction.savepoint()
+            LegAction.objects.bulk_create(new_actions)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Something else stored some of the same actions in the meantime;
+            # fall back to saving the actions one at a time.
+            transaction.savepoint_rollback(sid)
+            new_actions = [action for action in new_actions
+                           if self._save_instance_or_ignore(action)]
+            if not new_actions:
+                return []
+
+        # Bulk creation skips LegAction.save, so move the file's last
+        # activity up to its latest new action here.
+        latest = max(action.date_taken for action in new_actions)
+        LegFile.objects\
+            .filter(pk=legfile.pk)\
+            .filter(models.Q(last_activity__lt=latest) |
+                    models.Q(last_activity__isnull=True))\
+            .update(last_activity=latest)
+
+        # The actions created in bulk don't know their ids, so read them
+        # back to attach the votes.
+        if any(votes_by_fingerprint.values()):
+            action_ids = dict(
+                (self._action_fingerprint(date_taken, description, notes), pk)
+                for pk, date_taken, description, notes in
+                LegAction.objects.filter(file=legfile)
+                                 .values_list('pk', 'date_taken', 'description', 'notes'))
+
+            votes = []
+            for action in new_actions:
+                fingerprint = self._action_fingerprint(
+                    action.date_taken, action.description, action.notes)
+                for vote_record in votes_by_fingerprint[fingerprint]:
+                    vote_record = dict(vote_record)
+                    vote_record['action_id'] = action_ids[fingerprint]
+                    vote_record['voter'] = self.members.get_or_create(vote_record['voter'])
+                    votes.append(LegVote(**vote_record))
+            LegVote.objects.bulk_create(votes)
+
+        return new_actions
 
     @property
     def pdf_mapping(self):
         """
-        Build a mapping of the URLs and PDF test that already exist in the
-        database.
+        A mapping of the URLs and PDF text that already exist in the
+        database.  Each URL is looked up on demand, instead of loading all of
+        the text into memory up front.
         """
-        mapping = {}
-
-        for attachment in LegFileAttachment.objects.all():
-            mapping[attachment.url] = attachment.fulltext
-
-        for minutes in LegMinutes.objects.all():
-            mapping[minutes.url] = minutes.fulltext
-
-        return mapping
+        return StoredPdfTextMapping()
 
     def __convert_or_delete_date(self, file_record, date_key):
         if file_record[date_key]:
@@ -232,7 +445,7 @@ class CouncilmaticDataStoreWrapper (object):
                 minutes = None
             else:
                 try:
-                    minutes = LegMinutes.objects.get(url=record['minutes_url'])
+                    minutes = LegMinutes.objects.get(url=minutes_url)
                 except phillyleg.models.LegMinutes.DoesNotExist:
                     minutes = None
             self.__legminutes_cache[minutes_url] = minutes
@@ -244,7 +457,9 @@ class CouncilmaticDataStoreWrapper (object):
         return record
 
     def _save_or_ignore(self, ModelClass, record):
-        model_instance = ModelClass(**record)
+        return self._save_instance_or_ignore(ModelClass(**record))
+
+    def _save_instance_or_ignore(self, model_instance):
         try:
             # Wrap the save in a transaction savepoint, so that if we want to
             # roll back to this point we can.  We will want to roll back if
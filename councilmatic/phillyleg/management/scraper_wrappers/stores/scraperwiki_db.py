@@ -53,11 +53,11 @@ class ScraperWikiDataStoreWrapper (object):
         mapping = {}
 
         attachments = scraperwiki.sqlite.select('* from attachments')
-        for attachment in attachments:
-            mapping[attachment['url']] = attachment['fulltext']
-
         minuteses = scraperwiki.sqlite.select('* from minuteses')
-        for minutes in minuteses:
-            mapping[minutes['url']] = minutes['fulltext']
+        for document in attachments + minuteses:
+            # PDFs that couldn't be downloaded used to be stored with the
+            # text 'None'; leave them out so that they're tried again.
+            if document['fulltext'] not in (None, 'None'):
+                mapping[document['url']] = document['fulltext']
 
         return mapping
@@ -0,0 +1,187 @@
+"""
+Bulk writers for legislative file and minutes metadata.
+
+Attaching metadata values (words, topics) one at a time costs a
+``get_or_create`` and an M2M ``add`` per value, which means hundreds of round
+trips for every file that gets scraped.  The ``BulkMetaDataWriter`` resolves
+all of the values for a batch of metadata records with a single ``__in``
+lookup, creates the missing values with one bulk insert, and writes all of the
+M2M through-rows with another.
+
+"""
+import logging
+from itertools import chain
+from django.db import transaction
+from django.db.utils import IntegrityError
+
+from phillyleg.models import (LegFile, LegFileAttachment, LegFileMetaData,
+    MetaData_Word, MetaData_Topic, find_legfile_ids)
+
+log = logging.getLogger(__name__)
+
+
+def chunked(iterable, size):
+    """Split an iterable up into lists of at most ``size`` elements."""
+    chunk = []
+    for elem in iterable:
+        chunk.append(elem)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class BulkMetaDataWriter (object):
+    """
+    Sets the values of a many-to-many metadata field (e.g., ``words`` or
+    ``topics``) on many metadata records at once.
+
+        >>> writer = BulkMetaDataWriter(LegFileMetaData)
+        >>> writer.set_values('words', {metadata1: set(['a', 'b']),
+        ...                             metadata2: set(['b', 'c'])})
+
+    """
+
+    value_attrs = {
+        MetaData_Word: 'value',
+        MetaData_Topic: 'topic',
+    }
+    """Map of { ValueModel : name of the attribute holding the value }"""
+
+    batch_size = 1000
+    """The maximum number of values to look up or insert in one query"""
+
+    def __init__(self, MetaDataModel):
+        self.MetaDataModel = MetaDataModel
+
+    def resolve_values(self, ValueModel, values):
+        """
+        Return a map of { value : primary key } for each of the given values,
+        creating the ones that don't exist yet.
+        """
+        value_attr = self.value_attrs[ValueModel]
+        lookup = value_attr + '__in'
+
+        values = set(values)
+        pks = {}
+        for chunk in chunked(values, self.batch_size):
+            pks.update(ValueModel.objects.filter(**{lookup: chunk})
+                                         .values_list(value_attr, 'pk'))
+
+        missing = values - set(pks)
+        if missing:
+            try:
+                sid = transaction.savepoint()
+                ValueModel.objects.bulk_create(
+                    [ValueModel(**{value_attr: value}) for value in missing],
+                    batch_size=self.batch_size)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # Some other writer created some of the same values in the
+                # mean time.  Fall back to creating them one by one.
+                transaction.savepoint_rollback(sid)
+                log.debug('Concurrent insert of %s values; falling back to '
+                          'get_or_create' % (ValueModel.__name__,))
+                for value in missing:
+                    ValueModel.objects.get_or_create(**{value_attr: value})
+
+            # bulk_create doesn't give us primary keys back, so look the new
+            # values up again.
+            for chunk in chunked(missing, self.batch_size):
+                pks.update(ValueModel.objects.filter(**{lookup: chunk})
+                                             .values_list(value_attr, 'pk'))
+
+        return pks
+
+    def set_values(self, field_name, values_by_metadata):
+        """
+        Replace the values of the ``field_name`` many-to-many field on each
+        metadata record in ``values_by_metadata``, a map of
+        { metadata record : iterable of values }.
+        """
+        if not values_by_metadata:
+            return
+
+        field = self.MetaDataModel._meta.get_field(field_name)
+        values_by_metadata = dict((metadata, set(values))
+                                  for metadata, values in values_by_metadata.items())
+        pks = self.resolve_values(
+            field.rel.to, chain(*values_by_metadata.values()))
+
+        self.set_related(field_name, dict(
+            (metadata.pk, [pks[value] for value in values])
+            for metadata, values in values_by_metadata.items()))
+
+    def set_related(self, field_name, related_pks_by_metadata_pk):
+        """
+        Replace the related objects of the ``field_name`` many-to-many field,
+        given a map of { metadata primary key : iterable of related primary
+        keys }.  No model instances are needed, just keys.
+        """
+        if not related_pks_by_metadata_pk:
+            return
+
+        field = self.MetaDataModel._meta.get_field(field_name)
+        Through = field.rel.through
+        source_name = field.m2m_field_name()
+        source_attr = source_name + '_id'
+        target_attr = field.m2m_reverse_field_name() + '_id'
+
+        for chunk in chunked(related_pks_by_metadata_pk.keys(), self.batch_size):
+            Through.objects.filter(**{source_name + '__in': chunk}).delete()
+
+        Through.objects.bulk_create(
+            [Through(**{source_attr: metadata_pk, target_attr: related_pk})
+             for metadata_pk, related_pks in related_pks_by_metadata_pk.items()
+             for related_pk in set(related_pks)],
+            batch_size=self.batch_size)
+
+
+def rebuild_mentions(batch_size=500, progress=None):
+    """
+    Recalculate the ``mentioned_legfiles`` of every legislative file in one
+    pass over the corpus, reading only the keys, ids, and text of a batch of
+    files at a time.  ``progress``, if given, is called with the number of
+    files done so far after each batch.  Returns the number of mentions found.
+    """
+    writer = BulkMetaDataWriter(LegFileMetaData)
+
+    # Every bill id maps to a key; this is small enough to keep in memory
+    # and saves a lookup per batch.
+    keys_by_id = dict(LegFile.objects.exclude(id=None).values_list('id', 'key'))
+
+    legfiles = LegFile.objects.order_by('key').values_list('key', 'id', 'title')
+    done = mentions = 0
+    for batch in chunked(legfiles.iterator(), batch_size):
+        file_keys = [key for key, id, title in batch]
+        texts = dict((key, [title]) for key, id, title in batch)
+        for file_key, fulltext in LegFileAttachment.objects\
+                .filter(file__in=file_keys).values_list('file', 'fulltext'):
+            texts[file_key].append(fulltext)
+
+        metadata_pks = dict(LegFileMetaData.objects
+                            .filter(legfile__in=file_keys)
+                            .values_list('legfile', 'pk'))
+
+        mentioned = {}
+        for key, legfile_id, title in batch:
+            if key not in metadata_pks:
+                # The metadata will be created the next time the file is saved.
+                continue
+
+            ids = find_legfile_ids(' '.join(texts[key]))
+            ids.discard(legfile_id)
+            mentioned[metadata_pks[key]] = [keys_by_id[mentioned_id]
+                                            for mentioned_id in ids
+                                            if mentioned_id in keys_by_id]
+            mentions += len(mentioned[metadata_pks[key]])
+
+        with transaction.commit_on_success():
+            writer.set_related('mentioned_legfiles', mentioned)
+
+        done += len(batch)
+        if progress is not None:
+            progress(done)
+
+    return mentions
@@ -1,10 +1,13 @@
 import datetime
 import ebdata.nlp.addresses
 import re
+import time
 import utils
 import logging
+from collections import defaultdict
 from django.conf import settings
-from django.db import transaction
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
 from django.contrib.gis.db import models
 from django.contrib.gis import geos
 #from django.db import models
@@ -28,6 +31,14 @@ class LegKeys(models.Model):
 # Legislative File models
 #
 
+LEGFILE_ID_RE = re.compile(r'\s(\d{6}(?:-A+)?)')
+"""The characteristic form of a bill id, as mentioned in other files' text"""
+
+def find_legfile_ids(text):
+    """Return the set of bill ids mentioned in the given text."""
+    return set(LEGFILE_ID_RE.findall(text))
+
+
 class CouncilMemberAlias (models.Model):
     member = models.ForeignKey('CouncilMember', related_name='aliases')
     name = models.CharField(max_length=100, help_text=_('A name by which the council member is referred to in legislation'))
@@ -137,6 +148,10 @@ class LegFile(TimestampedModelMixin, models.Model):
     url = models.URLField()
     version = models.CharField(max_length=100)
     is_routine = models.BooleanField(default=True, blank=True)
+    last_activity = models.DateField(null=True, blank=True, db_index=True,
+        help_text=_('The latest of the intro, final, and action dates; kept up to date as the file and its actions are saved'))
+    content_hash = models.CharField(max_length=40, default='', blank=True,
+        help_text=_('A hash of the file, attachments, actions, and minutes as last scraped; the file is not saved again until they change'))
 
     class Meta:
         ordering = ['-key']
@@ -155,12 +170,31 @@ class LegFile(TimestampedModelMixin, models.Model):
         Gets the date of the latest action
 
         """
-        actions = self.actions.all()
+        return self.actions.aggregate(models.Max('date_taken'))['date_taken__max']
 
-        if len(actions) == 0:
-            return None
+    def calculate_last_activity(self):
+        """
+        Gets the latest of the file's intro date, final date, and action dates.
+
+        """
+        date_field = self._meta.get_field('intro_date')
+        dates = [date_field.to_python(self.intro_date),
+                 date_field.to_python(self.final_date)]
+        if self.pk is not None:
+            dates.append(self.last_action_date)
 
-        return max([action.date_taken for action in actions])
+        dates = [d.date() if isinstance(d, datetime.datetime) else d
+                 for d in dates if d is not None]
+        return max(dates) if dates else None
+
+    def update_last_activity(self):
+        """
+        Recalculate ``last_activity`` and store it, without re-saving the rest
+        of the file.
+
+        """
+        self.last_activity = self.calculate_last_activity()
+        LegFile.objects.filter(pk=self.pk).update(last_activity=self.last_activity)
 
     @property
     def timeline(self):
@@ -185,10 +219,12 @@ class LegFile(TimestampedModelMixin, models.Model):
         return timeline
 
     def all_text(self):
-        if not hasattr(self, '_all_text'):
-            att_text = [att.fulltext for att in self.attachments.all()]
-            self._all_text = ' '.join([self.title] + att_text)
-        return self._all_text
+        """
+        The title and the text of the attachments, read afresh each time (so
+        attachments saved after the file are included).
+        """
+        att_text = [att.fulltext for att in self.attachments.all()]
+        return ' '.join([self.title] + att_text)
 
     def unique_words(self):
         """
@@ -205,8 +241,10 @@ class LegFile(TimestampedModelMixin, models.Model):
         unique_words = set(word.lower() for word in only_words.split())
         return unique_words
 
-    def addresses(self):
-        addresses = ebdata.nlp.addresses.parse_addresses(self.all_text())
+    def addresses(self, text=None):
+        if text is None:
+            text = self.all_text()
+        addresses = ebdata.nlp.addresses.parse_addresses(text)
         return addresses
 
     def topics(self):
@@ -220,30 +258,26 @@ class LegFile(TimestampedModelMixin, models.Model):
         else :
            return 'label-inverse'
 
-    def mentioned_legfiles(self):
+    def mentioned_legfile_ids(self, text=None):
         """
-        Gets a generator for any files (specifically, bills) mentioned in the
-        file.
+        Gets the set of ids of files (specifically, bills) mentioned in the
+        title or attachments of the file (or in the given text, if it has
+        already been read with ``all_text``).
 
         """
-        # Find all the strings that match the characteristic regular expression
-        # for a bill id.
-        id_matches = re.findall(r'\s(\d{6}(-A+)?)', self.title)
+        if text is None:
+            text = self.all_text()
+        ids = find_legfile_ids(text)
+        ids.discard(self.id)
+        return ids
 
-        # The id matches may each have two groups (the second of which will
-        # contain only the A's).  We only care about the first.
-        mentioned_legfile_ids = set(groups[0] for groups in id_matches)
+    def mentioned_legfiles(self, text=None):
+        """
+        Gets a queryset of the files (specifically, bills) mentioned in the
+        file.  Ids that don't match any legfile in our database are ignored.
 
-        for mentioned_legfile_id in mentioned_legfile_ids:
-            # It's possible that no legfile in our database may match the id
-            # we've parsed out.  When this is the case, there's nothing we can
-            # do about it, so just fail "silently" (with a log message).
-            try:
-                mentioned_legfile = LegFile.objects.get(id=mentioned_legfile_id)
-                yield mentioned_legfile
-            except LegFile.DoesNotExist:
-                # TODO: Use a log message.
-                print 'LegFile %r, referenced from key %s, does not exist!!!' % (mentioned_legfile_id, self.pk)
+        """
+        return LegFile.objects.filter(id__in=self.mentioned_legfile_ids(text))
 
 
     def update(self, attribs, commit=True, **save_kwargs):
@@ -253,63 +287,79 @@ class LegFile(TimestampedModelMixin, models.Model):
         if commit:
             return self.save(**save_kwargs)
 
-    def save(self, update_words=True, update_mentions=True, update_locations=True, update_topics=True, *args, **kwargs):
+    def save(self, update_words=True, update_mentions=True, update_locations=True, update_topics=True, defer_metadata=False, *args, **kwargs):
         """
         Calls the default ``Models.save()`` method, and creates or updates
         metadata for the legislative file as well.
 
+        If ``defer_metadata`` is True, the metadata is not updated right away;
+        instead, a job to update it is put on the ``MetaDataJob`` queue (see
+        the ``processmetadata`` command).
+
         """
         try:
             # We don't want the legfile to be saved without its metadata, so
             # wrap this whole thing in a transaction.
             sid = transaction.savepoint()
 
+            self.last_activity = self.calculate_last_activity()
             super(LegFile, self).save(*args, **kwargs)
 
             metadata = LegFileMetaData.objects.get_or_create(legfile=self)[0]
 
-            if update_words:
-                # Add the unique words to the metadata
-                metadata.words.clear()
-                unique_words = self.unique_words()
-                for word in unique_words:
-                    md_word = MetaData_Word.objects.get_or_create(value=word)[0]
-                    metadata.words.add(md_word)
-
-            if update_locations:
-                # Add the unique locations to the metadata
-                metadata.locations.clear()
-                locations = self.addresses()
-                for location in locations:
-                    try:
-                        md_location = MetaData_Location.objects.get_or_create(
-                            matched_text=location[0]
-                        )[0]
-                    except MetaData_Location.CouldNotBeGeocoded:
-                        continue
-
-                    metadata.locations.add(md_location)
-
-            if update_mentions:
-                # Add the mentioned files to the metadata
-                metadata.mentioned_legfiles.clear()
-                for mentioned_legfile in self.mentioned_legfiles():
-                    metadata.mentioned_legfiles.add(mentioned_legfile)
-
-            if update_topics:
-                # Add topics to the metadata
-                metadata.topics.clear()
-                for topic in self.topics():
-                    t = MetaData_Topic.objects.get_or_create(topic=topic)[0]
-                    metadata.topics.add(t)
-
-            metadata.save()
+            if defer_metadata:
+                MetaDataJob.enqueue(self, update_words=update_words,
+                                    update_mentions=update_mentions,
+                                    update_locations=update_locations,
+                                    update_topics=update_topics)
+            else:
+                self.update_metadata(metadata, update_words=update_words,
+                                     update_mentions=update_mentions,
+                                     update_locations=update_locations,
+                                     update_topics=update_topics)
 
             transaction.savepoint_commit(sid)
         except:
             transaction.savepoint_rollback(sid)
             raise
 
+    def update_metadata(self, metadata=None, update_words=True, update_mentions=True, update_locations=True, update_topics=True):
+        """
+        Recalculate the words, locations, mentioned files, and topics in the
+        file's metadata.  The metadata is replaced each time, so it's safe to
+        run this any number of times.
+        """
+        if metadata is None:
+            metadata = LegFileMetaData.objects.get_or_create(legfile=self)[0]
+
+        from phillyleg.metadata import BulkMetaDataWriter
+        writer = BulkMetaDataWriter(LegFileMetaData)
+
+        # Read the attachments once for both the locations and the mentions.
+        if update_locations or update_mentions:
+            text = self.all_text()
+
+        if update_words:
+            # Add the unique words to the metadata
+            writer.set_values('words', {metadata: self.unique_words()})
+
+        if update_locations:
+            # Add the unique locations to the metadata
+            metadata.locations.clear()
+            metadata.locations.add(*MetaData_Location.get_or_create_many(
+                address for address, city in self.addresses(text)))
+
+        if update_mentions:
+            # Add the mentioned files to the metadata
+            writer.set_related('mentioned_legfiles', {
+                metadata.pk: self.mentioned_legfiles(text).values_list('pk', flat=True)})
+
+        if update_topics:
+            # Add topics to the metadata
+            writer.set_values('topics', {metadata: self.topics()})
+
+        metadata.save()
+
     def get_data_source(self):
         return PhillyLegistarSiteWrapper()
 
@@ -326,7 +376,7 @@ class LegFile(TimestampedModelMixin, models.Model):
 class LegFileAttachment(TimestampedModelMixin, models.Model):
     file = models.ForeignKey(LegFile, related_name='attachments')
     description = models.CharField(max_length=1000)
-    url = models.URLField()
+    url = models.URLField(db_index=True)
     fulltext = models.TextField()
 
     class Meta:
@@ -345,6 +395,24 @@ class LegAction(TimestampedModelMixin, models.Model):
     def __unicode__(self):
         return "%s - %s" % (self.date_taken, self.description)
 
+    def save(self, *args, **kwargs):
+        """
+        Saves the action, and moves the file's ``last_activity`` up to the
+        action's date if the action is the file's latest activity.
+
+        """
+        super(LegAction, self).save(*args, **kwargs)
+
+        date_taken = self._meta.get_field('date_taken').to_python(self.date_taken)
+        if isinstance(date_taken, datetime.datetime):
+            date_taken = date_taken.date()
+
+        LegFile.objects\
+            .filter(pk=self.file_id)\
+            .filter(models.Q(last_activity__lt=date_taken) |
+                    models.Q(last_activity__isnull=True))\
+            .update(last_activity=date_taken)
+
     class Meta:
         # TODO: Fix this; there's not actually uniqueness here.  See
         #       http://legislation.phila.gov/detailreport/?key=2915
@@ -415,21 +483,15 @@ class LegMinutes(TimestampedModelMixin, models.Model):
 
         if update_words:
             # Add the unique words to the metadata
-            metadata.words.clear()
-            unique_words = self.unique_words()
-            for word in unique_words:
-                md_word = MetaData_Word.objects.get_or_create(value=word)[0]
-                metadata.words.add(md_word)
+            from phillyleg.metadata import BulkMetaDataWriter
+            writer = BulkMetaDataWriter(LegMinutesMetaData)
+            writer.set_values('words', {metadata: self.unique_words()})
 
         if update_locations:
             # Add the unique locations to the metadata
             metadata.locations.clear()
-            locations = self.addresses()
-            for location in locations:
-                md_location = MetaData_Location.objects.get_or_create(
-                    matched_text=location['address']
-                )[0]
-                metadata.locations.add(md_location)
+            metadata.locations.add(*MetaData_Location.get_or_create_many(
+                address for address, city in self.addresses()))
 
         metadata.save()
 
@@ -453,6 +515,122 @@ class LegFileMetaData (TimestampedModelMixin, models.Model):
             (self.legfile.pk, len(self.mentioned_legfiles.all()), len(self.legfile.references_in_legislation.all())))
 
 
+class MetaDataJob (models.Model):
+    """
+    A request to update the metadata of a legislative file, waiting to be
+    picked up by a ``processmetadata`` worker.  There is at most one job per
+    file; enqueueing a file that already has a job just widens that job.
+    """
+    legfile = models.OneToOneField('LegFile', related_name='metadata_job')
+    update_words = models.BooleanField(default=False)
+    update_mentions = models.BooleanField(default=False)
+    update_locations = models.BooleanField(default=False)
+    update_topics = models.BooleanField(default=False)
+
+    enqueued_datetime = models.DateTimeField(db_index=True)
+    claimed_datetime = models.DateTimeField(null=True, blank=True)
+    claimed_by = models.CharField(max_length=128, blank=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    FLAGS = ('update_words', 'update_mentions', 'update_locations', 'update_topics')
+
+    def __unicode__(self):
+        return u'metadata job for %s' % self.legfile_id
+
+    @classmethod
+    def enqueue(cls, legfile, **flags):
+        """
+        Queue a metadata update for the legfile.  If the file is already
+        queued, the job is widened to cover the given flags and made available
+        again (so that a worker already processing the old job doesn't drop
+        the newer changes).
+        """
+        requested = dict((flag, True) for flag in cls.FLAGS if flags.get(flag))
+        if not requested:
+            return None
+
+        now = datetime.datetime.now()
+        try:
+            sid = transaction.savepoint()
+            job, created = cls.objects.get_or_create(
+                legfile=legfile, defaults=dict(enqueued_datetime=now, **requested))
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            job, created = cls.objects.get(legfile=legfile), False
+
+        if not created:
+            cls.objects.filter(pk=job.pk).update(
+                enqueued_datetime=now, claimed_datetime=None, claimed_by='',
+                attempts=0, **requested)
+        return job
+
+    @classmethod
+    def available(cls, max_attempts, claim_timeout):
+        """
+        The jobs that are waiting to be claimed: unclaimed (or claimed so long
+        ago that the worker has probably died), and not failed too often.
+        """
+        stale = datetime.datetime.now() - claim_timeout
+        return cls.objects\
+            .filter(attempts__lt=max_attempts)\
+            .filter(models.Q(claimed_datetime__isnull=True) |
+                    models.Q(claimed_datetime__lt=stale))\
+            .order_by('enqueued_datetime')
+
+    def claim(self, worker):
+        """
+        Try to take the job for the named worker.  Returns whether the job was
+        claimed; it may have been taken by another worker in the meantime.
+        """
+        now = datetime.datetime.now()
+        claimed = MetaDataJob.objects\
+            .filter(pk=self.pk, claimed_datetime=self.claimed_datetime,
+                    enqueued_datetime=self.enqueued_datetime)\
+            .update(claimed_datetime=now, claimed_by=worker)
+        if claimed:
+            self.claimed_datetime = now
+            self.claimed_by = worker
+        return bool(claimed)
+
+    def run(self):
+        """
+        Update the metadata.  The job is removed if it succeeds, unless the
+        file has been enqueued again since the job was claimed.  Failures are
+        recorded on the job, and it is released to be retried.
+        """
+        from councilmatic.subscriptions.models import ContentChange
+
+        flags = dict((flag, getattr(self, flag)) for flag in self.FLAGS)
+        try:
+            with transaction.commit_on_success():
+                self.legfile.update_metadata(**flags)
+                # Recount in the same transaction, so that if the recount
+                # fails the job is kept to be retried.
+                if self.update_topics:
+                    TopicTrend.recalculate([self.legfile.intro_date])
+                # The feeds that search the metadata may have new content.
+                ContentChange.record(self.legfile)
+                MetaDataJob.objects.filter(
+                    pk=self.pk, enqueued_datetime=self.enqueued_datetime).delete()
+        except utils.TooManyGeocodeRequests:
+            # Not the job's fault; put it back for when there's quota again.
+            MetaDataJob.objects\
+                .filter(pk=self.pk, enqueued_datetime=self.enqueued_datetime)\
+                .update(claimed_datetime=None, claimed_by='')
+            raise
+        except Exception as e:
+            log.exception('Could not update the metadata for %s' % self.legfile_id)
+            MetaDataJob.objects\
+                .filter(pk=self.pk, enqueued_datetime=self.enqueued_datetime)\
+                .update(claimed_datetime=None, claimed_by='',
+                        attempts=models.F('attempts') + 1,
+                        last_error='%s: %s' % (type(e).__name__, e))
+            return False
+        return True
+
+
 class LegMinutesMetaData (TimestampedModelMixin, models.Model):
     legminutes = models.OneToOneField('LegMinutes', related_name='metadata')
     words = models.ManyToManyField('MetaData_Word', related_name='references_in_minutes')
@@ -489,8 +667,13 @@ class MetaData_Location (TimestampedModelMixin, models.Model):
     class CouldNotBeGeocoded (Exception):
         pass
 
-    def geocode(self):
-        gc = utils.geocode(self.matched_text, settings.LEGISLATION['ADDRESS_BOUNDS'])
+    def geocode(self, gc=None):
+        """
+        Set the address and point from a geocoder response (looking the
+        response up if it isn't given).
+        """
+        if gc is None:
+            gc = utils.geocode(self.matched_text, settings.LEGISLATION['ADDRESS_BOUNDS'])
 
         if gc and gc['status'] == 'OK' and settings.LEGISLATION['ADDRESS_SUFFIX'] in gc['results'][0]['formatted_address']:
             self.address = gc['results'][0]['formatted_address']
@@ -501,6 +684,43 @@ class MetaData_Location (TimestampedModelMixin, models.Model):
             log.debug('Could not geocode the address "%s"' % self.matched_text)
             raise self.CouldNotBeGeocoded(self.matched_text)
 
+    @classmethod
+    def get_or_create_many(cls, matched_texts):
+        """
+        Return the locations for the given matched texts, geocoding all of
+        the new ones in one batch.  Texts that can't be geocoded are left out.
+        """
+        from utils.geocoding import get_geocoder
+
+        matched_texts = set(matched_texts)
+        locations = dict((location.matched_text, location) for location in
+                         cls.objects.filter(matched_text__in=matched_texts))
+
+        new_texts = [text for text in matched_texts if text not in locations]
+        if new_texts:
+            responses = get_geocoder().geocode_many(new_texts)
+            for text in new_texts:
+                if responses[text] is None:
+                    # The geocoder couldn't be reached; try again next time.
+                    continue
+
+                location = cls(matched_text=text)
+                try:
+                    location.geocode(responses[text])
+                except cls.CouldNotBeGeocoded:
+                    continue
+
+                try:
+                    sid = transaction.savepoint()
+                    location.save()
+                    transaction.savepoint_commit(sid)
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid)
+                    location = cls.objects.get(matched_text=text)
+                locations[text] = location
+
+        return locations.values()
+
 class MetaData_Topic (models.Model):
     topic = models.CharField(max_length=128, unique=True)
 
@@ -512,3 +732,197 @@ class MetaData_Topic (models.Model):
     
     def __unicode__(self):
         return self.topic
+
+
+class TopicTrend (models.Model):
+    """
+    The number of files on a topic that were introduced in a given week, by
+    all sponsors (``sponsor`` is None) or by a particular sponsor.  These are
+    kept up to date as files are scraped, so that the dashboards can show the
+    busiest topics without counting the files each time.
+    """
+    topic = models.ForeignKey('MetaData_Topic', related_name='trends')
+    sponsor = models.ForeignKey('CouncilMember', related_name='topic_trends', null=True)
+    week = models.DateField(db_index=True)
+    """The Monday of the week the files were introduced in"""
+
+    count = models.IntegerField(default=0)
+
+    VERSION_CACHE_KEY = 'topic_trends_version'
+    CACHE_TIMEOUT = 24 * 60 * 60
+    RECOUNT_TRIES = 3
+
+    class Meta:
+        unique_together = (('topic', 'sponsor', 'week'),)
+
+    def __unicode__(self):
+        return u'%s files on %s in the week of %s' % (self.count, self.topic_id, self.week)
+
+    @staticmethod
+    def week_of(date):
+        return date - datetime.timedelta(days=date.weekday())
+
+    @classmethod
+    def version(cls):
+        """
+        An identifier for the current state of the trends, which changes
+        whenever they're recalculated.  Use it in cache keys.
+        """
+        version = cache.get(cls.VERSION_CACHE_KEY)
+        if version is None:
+            version = cls.bump_version()
+        return version
+
+    @classmethod
+    def bump_version(cls):
+        version = str(time.time())
+        cache.set(cls.VERSION_CACHE_KEY, version, 30 * cls.CACHE_TIMEOUT)
+        return version
+
+    @classmethod
+    def recalculate(cls, dates=None):
+        """
+        Recount the trends for the weeks containing the given dates, or for
+        every week if no dates are given.  Returns the number of trend rows.
+        Run this in a transaction (managed by the caller); the recount is
+        retried within it if it collides with another recount.
+        """
+        TopicsThrough = LegFileMetaData.topics.through
+        SponsorsThrough = LegFile.sponsors.through
+
+        topic_rows = TopicsThrough.objects.filter(
+            legfilemetadata__legfile__intro_date__isnull=False)
+        sponsor_rows = SponsorsThrough.objects.all()
+        trends = cls.objects.all()
+
+        if dates is not None:
+            weeks = set(cls.week_of(date) for date in dates if date is not None)
+            if not weeks:
+                return 0
+
+            in_weeks = models.Q()
+            for week in weeks:
+                in_weeks |= models.Q(intro_date__gte=week,
+                                     intro_date__lt=week + datetime.timedelta(days=7))
+            legfiles = LegFile.objects.filter(in_weeks).values('key')
+            topic_rows = topic_rows.filter(legfilemetadata__legfile__in=legfiles)
+            sponsor_rows = sponsor_rows.filter(legfile__in=legfiles)
+            trends = trends.filter(week__in=weeks)
+
+        # Metadata workers may recount the same week at the same time.  The
+        # one whose new rows collide with the other's (which it couldn't see
+        # to delete) counts again once the other is done.
+        for attempt in range(cls.RECOUNT_TRIES):
+            counts = cls._count(topic_rows, sponsor_rows)
+            try:
+                sid = transaction.savepoint()
+                trends.delete()
+                cls.objects.bulk_create(
+                    [cls(topic_id=topic_id, sponsor_id=member_id, week=week, count=count)
+                     for (topic_id, member_id, week), count in counts.items()],
+                    batch_size=1000)
+                transaction.savepoint_commit(sid)
+                break
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                if attempt == cls.RECOUNT_TRIES - 1:
+                    raise
+
+        cls.bump_version()
+        return len(counts)
+
+    @classmethod
+    def _count(cls, topic_rows, sponsor_rows):
+        """
+        Count the given files' topics, as { (topic id, sponsor id or None,
+        week) : count }.
+        """
+        sponsors_by_file = defaultdict(list)
+        for legfile_key, member_id in sponsor_rows.values_list('legfile', 'councilmember'):
+            sponsors_by_file[legfile_key].append(member_id)
+
+        counts = defaultdict(int)
+        for legfile_key, intro_date, topic_id in topic_rows.values_list(
+                'legfilemetadata__legfile', 'legfilemetadata__legfile__intro_date',
+                'metadata_topic'):
+            week = cls.week_of(intro_date)
+            counts[topic_id, None, week] += 1
+            for member_id in sponsors_by_file[legfile_key]:
+                counts[topic_id, member_id, week] += 1
+        return counts
+
+    @classmethod
+    def top_topics(cls, since=None, sponsor=None, exclude=('Routine',)):
+        """
+        Return the topics with the most files introduced since the given date
+        (to the week), for all sponsors or the given one, busiest first, as a
+        list of { 'topic', 'leg_count' } dictionaries.  Results are cached
+        until the trends next change.
+        """
+        since_week = cls.week_of(since) if since else None
+        sponsor_id = sponsor.pk if sponsor is not None else None
+        cache_key = 'topic_trends:%s:%s:%s' % (cls.version(), sponsor_id, since_week)
+
+        topics = cache.get(cache_key)
+        if topics is None:
+            trends = cls.objects.filter(sponsor=sponsor_id) if sponsor_id \
+                     else cls.objects.filter(sponsor__isnull=True)
+            if since_week is not None:
+                trends = trends.filter(week__gte=since_week)
+
+            topics = list(trends.exclude(topic__topic__in=exclude)
+                                .values('topic__topic')
+                                .annotate(leg_count=models.Sum('count'))
+                                .order_by('-leg_count', 'topic__topic'))
+            topics = [{'topic': row['topic__topic'], 'leg_count': row['leg_count']}
+                      for row in topics]
+            cache.set(cache_key, topics, cls.CACHE_TIMEOUT)
+        return topics
+
+
+#
+# Search choices
+#
+
+SEARCH_CHOICES_CACHE_KEY = 'search_choices'
+SEARCH_CHOICES_TIMEOUT = 24 * 60 * 60
+
+def calculate_search_choices():
+    """
+    Find the values that the search form offers for each of the facets that
+    it filters on, in one query.  Returns a dictionary of { facet : [(value,
+    label)] }.
+    """
+    sources = [('statuses', LegFile, 'status'),
+               ('controlling_bodies', LegFile, 'controlling_body'),
+               ('file_types', LegFile, 'type'),
+               ('topics', MetaData_Topic, 'topic'),
+               ('sponsors', CouncilMember, 'real_name')]
+
+    qn = connection.ops.quote_name
+    query = ' UNION '.join(
+        'SELECT DISTINCT %%s, %s FROM %s' % (
+            qn(Model._meta.get_field(field).column), qn(Model._meta.db_table))
+        for facet, Model, field in sources)
+
+    cursor = connection.cursor()
+    cursor.execute(query, [facet for facet, Model, field in sources])
+
+    values = dict((facet, set()) for facet, Model, field in sources)
+    for facet, value in cursor.fetchall():
+        values[facet].add(value)
+
+    return dict((facet, [(value, value) for value in sorted(facet_values)])
+                for facet, facet_values in values.items())
+
+def get_search_choices():
+    """Return the search form's choices, from the cache if possible."""
+    choices = cache.get(SEARCH_CHOICES_CACHE_KEY)
+    if choices is None:
+        choices = calculate_search_choices()
+        cache.set(SEARCH_CHOICES_CACHE_KEY, choices, SEARCH_CHOICES_TIMEOUT)
+    return choices
+
+def invalidate_search_choices():
+    """Forget the search form's choices, so new values will be picked up."""
+    cache.delete(SEARCH_CHOICES_CACHE_KEY)
@@ -8,6 +8,7 @@ class LegislationIndex(indexes.SearchIndex, indexes.Indexable):
     text = indexes.CharField(document=True, use_template=True)
 
     file_id = indexes.CharField(model_attr='id')
+    title = indexes.CharField(model_attr='title', indexed=False)
     topics = indexes.MultiValueField()
     status = indexes.CharField(model_attr='status')
     controlling_body = indexes.CharField(model_attr='controlling_body')
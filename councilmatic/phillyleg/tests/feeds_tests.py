@@ -0,0 +1,148 @@
+from collections import defaultdict
+from datetime import date, datetime, time
+from django.test import TestCase
+
+from councilmatic.feeds import LegislationUpdatesFeed
+from councilmatic.feeds import NewLegislationFeed
+from councilmatic.feeds import SearchResultsFeed
+from phillyleg.models import CouncilMember, CouncilMemberAlias
+from phillyleg.models import LegAction, LegFile
+
+
+class ReferenceLegislationUpdatesFeed (LegislationUpdatesFeed):
+    """
+    The original, one-file-at-a-time implementation of the feed, to check the
+    set-based implementation against.  It's kept as it was; in particular, it
+    doesn't order a file's actions, so changes are compared without regard to
+    the order the actions are listed in.
+    """
+
+    def get_updates_since(self, datetime):
+        return [content_item for content_item in self.get_content()
+                if self.get_last_updated_time_for_file(content_item) > datetime.date()]
+
+    def get_changes_to(self, legfile, since_datetime):
+        changes = defaultdict(unicode)
+        dates = set()
+        for action in legfile.actions.all():
+            if action.date_taken > since_datetime.date():
+                if 'Actions' in changes:
+                    changes['Actions'] += u'\n'
+                changes['Actions'] += unicode(action)
+                dates.add(action.date_taken)
+
+        if changes:
+            return changes, datetime.combine(max(dates), time())
+        else:
+            return {}, datetime.min
+
+    def get_last_updated_time(self):
+        dates = set()
+        for legfile in self.get_content():
+            dates.add(self.get_last_updated_time_for_file(legfile))
+
+        return max(dates)
+
+    def get_last_updated_time_for_file(self, legfile):
+        legfile_date = max(legfile.intro_date,
+                           legfile.final_date or date(1970, 1, 1))
+        action_dates = [action.date_taken
+                        for action in legfile.actions.all()]
+
+        return max([legfile_date] + action_dates)
+
+
+class LegislationUpdatesFeedTests (TestCase):
+    def setUp(self):
+        def legfile(key, intro_date, action_dates, final_date=None):
+            legfile = LegFile.objects.create(key=key, id=str(key), title='File %s' % key,
+                                             intro_date=intro_date, final_date=final_date)
+            for i, action_date in enumerate(action_dates):
+                legfile.actions.add(LegAction(date_taken=action_date,
+                                              description='Action %s' % i))
+            return legfile
+
+        legfile(1, date(2011, 8, 1), [])
+        legfile(2, date(2011, 8, 1), [date(2011, 8, 5), date(2011, 8, 12)])
+        legfile(3, date(2011, 8, 1), [date(2011, 8, 12), date(2011, 8, 12), date(2011, 8, 20)])
+        legfile(4, date(2011, 8, 15), [])
+        legfile(5, date(2011, 8, 1), [date(2011, 8, 2)], final_date=date(2011, 8, 25))
+
+        self.since = datetime(2011, 8, 10, 12, 0)
+
+    def assertSameUpdates(self, feed, reference):
+        updates = feed.get_updates_since(self.since)
+        expected = reference.get_updates_since(self.since)
+        self.assertEqual(sorted(updates, key=lambda l: l.pk),
+                         sorted(expected, key=lambda l: l.pk))
+
+        def unordered(changes):
+            changes, changed_datetime = changes
+            return (dict((label, set(text.split(u'\n')))
+                         for label, text in changes.items()),
+                    changed_datetime)
+
+        for legfile in updates:
+            self.assertEqual(unordered(feed.get_changes_to(legfile, self.since)),
+                             unordered(reference.get_changes_to(legfile, self.since)))
+
+        self.assertEqual(feed.get_last_updated_time(),
+                         reference.get_last_updated_time())
+
+    def test_MatchesTheOriginalImplementation(self):
+        self.assertSameUpdates(LegislationUpdatesFeed(),
+                               ReferenceLegislationUpdatesFeed())
+
+    def test_MatchesTheOriginalImplementationWithSelectors(self):
+        self.assertSameUpdates(LegislationUpdatesFeed(pk=3),
+                               ReferenceLegislationUpdatesFeed(pk=3))
+
+    def test_ChangesAreFoundWithoutAQueryPerFile(self):
+        feed = LegislationUpdatesFeed()
+        with self.assertNumQueries(2):
+            for legfile in feed.get_updates_since(self.since):
+                feed.get_changes_to(legfile, self.since)
+
+
+class CouldMatchTests (TestCase):
+    def setUp(self):
+        self.legfile = LegFile.objects.create(
+            key=1, id='1', title='File 1', intro_date=date(2011, 8, 15),
+            status='Adopted', type='Resolution', controlling_body='CITY COUNCIL')
+        member = CouncilMember.objects.create(real_name='Jane Smith')
+        CouncilMemberAlias.objects.create(member=member, name='Councilmember Smith')
+        member.legislation.add(self.legfile)
+
+        self.before = datetime(2011, 8, 1)
+        self.after = datetime(2011, 9, 1)
+
+    def test_NewLegislationOnlyChangesForNewerFiles(self):
+        feed = NewLegislationFeed()
+        self.assertTrue(feed.could_match([self.legfile], self.before))
+        self.assertFalse(feed.could_match([self.legfile], self.after))
+
+    def test_LegislationUpdatesChecksTheFollowedFile(self):
+        self.assertTrue(LegislationUpdatesFeed(pk='1').could_match([self.legfile], self.after))
+        self.assertFalse(LegislationUpdatesFeed(pk='2').could_match([self.legfile], self.after))
+        self.assertFalse(LegislationUpdatesFeed().could_match([], self.after))
+
+    def test_SearchResultsChecksTheFacetsOfNewerFiles(self):
+        def could_match(search_filter, last_updated=None):
+            feed = SearchResultsFeed(search_filter)
+            return feed.could_match([self.legfile], last_updated or self.before)
+
+        self.assertTrue(could_match({'sponsors': ['Councilmember Smith']}))
+        self.assertTrue(could_match({'statuses': 'adopted', 'file_types': ['Resolution']}))
+        self.assertFalse(could_match({'sponsors': ['John Doe']}))
+        self.assertFalse(could_match({'topics': ['Zoning']}))
+        self.assertFalse(could_match({'statuses': 'Adopted'}, self.after))
+
+        # Keywords can't be checked without the search engine.
+        self.assertTrue(could_match({'q': ['budget']}, self.after))
+
+
+class SearchResultsFeedTests (TestCase):
+    def test_BuildsTheSearchOnce(self):
+        feed = SearchResultsFeed({'statuses': 'Adopted', 'sponsors': ['Jane Smith']})
+        self.assertIs(feed.get_search(), feed.get_search())
+        self.assertIsNot(feed.get_content(), feed.get_search())
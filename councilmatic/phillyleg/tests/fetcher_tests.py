@@ -0,0 +1,70 @@
+from unittest import TestCase
+import requests
+
+from phillyleg.management.scraper_wrappers.fetcher import HttpFetcher
+from phillyleg.tests.fixture_server import FixtureServer
+
+
+def etagged_page(handler):
+    if handler.headers.get('If-None-Match') == '"v1"':
+        handler.send_body(304)
+    else:
+        handler.send_body(200, '<html>Page</html>', {'ETag': '"v1"'})
+
+
+class HttpFetcherTests (TestCase):
+    def setUp(self):
+        self.server = FixtureServer({'/page': etagged_page}).start()
+        self.fetcher = HttpFetcher(tries=3, backoff=0)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_ReusesConnections(self):
+        for _ in range(3):
+            self.fetcher.fetch(self.server.url('/page'))
+
+        client_addresses = set(address for path, address, headers in self.server.requests)
+        self.assertEqual(len(client_addresses), 1)
+
+    def test_MakesConditionalRequestsWithRememberedValidators(self):
+        url = self.server.url('/page')
+
+        response = self.fetcher.fetch(url, conditional=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, '<html>Page</html>')
+
+        # Nothing has been remembered yet.
+        self.assertEqual(self.fetcher.fetch(url, conditional=True).status_code, 200)
+
+        self.fetcher.remember(url, response.headers)
+        self.assertEqual(self.fetcher.fetch(url, conditional=True).status_code, 304)
+        self.assertEqual(self.fetcher.fetch(url).status_code, 200)
+        self.assertEqual(self.fetcher.stats()['not_modified'], 1)
+
+        self.fetcher.forget(url)
+        self.assertEqual(self.fetcher.fetch(url, conditional=True).status_code, 200)
+
+    def test_RetriesServerErrors(self):
+        failures = [503, 500]
+        def flaky(handler):
+            if failures:
+                handler.send_body(failures.pop(0))
+            else:
+                handler.send_body(200, 'OK')
+        self.server.routes['/flaky'] = flaky
+
+        self.assertEqual(self.fetcher.fetch(self.server.url('/flaky')).content, 'OK')
+        self.assertEqual(self.fetcher.stats()['retried'], 2)
+
+    def test_GivesUpAfterTheLastTry(self):
+        self.server.routes['/broken'] = lambda handler: handler.hang_up()
+
+        self.assertRaises(requests.ConnectionError,
+                          self.fetcher.fetch, self.server.url('/broken'))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_DoesNotRetryClientErrors(self):
+        self.assertRaises(requests.HTTPError,
+                          self.fetcher.fetch, self.server.url('/missing'))
+        self.assertEqual(len(self.server.requests), 1)
@@ -0,0 +1,67 @@
+import BaseHTTPServer
+import SocketServer
+import threading
+
+
+class FixtureHandler (BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.client_address, dict(self.headers)))
+        respond = self.server.routes.get(self.path)
+        if respond is None:
+            self.send_body(404, 'Not found')
+        else:
+            respond(self)
+
+    def send_body(self, status, body='', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def hang_up(self):
+        """Close the connection without a response (an empty status line)."""
+        self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer (SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # Kept-alive connections hold on to their threads until the client
+    # closes them, so don't wait for them on shutdown.
+    daemon_threads = True
+
+
+class FixtureServer (object):
+    """
+    A local HTTP server for the scraper tests.  ``routes`` maps paths to
+    functions that take the request handler and respond with it (with
+    ``send_body`` or ``hang_up``); other paths are 404s.  Each request is
+    recorded in ``requests`` as a (path, client address, headers) tuple.
+    """
+
+    def __init__(self, routes=None):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+        self.httpd.routes = routes or {}
+        self.httpd.requests = self.requests = []
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def routes(self):
+        return self.httpd.routes
+
+    def url(self, path):
+        return 'http://127.0.0.1:%s%s' % (self.httpd.server_port, path)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -1,13 +1,15 @@
 from unittest import TestCase
+from django.test import TestCase as DjangoTestCase
 import os
 import bs4 as bs
 import datetime as dt
 import mock
-from StringIO import StringIO
+import requests
 
 from phillyleg.management.scraper_wrappers import PhillyLegistarSiteWrapper
 from phillyleg.management.scraper_wrappers import LegistarApiWrapper
 from phillyleg.management.scraper_wrappers import CouncilmaticDataStoreWrapper
+from phillyleg.management.scraper_wrappers.stores.councilmatic_orm import CouncilMemberIndex
 
 class LegistarTests (TestCase):
 
@@ -30,7 +32,7 @@ class LegistarTests (TestCase):
         html = self.open_legfile('73').read()
         soup = bs.BeautifulSoup(html)
 
-        wrapper = PhillyLegistarSiteWrapper(root_url='')
+        wrapper = PhillyLegistarSiteWrapper(root_url='', pdf_cache_path=':memory:')
         file_record, attachment_records, action_records, minutes_records = \
             wrapper.scrape_legis_file(73, soup)
 
@@ -39,7 +41,8 @@ class LegistarTests (TestCase):
                  if act_rec['notes']]), 2)
 
     def test_ResolutionPdfParsesCorrectly(self):
-        wrapper = PhillyLegistarSiteWrapper(root_url='')
+        wrapper = PhillyLegistarSiteWrapper(root_url='', pdf_cache_path=':memory:',
+                                            pdf_backend='pdftohtml')
         expected_text = """\n\n\n\n\n\n\n\n\nCity of Philadelphia \n \n \n \n \nCity of Philadelphia \n- 1 - \n \n \n \nCity Council \nChief Clerk's Office \n402 City Hall \nPhiladelphia, PA 19107 \nRESOLUTION NO. 110406 \n \n \nIntroduced May 12, 2011 \n \n \nCouncilmember DiCicco \n \n \nReferred to the \nCommittee of the Whole   \n \n \nRESOLUTION \n \nAppointing David Campoli to the Board of Directors of the Center City District. \n \n \n \nRESOLVED, BY THE COUNCIL OF THE CITY OF PHILADELPHIA, \nTHAT David Campoli is hereby appointed as a member of the Board of Directors of the \nCenter City District, to serve in a term ending December 31, 2012. \n \n \n\n\n\nCity of Philadelphia \n \nRESOLUTION NO. 110406 continued \n \n \n \n \n \nCity of Philadelphia \n- 2 - \n \n \n \n \n\n"""
 
         # Raw stream
@@ -60,7 +63,7 @@ class LegistarTests (TestCase):
     def test_DealsWith404PdfAddressesCorrectly(self):
         # I don't know why they'd be deleting these files, but when they do (and
         # they do) we have to handle it.
-        wrapper = PhillyLegistarSiteWrapper(root_url='')
+        wrapper = PhillyLegistarSiteWrapper(root_url='', pdf_cache_path=':memory:')
         expected_text = ''
 
         attachment_pdf = 'http://legislation.phila.gov/attachments/115954.pdf'
@@ -68,7 +71,7 @@ class LegistarTests (TestCase):
         self.assertEqual(attachment_text, expected_text)
 
     def test_MinutesDateParsedCorrectly(self):
-        wrapper = PhillyLegistarSiteWrapper(root_url='')
+        wrapper = PhillyLegistarSiteWrapper(root_url='', pdf_cache_path=':memory:')
 
         expected_date = dt.date(2083, 12, 6) # They learned nothing from Y2K
         taken_date = wrapper.get_minutes_date('http://www.bogus.com/path/mydoc_83-12-06_bill.pdf')
@@ -76,7 +79,7 @@ class LegistarTests (TestCase):
         self.assertEqual(taken_date, expected_date)
 
     def test_MinutesDocumentConstructedCorrectly(self):
-        wrapper = PhillyLegistarSiteWrapper(root_url='')
+        wrapper = PhillyLegistarSiteWrapper(root_url='', pdf_cache_path=':memory:')
         wrapper.get_minutes_date = mock.Mock(return_value=dt.date(2083, 12, 6))
         wrapper.extract_pdf_text = mock.Mock(return_value='This is the text')
 
@@ -88,8 +91,9 @@ class LegistarTests (TestCase):
         self.assertEqual(minutes_doc, expected_doc)
 
     def test_PdfDataIsCached(self):
-        wrapper = PhillyLegistarSiteWrapper(root_url='')
-        wrapper.urlopen = mock.Mock(return_value=StringIO('<doc><pdf2xml></pdf2xml></doc>'))
+        wrapper = PhillyLegistarSiteWrapper(root_url='', pdf_cache_path=':memory:')
+        wrapper.fetch = mock.Mock(return_value=mock.Mock(
+            status_code=200, content='<doc><pdf2xml></pdf2xml></doc>'))
         wrapper.extract_xml_text = mock.Mock()
 
         actions = [{'minutes_url': 'http://www.sample.com/file.pdf'},
@@ -97,15 +101,15 @@ class LegistarTests (TestCase):
                    {'minutes_url': 'http://www.sample.com/other/file.pdf'}]
         minutes = wrapper.collect_minutes(actions)
 
-        self.assertEqual(wrapper.urlopen.call_count, 2)
+        self.assertEqual(wrapper.fetch.call_count, 2)
 
     def test_ConvertDateIsEmptyWhenNoDateGiven(self):
-        wrapper = PhillyLegistarSiteWrapper(root_url='')
+        wrapper = PhillyLegistarSiteWrapper(root_url='', pdf_cache_path=':memory:')
 
         self.assertEqual(wrapper.convert_date(None), '')
 
     def test_detectsErrorsCorrectly(self):
-        wrapper = PhillyLegistarSiteWrapper(root_url='')
+        wrapper = PhillyLegistarSiteWrapper(root_url='', pdf_cache_path=':memory:')
 
         soup = bs.BeautifulSoup(self.open_legfile('12000').read())
         self.assertTrue(wrapper.is_error_page(soup))
@@ -114,24 +118,104 @@ class LegistarTests (TestCase):
         self.assertTrue(not wrapper.is_error_page(soup))
 
     def test_ExitsSilentlyOnNoNewContent(self):
-        wrapper = PhillyLegistarSiteWrapper(root_url='')
+        wrapper = PhillyLegistarSiteWrapper(root_url='', pdf_cache_path=':memory:')
         error_page = self.open_legfile('12000').read()
-        wrapper.urlopen = mock.Mock(
-            side_effect=lambda *a, **k: StringIO(error_page))
+        wrapper.fetch = mock.Mock(
+            return_value=mock.Mock(status_code=200, content=error_page))
 
         wrapper.check_for_new_content(73)
         # Check that we've tried 100 additional items
-        self.assertEqual(wrapper.urlopen.call_count, 100)
+        self.assertEqual(wrapper.fetch.call_count, 100)
+
+    def test_ProbesAWindowOfKeysInKeyOrder(self):
+        wrapper = PhillyLegistarSiteWrapper(root_url='', pdf_cache_path=':memory:', probe_window=10)
+        error_page = self.open_legfile('12000').read()
+        file_page = self.open_legfile('73').read()
+
+        fetched_keys = []
+        def fetch(url, conditional=False):
+            key = int(url.rsplit('=', 1)[1])
+            fetched_keys.append(key)
+            if key == 78:
+                raise requests.ConnectionError('Down')
+            content = file_page if key in (76, 80) else error_page
+            return mock.Mock(status_code=200, content=content, headers={})
+        wrapper.fetch = fetch
+
+        key, soup = wrapper.check_for_new_content(73)
+        self.assertEqual(key, 76)
+        self.assertEqual(sorted(fetched_keys), range(74, 84))
+
+        # A failure is raised when its key is reached.
+        self.assertRaises(requests.ConnectionError, wrapper.check_for_new_content, 76)
+
+        key, soup = wrapper.check_for_new_content(78)
+        self.assertEqual(key, 80)
+
+        # Pages fetched past the file that was found are kept, not fetched
+        # again.
+        self.assertEqual(sorted(fetched_keys), range(74, 89))
+
+    def test_OnlyParsesPagesThatMightBeErrors(self):
+        wrapper = PhillyLegistarSiteWrapper(root_url='', pdf_cache_path=':memory:')
+
+        self.assertTrue(wrapper.might_be_error_page(self.open_legfile('12000').read()))
+        self.assertFalse(wrapper.might_be_error_page(self.open_legfile('73').read()))
+
+    def test_RequiresAPlaceToCachePdfText(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from django.test.utils import override_settings
+
+        with override_settings(PDF_CACHE_PATH=None):
+            self.assertRaises(ImproperlyConfigured,
+                              PhillyLegistarSiteWrapper, root_url='')
 
     def test_RaisesErrorOnTooMany404(self):
-        from httplib import BadStatusLine
-        wrapper = PhillyLegistarSiteWrapper(root_url='')
-        wrapper.urlopen = mock.Mock(
-            side_effect=BadStatusLine(500))
+        from phillyleg.tests.fixture_server import FixtureServer
 
-        self.assertRaises(BadStatusLine, wrapper.check_for_new_content, 73)
-        # Check that we've retried the URL 10 items
-        self.assertEqual(wrapper.urlopen.call_count, 10)
+        # Respond to everything with an empty status line.
+        server = FixtureServer().start()
+        try:
+            wrapper = PhillyLegistarSiteWrapper(root_url=server.url('/'),
+                                                pdf_cache_path=':memory:',
+                                                http_backoff=0)
+            server.routes['/detailreport/?key=74'] = lambda handler: handler.hang_up()
+
+            self.assertRaises(requests.ConnectionError, wrapper.check_for_new_content, 73)
+            # Check that we've retried the URL 10 items
+            self.assertEqual(len(server.requests), 10)
+        finally:
+            server.stop()
+
+    def test_SkipsUnchangedDetailPagesOnceSaved(self):
+        from phillyleg.management.scraper_wrappers.fetcher import NOT_MODIFIED
+        from phillyleg.tests.fixture_server import FixtureServer
+
+        page = self.open_legfile('73').read()
+        def detail_page(handler):
+            if handler.headers.get('If-None-Match') == '"73"':
+                handler.send_body(304)
+            else:
+                handler.send_body(200, page, {'ETag': '"73"'})
+
+        server = FixtureServer({'/detailreport/?key=73': detail_page}).start()
+        try:
+            wrapper = PhillyLegistarSiteWrapper(root_url=server.url('/'),
+                                                pdf_cache_path=':memory:')
+
+            key, soup = wrapper.check_for_new_content(72)
+            self.assertEqual(key, 73)
+            self.assertTrue(soup is not NOT_MODIFIED)
+
+            # Until the file is saved, the page is fetched in full.
+            key, soup = wrapper.check_for_new_content(72)
+            self.assertTrue(soup is not NOT_MODIFIED)
+
+            wrapper.file_saved(73)
+            key, soup = wrapper.check_for_new_content(72)
+            self.assertEqual((key, soup), (73, NOT_MODIFIED))
+        finally:
+            server.stop()
 
 
 class OrmStoreTests (TestCase):
@@ -150,3 +234,316 @@ class OrmStoreTests (TestCase):
             self.fail('Shouldn\'t have raised a DatabaseError')
         else:
             pass
+
+    def test_LeavesOutPdfTextStoredAsNone (self):
+        from phillyleg.models import LegFile
+
+        LegFile.objects.all().delete()
+        legfile = LegFile.objects.create(title='testing', key=123)
+        legfile.attachments.create(url='http://www.example.com/a.pdf', fulltext='None')
+        legfile.attachments.create(url='http://www.example.com/b.pdf', fulltext='Text')
+
+        mapping = CouncilmaticDataStoreWrapper().pdf_mapping
+        self.assertIsNone(mapping.get('http://www.example.com/a.pdf'))
+        self.assertEqual(mapping.get('http://www.example.com/b.pdf'), 'Text')
+
+    def test_RecordsAChangeForEachSavedFile (self):
+        from phillyleg.models import LegFile
+        from councilmatic.subscriptions.models import ContentChange
+
+        LegFile.objects.all().delete()
+        ContentChange.objects.all().delete()
+
+        ds = CouncilmaticDataStoreWrapper()
+        ds.save_legis_file({'key': 123, 'id': '120123', 'title': 'testing',
+                            'intro_date': dt.date(2012, 1, 1), 'final_date': None,
+                            'sponsors': '', 'status': '', 'type': '',
+                            'controlling_body': '', 'url': '', 'version': '',
+                            'contact': ''}, [], [], [])
+
+        self.assertEqual(ContentChange.get_changed_content(ContentChange.objects.all()),
+                         [LegFile.objects.get(key=123)])
+
+
+class PipelinedImportTests (TestCase):
+    def test_SavesFilesAndContinuationKeysInKeyOrder(self):
+        import random
+        import time
+        from phillyleg.management.commands.updatelegfiles import import_leg_files
+
+        class FakeSource (object):
+            def check_for_new_content(self, last_key):
+                if last_key >= 20:
+                    return last_key, None
+                return last_key + 1, 'content for %s' % (last_key + 1)
+
+            def scrape_legis_file(self, key, source_obj):
+                # Finish scraping in a different order than we started.
+                time.sleep(random.random() / 100)
+                return {'key': key}, [], [], []
+
+        class FakeStore (object):
+            def __init__(self):
+                self.saved = []
+            def save_legis_file(self, record, attachments, actions, minutes):
+                self.saved.append(('file', record['key']))
+            def save_continuation_key(self, key):
+                self.saved.append(('key', key))
+
+        ds = FakeStore()
+        import_leg_files(0, FakeSource(), ds, save_key=True, workers=4)
+
+        expected = []
+        for key in range(1, 21):
+            expected += [('file', key), ('key', key)]
+        self.assertEqual(ds.saved, expected)
+
+
+class PdfTextCacheTests (TestCase):
+    def setUp(self):
+        from phillyleg.management.scraper_wrappers.pdf_cache import PdfTextCache
+        self.cache = PdfTextCache(':memory:')
+
+    def test_FindsTextByUrlAndByContent(self):
+        digest = self.cache.digest('pdf bytes')
+        self.cache.put(digest, u'some text', url='http://www.example.com/a.pdf')
+
+        self.assertEqual(self.cache.get_by_url('http://www.example.com/a.pdf'), u'some text')
+        self.assertEqual(self.cache.get_by_digest(digest), u'some text')
+        self.assertIsNone(self.cache.get_by_url('http://www.example.com/b.pdf'))
+
+    def test_CountsEachDocumentOnce(self):
+        wrapper = PhillyLegistarSiteWrapper(root_url='', pdf_cache_path=':memory:')
+        wrapper.pdf_cache = self.cache
+        wrapper.fetch = mock.Mock(return_value=mock.Mock(status_code=200, content='same bytes'))
+        wrapper.extract_pdf_data_text = mock.Mock(return_value=u'text')
+
+        wrapper.extract_pdf_text('http://www.example.com/a.pdf')  # miss
+        wrapper.extract_pdf_text('http://www.example.com/a.pdf')  # hit by URL
+        wrapper.extract_pdf_text('http://www.example.com/b.pdf')  # hit by content
+
+        self.assertEqual(self.cache.stats()['hits'], 2)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_FallsBackOnTheSeedMapping(self):
+        self.cache.seed = {'http://www.example.com/a.pdf': u'stored text'}
+
+        self.assertEqual(self.cache.get_by_url('http://www.example.com/a.pdf'), u'stored text')
+
+    def test_EvictsLeastRecentlyUsedTextWhenFull(self):
+        import os
+        first, second = os.urandom(1000), os.urandom(1000)
+        self.cache.max_size = 1500
+
+        self.cache.put('first', first.encode('hex'))
+        self.cache.put('second', second.encode('hex'))
+
+        self.assertIsNone(self.cache.get_by_digest('first'))
+        self.assertEqual(self.cache.get_by_digest('second'), second.encode('hex'))
+
+    def test_DoesNotReparseIdenticalPdfsAtNewUrls(self):
+        wrapper = PhillyLegistarSiteWrapper(root_url='', pdf_cache_path=':memory:')
+        wrapper.fetch = mock.Mock(return_value=mock.Mock(status_code=200, content='same bytes'))
+        wrapper.extract_pdf_data_text = mock.Mock(return_value=u'text')
+
+        wrapper.extract_pdf_text('http://www.example.com/a.pdf')
+        wrapper.extract_pdf_text('http://www.example.com/b.pdf')
+
+        self.assertEqual(wrapper.fetch.call_count, 2)
+        self.assertEqual(wrapper.extract_pdf_data_text.call_count, 1)
+
+    def test_CachesNoTextForPdfsThatTimeOut(self):
+        import utils
+        wrapper = PhillyLegistarSiteWrapper(root_url='', pdf_cache_path=':memory:')
+        wrapper.fetch = mock.Mock(return_value=mock.Mock(status_code=200, content='slow bytes'))
+        wrapper.extract_pdf_data_text = mock.Mock(
+            side_effect=utils.PdfConversionTimeout('pdftohtml took too long'))
+
+        self.assertEqual(wrapper.extract_pdf_text('http://www.example.com/a.pdf'), '')
+        self.assertEqual(wrapper.extract_pdf_text('http://www.example.com/b.pdf'), '')
+        self.assertEqual(wrapper.extract_pdf_data_text.call_count, 1)
+
+    def test_KeepsTextFromDifferentBackendsApart(self):
+        wrapper = PhillyLegistarSiteWrapper(root_url='', pdf_cache_path=':memory:', pdf_backend='pdftotext')
+        wrapper.pdf_cache = self.cache
+        wrapper.fetch = mock.Mock(return_value=mock.Mock(status_code=200, content='same bytes'))
+        self.cache.put(self.cache.digest('same bytes'), u'pdftohtml text')
+
+        with mock.patch('utils.pdftotxt', return_value=u'pdftotext text'):
+            text = wrapper.extract_pdf_text('http://www.example.com/a.pdf')
+
+        self.assertEqual(text, u'pdftotext text')
+
+    def test_RejectsUnknownPdfBackends(self):
+        self.assertRaises(ValueError, PhillyLegistarSiteWrapper,
+                          root_url='', pdf_backend='ocr')
+
+
+class CouncilMemberIndexTests (DjangoTestCase):
+    def setUp(self):
+        from phillyleg.models import CouncilMember, CouncilMemberAlias
+
+        self.member = CouncilMember.objects.create(real_name='Jane Smith')
+        CouncilMemberAlias.objects.create(member=self.member, name='Councilmember Smith')
+        CouncilMemberAlias.objects.create(member=self.member, name='SMITH')
+
+    def test_LooksUpEveryAliasWithOneQuery(self):
+        index = CouncilMemberIndex()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(index.get_or_create('Councilmember Smith'), self.member)
+            self.assertEqual(index.get_or_create('SMITH'), self.member)
+
+    def test_CreatesMembersForNewNamesOnce(self):
+        from phillyleg.models import CouncilMember
+
+        index = CouncilMemberIndex()
+        index.load()
+
+        member = index.get_or_create('Councilmember Jones')
+        self.assertEqual(member.real_name, 'Councilmember Jones')
+        self.assertEqual(list(member.aliases.values_list('name', flat=True)),
+                         ['Councilmember Jones'])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(index.get_or_create('Councilmember Jones'), member)
+
+    def test_SavesSponsorsAndVotersThroughTheIndex(self):
+        from phillyleg.models import LegFile, LegVote
+
+        ds = CouncilmaticDataStoreWrapper()
+        ds.defer_metadata = True
+        file_record = {'key': 1, 'id': '120001', 'title': 'A bill',
+                       'intro_date': dt.date(2012, 1, 5), 'final_date': None,
+                       'sponsors': 'Councilmember Smith, Councilmember Jones'}
+        action_records = [{'key': 1, 'date_taken': dt.date(2012, 1, 5),
+                           'description': 'ADOPTED', 'notes': '',
+                           'acting_body': 'CITY COUNCIL', 'motion': '',
+                           'votes': [{'voter': 'SMITH', 'value': 'Ayes'}]}]
+        ds.save_legis_file(file_record, [], action_records, [])
+
+        legfile = LegFile.objects.get(key=1)
+        self.assertEqual(set(legfile.sponsors.values_list('real_name', flat=True)),
+                         set(['Jane Smith', 'Councilmember Jones']))
+        self.assertEqual(LegVote.objects.get().voter, self.member)
+
+
+class ActionIngestionTests (DjangoTestCase):
+    def setUp(self):
+        from phillyleg.models import CouncilMember, CouncilMemberAlias, LegFile
+
+        self.legfile = LegFile.objects.create(key=1, id='120001', title='A bill')
+        for name in ('SMITH', 'JONES'):
+            member = CouncilMember.objects.create(real_name=name)
+            CouncilMemberAlias.objects.create(member=member, name=name)
+
+        self.ds = CouncilmaticDataStoreWrapper()
+        self.ds.members.load()
+
+    def action_records(self, count):
+        return [{'key': 1, 'date_taken': dt.date(2012, 1, 1) + dt.timedelta(days=day),
+                 'description': 'ADOPTED', 'notes': '', 'motion': '',
+                 'acting_body': 'CITY COUNCIL',
+                 'votes': [{'voter': 'SMITH', 'value': 'Ayes'},
+                           {'voter': 'JONES', 'value': 'Nays'}]}
+                for day in range(count)]
+
+    def count_queries(self, func, *args):
+        from django.db import connection
+
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            func(*args)
+            return len(connection.queries) - start
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+
+    def test_QueryCountDoesNotGrowWithTheNumberOfActions(self):
+        from phillyleg.models import LegAction, LegVote
+
+        short_history = self.count_queries(
+            self.ds._save_actions, self.legfile, self.action_records(1))
+        LegAction.objects.all().delete()
+        long_history = self.count_queries(
+            self.ds._save_actions, self.legfile, self.action_records(50))
+
+        self.assertEqual(short_history, long_history)
+        self.assertEqual(LegAction.objects.count(), 50)
+        self.assertEqual(LegVote.objects.count(), 100)
+
+    def test_SkipsActionsThatAreAlreadyStored(self):
+        from phillyleg.models import LegAction, LegFile, LegVote
+
+        self.ds._save_actions(self.legfile, self.action_records(3))
+        new_actions = self.ds._save_actions(self.legfile, self.action_records(5))
+
+        self.assertEqual([action.date_taken for action in new_actions],
+                         [dt.date(2012, 1, 4), dt.date(2012, 1, 5)])
+        self.assertEqual(LegAction.objects.count(), 5)
+        self.assertEqual(LegVote.objects.count(), 10)
+        self.assertEqual(LegFile.objects.get(key=1).last_activity, dt.date(2012, 1, 5))
+
+
+class ContentHashTests (DjangoTestCase):
+    def records(self, title='A bill'):
+        file_record = {'key': 1, 'id': '120001', 'title': title,
+                       'intro_date': dt.date(2012, 1, 5), 'final_date': None,
+                       'sponsors': []}
+        action_records = [{'key': 1, 'date_taken': dt.date(2012, 1, 5),
+                           'description': 'ADOPTED', 'notes': '',
+                           'acting_body': 'CITY COUNCIL', 'motion': '',
+                           'votes': []}]
+        return file_record, [], action_records, []
+
+    def test_SkipsFilesThatHaveNotChanged(self):
+        from phillyleg.models import LegFile
+
+        ds = CouncilmaticDataStoreWrapper()
+        ds.defer_metadata = True
+
+        self.assertTrue(ds.save_legis_file(*self.records()))
+        self.assertFalse(ds.save_legis_file(*self.records()))
+        self.assertTrue(ds.save_legis_file(*self.records(title='A new bill')))
+
+        self.assertEqual(LegFile.objects.get(key=1).title, 'A new bill')
+        self.assertEqual((ds.changed_count, ds.skipped_count), (2, 1))
+
+    def test_FindsFilesMentionedOnlyInAttachments(self):
+        from phillyleg.models import LegFile
+
+        LegFile.objects.create(key=2, id='120002', title='Another bill')
+
+        ds = CouncilmaticDataStoreWrapper()
+        ds.defer_metadata = False
+
+        file_record, _, action_records, minutes_records = self.records()
+        attachment_records = [{'key': 1, 'description': 'Report',
+                               'url': 'http://www.example.com/report.pdf',
+                               'fulltext': 'Amending Bill No. 120002 to...'}]
+        ds.save_legis_file(file_record, attachment_records, action_records, minutes_records)
+
+        legfile = LegFile.objects.get(key=1)
+        self.assertEqual([f.id for f in legfile.metadata.mentioned_legfiles.all()],
+                         ['120002'])
+
+    def test_RecountsTopicTrendsOnceAfterSavingFiles(self):
+        from phillyleg.models import TopicTrend
+
+        ds = CouncilmaticDataStoreWrapper()
+        with mock.patch.object(TopicTrend, 'recalculate', return_value=0) as recalculate:
+            ds.save_legis_file(*self.records())
+            ds.save_legis_file(*self.records(title='A new bill'))
+            self.assertFalse(recalculate.called)
+
+            ds.recount_topic_trends()
+        recalculate.assert_called_once_with(set([dt.date(2012, 1, 5)]))
+
+    def test_SavesUnchangedFilesWhenNotSkipping(self):
+        ds = CouncilmaticDataStoreWrapper()
+        ds.defer_metadata = True
+        ds.skip_unchanged = False
+
+        ds.save_legis_file(*self.records())
+        self.assertTrue(ds.save_legis_file(*self.records()))
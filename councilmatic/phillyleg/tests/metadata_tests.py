@@ -0,0 +1,77 @@
+from nose.tools import *
+
+from phillyleg.metadata import BulkMetaDataWriter, chunked, rebuild_mentions
+from phillyleg.models import *
+
+
+class Test__BulkMetaDataWriter_setValues:
+
+    def setup(self):
+        LegFile.objects.all().delete()
+        MetaData_Word.objects.all().delete()
+
+        self.writer = BulkMetaDataWriter(LegFileMetaData)
+        # Saving a legfile creates its metadata record.
+        self.metadata1 = LegFile.objects.create(key=1, title='a').metadata
+        self.metadata2 = LegFile.objects.create(key=2, title='b').metadata
+
+    @istest
+    def attaches_the_values_to_each_metadata_record(self):
+        self.writer.set_values('words', {self.metadata1: ['a', 'b'],
+                                         self.metadata2: ['b', 'c']})
+
+        assert_equal(set(self.metadata1.words.values_list('value', flat=True)),
+                     set(['a', 'b']))
+        assert_equal(set(self.metadata2.words.values_list('value', flat=True)),
+                     set(['b', 'c']))
+
+    @istest
+    def creates_each_new_value_once_and_reuses_existing_ones(self):
+        # 'a' and 'b' already exist, from the legfile titles.
+        self.writer.set_values('words', {self.metadata1: ['a', 'b'],
+                                         self.metadata2: ['b', 'c']})
+
+        assert_equal(MetaData_Word.objects.count(), 3)
+
+    @istest
+    def replaces_the_previous_values(self):
+        self.writer.set_values('words', {self.metadata1: ['a', 'b']})
+        self.writer.set_values('words', {self.metadata1: ['c']})
+
+        assert_equal(list(self.metadata1.words.values_list('value', flat=True)),
+                     ['c'])
+
+    @istest
+    def sets_topics_too(self):
+        self.writer.set_values('topics', {self.metadata1: ['Zoning']})
+
+        assert_equal(list(self.metadata1.topics.values_list('topic', flat=True)),
+                     ['Zoning'])
+
+
+@istest
+def chunked_splits_an_iterable_into_lists_of_the_given_size():
+    assert_equal(list(chunked(xrange(5), 2)), [[0, 1], [2, 3], [4]])
+
+
+class Test__rebuildMentions:
+
+    def setup(self):
+        LegFile.objects.all().delete()
+
+    @istest
+    def sets_the_mentioned_files_of_every_file(self):
+        bill = LegFile.objects.create(key=1, id='123456', title='A bill')
+        amendment = LegFile.objects.create(key=2, id='123457', title='Amends bill 123456')
+        resolution = LegFile.objects.create(key=3, id='123458', title='A resolution')
+        resolution.attachments.create(description='', url='http://www.example.com/a.pdf',
+                                      fulltext='Regarding 123456 and 123457 and 999999.')
+        LegFileMetaData.objects.get(legfile=amendment).mentioned_legfiles.clear()
+
+        mentions = rebuild_mentions(batch_size=2)
+
+        assert_equal(mentions, 3)
+        assert_equal(list(amendment.metadata.mentioned_legfiles.all()), [bill])
+        assert_equal(set(resolution.metadata.mentioned_legfiles.all()),
+                     set([bill, amendment]))
+        assert_equal(list(bill.metadata.mentioned_legfiles.all()), [])
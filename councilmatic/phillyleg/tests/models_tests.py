@@ -4,6 +4,7 @@ from nose.tools import *
 import os
 import datetime as dt
 import mock
+from django.db import transaction
 from StringIO import StringIO
 
 from phillyleg.management.scraper_wrappers import PhillyLegistarSiteWrapper
@@ -41,6 +42,19 @@ class Test__LegFile_mentionedLegfiles:
         files = set(legfile.mentioned_legfiles())
         assert_equal(files, set([l123456, l123456aa]))
 
+    @istest
+    def FindsLegfilesMentionedInAttachments(self):
+        l123456 = LegFile(id='123456', key=1)
+        l123456.save()
+
+        legfile = LegFile(id='654321', key=2, title='This legfile mentions nothing.')
+        legfile.save()
+        legfile.attachments.create(description='', url='http://www.example.com/a.pdf',
+                                   fulltext='Bill No. 654321 amends 123456.')
+
+        files = set(legfile.mentioned_legfiles())
+        assert_equal(files, set([l123456]))
+
 
 class Test__LegFile_lastActionDate:
 
@@ -64,6 +78,38 @@ class Test__LegFile_lastActionDate:
         assert_equal(legfile.last_action_date, dt.date(2011, 8, 19))
 
 
+class Test__LegFile_lastActivity:
+
+    def setup(self):
+        LegFile.objects.all().delete()
+
+    @istest
+    def is_the_intro_date_for_a_new_file (self):
+        legfile = LegFile(id='123456', key=1, intro_date=dt.date(2011, 8, 1))
+        legfile.save()
+
+        assert_equal(LegFile.objects.get(key=1).last_activity, dt.date(2011, 8, 1))
+
+    @istest
+    def moves_forward_as_actions_are_saved (self):
+        legfile = LegFile(id='123456', key=1, intro_date=dt.date(2011, 8, 1))
+        legfile.save()
+        legfile.actions.add(LegAction(date_taken=dt.date(2011, 8, 11), description='a'))
+        legfile.actions.add(LegAction(date_taken=dt.date(2011, 8, 5), description='b'))
+
+        assert_equal(LegFile.objects.get(key=1).last_activity, dt.date(2011, 8, 11))
+
+    @istest
+    def is_recalculated_when_the_file_is_saved (self):
+        legfile = LegFile(id='123456', key=1, intro_date=dt.date(2011, 8, 1))
+        legfile.save()
+        legfile.actions.add(LegAction(date_taken=dt.date(2011, 8, 11), description='a'))
+        legfile.final_date = dt.date(2011, 9, 1)
+        legfile.save()
+
+        assert_equal(LegFile.objects.get(key=1).last_activity, dt.date(2011, 9, 1))
+
+
 class Test__LegFile_timeline:
 
     def setup(self):
@@ -115,8 +161,8 @@ class Test__LegFile_refresh:
             os.path.dirname(os.path.abspath(__file__)),
             'testlegfiles')
         class PhillyLegistarFileWrapper (PhillyLegistarSiteWrapper):
-            def urlopen(wrapper, *args, **kwargs):
-                return self.open_legfile(73)
+            def fetch(wrapper, *args, **kwargs):
+                return mock.Mock(status_code=200, content=self.open_legfile(73).read())
         self.PhillyLegistarFileWrapper = PhillyLegistarFileWrapper
 
     def open_legfile(self, key):
@@ -141,3 +187,180 @@ class Test__LegFile_refresh:
 
         legfile.refresh()
         assert_equal(legfile.title, '''abcde''')
+
+
+class Test__LegFile_deferredMetadata:
+
+    def setup(self):
+        LegFile.objects.all().delete()
+        MetaDataJob.objects.all().delete()
+
+    @istest
+    def queues_a_job_instead_of_updating_metadata(self):
+        legfile = LegFile(id='123456', key=1, title='Some words')
+        legfile.save(defer_metadata=True)
+
+        job = MetaDataJob.objects.get(legfile=legfile)
+        assert_true(job.update_words)
+        assert_equal(legfile.metadata.words.count(), 0)
+
+    @istest
+    def running_the_job_updates_the_metadata_and_removes_the_job(self):
+        legfile = LegFile(id='123456', key=1, title='Some words')
+        legfile.save(defer_metadata=True, update_locations=False)
+
+        job = MetaDataJob.objects.get(legfile=legfile)
+        assert_true(job.claim('worker'))
+        assert_true(job.run())
+
+        assert_equal(set(legfile.metadata.words.values_list('value', flat=True)),
+                     set(['some', 'words']))
+        assert_equal(MetaDataJob.objects.count(), 0)
+
+    @istest
+    def running_the_job_records_a_content_change(self):
+        from councilmatic.subscriptions.models import ContentChange
+
+        legfile = LegFile(id='123456', key=1, title='Some words')
+        legfile.save(defer_metadata=True, update_locations=False)
+        ContentChange.objects.all().delete()
+
+        job = MetaDataJob.objects.get(legfile=legfile)
+        assert_true(job.claim('worker'))
+        assert_true(job.run())
+
+        assert_equal(ContentChange.get_changed_content(ContentChange.objects.all()),
+                     [legfile])
+
+    @istest
+    def jobs_can_only_be_claimed_once(self):
+        legfile = LegFile(id='123456', key=1, title='Some words')
+        legfile.save(defer_metadata=True)
+
+        job = MetaDataJob.objects.get(legfile=legfile)
+        other_job = MetaDataJob.objects.get(legfile=legfile)
+        assert_true(job.claim('worker1'))
+        assert_false(other_job.claim('worker2'))
+
+    @istest
+    def failed_jobs_are_kept_for_a_retry(self):
+        legfile = LegFile(id='123456', key=1, title='Some words')
+        legfile.save(defer_metadata=True)
+
+        job = MetaDataJob.objects.get(legfile=legfile)
+        job.claim('worker')
+        with mock.patch.object(LegFile, 'update_metadata', side_effect=ValueError('oops')):
+            assert_false(job.run())
+
+        job = MetaDataJob.objects.get(legfile=legfile)
+        assert_equal(job.attempts, 1)
+        assert_is_none(job.claimed_datetime)
+        assert_in('oops', job.last_error)
+
+
+class Test__searchChoices:
+
+    def setup(self):
+        LegFile.objects.all().delete()
+        CouncilMember.objects.all().delete()
+        MetaData_Topic.objects.all().delete()
+        invalidate_search_choices()
+
+        LegFile.objects.create(key=1, id='1', status='Adopted', type='Bill',
+                               controlling_body='CITY COUNCIL')
+        LegFile.objects.create(key=2, id='2', status='Introduced', type='Bill',
+                               controlling_body='CITY COUNCIL')
+        CouncilMember.objects.create(real_name='Jane Smith')
+        MetaData_Topic.objects.create(topic='Zoning')
+
+    @istest
+    def finds_the_distinct_values_of_each_facet(self):
+        choices = calculate_search_choices()
+
+        assert_equal(choices['statuses'], [('Adopted', 'Adopted'), ('Introduced', 'Introduced')])
+        assert_equal(choices['file_types'], [('Bill', 'Bill')])
+        assert_equal(choices['controlling_bodies'], [('CITY COUNCIL', 'CITY COUNCIL')])
+        assert_equal(choices['sponsors'], [('Jane Smith', 'Jane Smith')])
+        assert_equal(choices['topics'], [('Zoning', 'Zoning')])
+
+    @istest
+    def picks_up_new_values_once_invalidated(self):
+        get_search_choices()
+        LegFile.objects.create(key=3, id='3', status='Vetoed')
+        assert_not_in(('Vetoed', 'Vetoed'), get_search_choices()['statuses'])
+
+        invalidate_search_choices()
+        assert_in(('Vetoed', 'Vetoed'), get_search_choices()['statuses'])
+
+
+class Test__TopicTrend:
+
+    def setup(self):
+        LegFile.objects.all().delete()
+        CouncilMember.objects.all().delete()
+        MetaData_Topic.objects.all().delete()
+        TopicTrend.objects.all().delete()
+
+        self.member = CouncilMember.objects.create(real_name='Jane Smith')
+        zoning = MetaData_Topic.objects.create(topic='Zoning')
+        routine = MetaData_Topic.objects.create(topic='Routine')
+
+        # A Monday and the Wednesday after it, and a Monday a month earlier.
+        for key, intro_date, topics in [(1, dt.date(2012, 10, 1), [zoning]),
+                                        (2, dt.date(2012, 10, 3), [zoning, routine]),
+                                        (3, dt.date(2012, 9, 3), [zoning])]:
+            legfile = LegFile.objects.create(key=key, id=str(key), intro_date=intro_date)
+            metadata = LegFileMetaData.objects.create(legfile=legfile)
+            metadata.topics.add(*topics)
+            if key == 1:
+                legfile.sponsors.add(self.member)
+
+    @istest
+    def counts_files_by_topic_sponsor_and_week(self):
+        assert_equal(TopicTrend.recalculate(), 4)
+
+        counts = dict(((t.topic.topic, t.sponsor_id, t.week), t.count)
+                      for t in TopicTrend.objects.all())
+        assert_equal(counts, {('Zoning', None, dt.date(2012, 10, 1)): 2,
+                              ('Routine', None, dt.date(2012, 10, 1)): 1,
+                              ('Zoning', None, dt.date(2012, 9, 3)): 1,
+                              ('Zoning', self.member.pk, dt.date(2012, 10, 1)): 1})
+
+    @istest
+    def recounts_only_the_weeks_of_the_given_dates(self):
+        TopicTrend.recalculate()
+        TopicTrend.objects.filter(week=dt.date(2012, 9, 3)).update(count=10)
+        LegFile.objects.get(key=2).delete()
+
+        TopicTrend.recalculate([dt.date(2012, 10, 3)])
+
+        assert_equal(TopicTrend.objects.get(week=dt.date(2012, 10, 1), sponsor=None).count, 1)
+        assert_equal(TopicTrend.objects.get(week=dt.date(2012, 9, 3)).count, 10)
+
+    @istest
+    def top_topics_skips_routine_files_and_older_weeks(self):
+        TopicTrend.recalculate()
+
+        assert_equal(TopicTrend.top_topics(since=dt.date(2012, 10, 2)),
+                     [{'topic': 'Zoning', 'leg_count': 2}])
+        assert_equal(TopicTrend.top_topics(),
+                     [{'topic': 'Zoning', 'leg_count': 3}])
+        assert_equal(TopicTrend.top_topics(sponsor=self.member),
+                     [{'topic': 'Zoning', 'leg_count': 1}])
+
+    @istest
+    def counts_again_when_another_worker_recounted_the_week_first(self):
+        original_bulk_create = TopicTrend.objects.bulk_create
+        tries = []
+        def bulk_create(objs, **kwargs):
+            tries.append(objs)
+            if len(tries) == 1:
+                raise IntegrityError('duplicate key value violates unique constraint')
+            return original_bulk_create(objs, **kwargs)
+
+        with mock.patch.object(TopicTrend.objects, 'bulk_create', side_effect=bulk_create):
+            with transaction.commit_on_success():
+                assert_equal(TopicTrend.recalculate(), 4)
+
+        assert_equal(len(tries), 2)
+        assert_equal(TopicTrend.objects.count(), 4)
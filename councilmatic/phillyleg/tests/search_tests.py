@@ -0,0 +1,54 @@
+from django.test import TestCase
+
+from councilmatic.views import SQSProxy
+from phillyleg.models import LegFile, LegMinutes
+
+
+class FakeResult (object):
+    def __init__(self, obj):
+        self.model = obj.__class__
+        self.pk = unicode(obj.pk)
+
+
+class FakeSearchQuerySet (object):
+    def __init__(self, results):
+        self.results = results
+        self.counted = 0
+
+    def count(self):
+        self.counted += 1
+        return len(self.results)
+
+    def __getitem__(self, key):
+        return self.results[key]
+
+
+class SQSProxyTests (TestCase):
+    def setUp(self):
+        legfiles = [LegFile.objects.create(key=key, id=str(key), title='File %s' % key)
+                    for key in (3, 1, 2)]
+        minutes = LegMinutes.objects.create(url='http://example.com/minutes.pdf',
+                                            fulltext='Minutes')
+        self.objs = legfiles[:2] + [minutes] + legfiles[2:]
+        self.sqs = FakeSearchQuerySet([FakeResult(obj) for obj in self.objs])
+
+    def test_HydratesResultsInSearchOrderWithAQueryPerModel(self):
+        proxy = SQSProxy(self.sqs)
+
+        # One query for the minutes, and one for the files plus two for their
+        # prefetched metadata.
+        with self.assertNumQueries(4):
+            self.assertEqual(proxy[0:4], self.objs)
+
+    def test_CountsOnce(self):
+        proxy = SQSProxy(self.sqs)
+
+        self.assertEqual(len(proxy), 4)
+        self.assertEqual(proxy.count(), 4)
+        self.assertEqual(self.sqs.counted, 1)
+
+    def test_GivesStoredResultsWithoutQueries(self):
+        proxy = SQSProxy(self.sqs)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(proxy.stored(slice(0, 2)), self.sqs.results[:2])
@@ -29,6 +29,8 @@ class ContentFeedRecordAdmin(admin.ModelAdmin):
 class SubscriptionDispatchRecordInline(admin.TabularInline):
     model = models.SubscriptionDispatchRecord
     extra = 0
+    fields = ['when', 'dispatcher', 'get_content']
+    readonly_fields = ['get_content']
 
 class SubscriptionAdmin(admin.ModelAdmin):
     list_display = ['__unicode__', 'last_sent']
@@ -1,5 +1,6 @@
 import json
 import smtplib
+import time
 
 from collections import defaultdict
 from datetime import date, datetime
@@ -7,16 +8,21 @@ from email.mime.text import MIMEText
 from logging import getLogger
 
 from django.contrib.sites.models import Site
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
 from django.db.models.manager import Manager
+from django.db.models.query import QuerySet
 from django.template import Context, TemplateDoesNotExist
 from django.template.loader import get_template
 from django.utils.encoding import smart_str, smart_unicode
+from django.utils.safestring import mark_safe
 
+from cache import LRUCache
 from models import ContentFeedRecord
 from models import ContentFeedParameter
 from models import Subscription
+from models import DeliveryBody
 from models import SubscriptionDispatchRecord
 
 log = getLogger(__name__)
@@ -82,6 +88,25 @@ class ContentFeed (object):
         """
         raise NotImplementedError()
 
+    def has_content(self):
+        """
+        Return whether there is any content in the feed (if not, it has no
+        last updated time).
+        """
+        content = self.get_content()
+        if isinstance(content, QuerySet):
+            return content.exists()
+        return bool(content)
+
+    def could_match(self, changed_content, last_updated):
+        """
+        Return whether any of the changed content could change the last
+        updated time of the feed, given what it was.  This should be cheap,
+        and only needs to rule out feeds that certainly aren't affected; when
+        in doubt, return True.
+        """
+        return True
+
     class NotFound (Exception):
         pass
 
@@ -94,15 +119,21 @@ class ContentFeedLibrary (object):
     _reverse = {}
     """Map of { ContentFeedClass : feed_name }. For reverse-lookup"""
 
-    _feed_cache = {}
-    _record_cache = {}
+    cache_size = 1000
+    """The most feeds (and records) to keep around in each cache"""
+
+    _feed_cache = LRUCache(cache_size)
+    """Map of { record id : feed }"""
+
+    _record_cache = LRUCache(cache_size)
+    """Map of { feed fingerprint : record }"""
 
     def __init__(self, shared=True):
         if not shared:
             self.feeds = {}
             self._reverse = {}
-            self._feed_cache = {}
-            self._record_cache = {}
+            self._feed_cache = LRUCache(self.cache_size)
+            self._record_cache = LRUCache(self.cache_size)
 
     def register(self, ContentFeedClass, name):
         """Add the given manager class to the registry by the given name."""
@@ -117,14 +148,28 @@ class ContentFeedLibrary (object):
         self._record_cache.clear()
 
     def _cache(self, feed, record):
-        self._feed_cache[record] = feed
-        self._record_cache[feed] = record
+        self._feed_cache.set(record.pk, feed)
+        self._record_cache.set(record.fingerprint, record)
+
+    def invalidate(self, record_ids):
+        """Forget the feeds and records for the given (deleted) records."""
+        record_ids = set(record_ids)
+        for record_id in record_ids:
+            self._feed_cache.discard(record_id)
+        self._record_cache.discard_where(
+            lambda fingerprint, record: record.pk in record_ids)
+
+    def cache_stats(self):
+        """Return the size and hit-rate statistics of the caches."""
+        return {'feeds': self._feed_cache.stats(),
+                'records': self._record_cache.stats()}
 
     def get_feed(self, record):
         """Retrieve a feed based on the given record."""
 
-        if record in self._feed_cache:
-            return self._feed_cache[record]
+        feed = self._feed_cache.get(record.pk)
+        if feed is not None:
+            return feed
 
         ContentFeedClass = self.feeds[record.feed_name]
         kwargs = dict([(param.name, param.value)
@@ -133,6 +178,7 @@ class ContentFeedLibrary (object):
         try:
             feed = ContentFeedClass(**kwargs)
         except ContentFeedClass.IsObsolete:
+            self.invalidate([record.pk])
             record.delete()
             log.debug('The record %r is obsolete and has been deleted' % (record))
             return
@@ -143,15 +189,11 @@ class ContentFeedLibrary (object):
 
         return feed
 
-    def get_record(self, feed):
-        """Retrieve a record describing the given feed."""
-
-        if feed in self._record_cache:
-            return self._record_cache[feed]
-
+    def get_feed_name(self, feed):
+        """Return the name that the given feed's class is registered with."""
         ContentFeedClass = feed.__class__
         try:
-            name = self._reverse[ContentFeedClass]
+            return self._reverse[ContentFeedClass]
         except KeyError:
             log.debug('%s is not registered in the library: %s' %
                 (feed.__class__.__name__, self.feeds))
@@ -159,16 +201,62 @@ class ContentFeedLibrary (object):
                 '%s is not registered in the library' %
                 (feed.__class__.__name__,))
 
-        record = ContentFeedRecord()
-        record.feed_name = name
-        record.save()
+    def get_fingerprint(self, feed):
+        """Identify the given feed by its name and parameters."""
+        return ContentFeedRecord.make_fingerprint(
+            self.get_feed_name(feed), feed.get_params())
+
+    def find_record(self, feed):
+        """
+        Retrieve the record describing the given feed, or None if there isn't
+        one yet.  Never creates a record.  Records are cached per process, so
+        a cached record is checked (and its last updated time refreshed) in
+        case another process has since changed or deleted it (e.g.,
+        ``updatefeeds`` or ``cleanfeeds``).
+        """
+        fingerprint = self.get_fingerprint(feed)
+        record = self._record_cache.get(fingerprint)
+        if record is not None:
+            last_updated = ContentFeedRecord.objects.filter(pk=record.pk)\
+                .values_list('last_updated', flat=True)[:1]
+            if last_updated:
+                record.last_updated = last_updated[0]
+                return record
+
+            self.invalidate([record.pk])
+
+        try:
+            record = ContentFeedRecord.objects.get(fingerprint=fingerprint)
+        except ContentFeedRecord.DoesNotExist:
+            return None
+
+        self._cache(feed, record)
+        return record
+
+    def get_record(self, feed):
+        """Retrieve a record describing the given feed, creating it if needed."""
 
-        for param_name, param_value in feed.get_params().items():
-            param = ContentFeedParameter()
-            param.name = param_name
-            param.value = param_value
-            record.feed_params.add(param)
-            param.save()
+        record = self.find_record(feed)
+        if record is not None:
+            return record
+
+        name = self._reverse[feed.__class__]
+        params = feed.get_params()
+        fingerprint = ContentFeedRecord.make_fingerprint(name, params)
+
+        try:
+            sid = transaction.savepoint()
+            record = ContentFeedRecord.objects.create(
+                feed_name=name, fingerprint=fingerprint)
+            ContentFeedParameter.objects.bulk_create([
+                ContentFeedParameter(feed_record=record, name=param_name,
+                                     value=param_value)
+                for param_name, param_value in params.items()])
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Another process created the record first.
+            transaction.savepoint_rollback(sid)
+            record = ContentFeedRecord.objects.get(fingerprint=fingerprint)
 
         self._cache(feed, record)
 
@@ -193,9 +281,8 @@ class ContentFeedRecordUpdater (object):
         if feed is None:
             return
 
-        all_content = feed.get_content()
         latest = None
-        if all_content:
+        if feed.has_content():
             latest = feed.get_last_updated_time()
 
         if latest is None:
@@ -209,6 +296,29 @@ class ContentFeedRecordUpdater (object):
         for record in records:
             self.update(record, library)
 
+    def update_changed(self, records, changed_content, library=None):
+        """
+        Update only the feeds in the collection that the changed content could
+        affect.  Returns the number of records that were updated.
+        """
+        if library is None:
+            library = ContentFeedLibrary()
+
+        if not changed_content:
+            return 0
+
+        updated = 0
+        for record in records:
+            feed = library.get_feed(record)
+            if feed is None:
+                continue
+
+            if feed.could_match(changed_content, record.last_updated):
+                self.update(record, library)
+                updated += 1
+
+        return updated
+
 
 class ContentFeedRecordCleaner (object):
     """Responsible for identifying and removing all unused feeds"""
@@ -219,8 +329,14 @@ class ContentFeedRecordCleaner (object):
         subscription.
 
         """
+        if library is None:
+            library = ContentFeedLibrary()
+
         used_record_ids = Subscription.objects.values('feed_record__id').distinct()
-        ContentFeedRecord.objects.exclude(id__in=used_record_ids).delete()
+        unused = ContentFeedRecord.objects.exclude(id__in=used_record_ids)
+
+        library.invalidate(unused.values_list('id', flat=True))
+        unused.delete()
 
 
 class SubscriptionDispatcher (object):
@@ -244,6 +360,48 @@ class SubscriptionDispatcher (object):
     """A variable (essentialy global) mapping feeds to the last time that they
        were updated. Used as a cache."""
 
+    batch_size = None
+    """The number of deliveries to hold before sending them together; by
+       default each delivery is sent as soon as it is rendered"""
+
+    def __init__(self, batch_size=None):
+        self.feed_updates = {}
+        self.pending = []
+        self.delivered = 0
+        self.site = None
+        self.templates = {}
+        self.render_times = []
+        self.records = []
+        self.bodies = {}
+        if batch_size is not None:
+            self.batch_size = batch_size
+
+    feed_updates = None
+    """Map of { (feed record id, last sent time) : [(item, changes, change
+       time), ...] }.  Many subscribers follow the same feeds, and were last
+       sent them at the same time, so each distinct feed's updates are only
+       looked up once for the lifetime of the dispatcher (i.e., one run)."""
+
+    def get_feed_updates(self, subscription, library):
+        """
+        Return a list of (item, changes, change time) for each piece of content
+        in the subscription's feed that has changed since the subscription was
+        last sent.
+        """
+        key = (subscription.feed_record_id, subscription.last_sent)
+        if self.feed_updates is not None and key in self.feed_updates:
+            return self.feed_updates[key]
+
+        feed = library.get_feed(subscription.feed_record)
+        updates = []
+        for item in feed.get_updates_since(subscription.last_sent):
+            changes, change_time = feed.get_changes_to(item, subscription.last_sent)
+            updates.append((item, changes, change_time))
+
+        if self.feed_updates is not None:
+            self.feed_updates[key] = updates
+        return updates
+
     def get_content_updates_for(self, subscriptions, library):
         """
         Check the library for the manager of each subscription feed. Check the
@@ -257,16 +415,11 @@ class SubscriptionDispatcher (object):
         content_changes = defaultdict(lambda: [dict(), datetime.min])
 
         for subscription in subscriptions:
-            feed = library.get_feed(subscription.feed_record)
-
             # Check whether the feed has been updated since the subscription
             # was last sent (this assumes that the feed_record has been
             # updated to accurately represent the feed).
             if subscription.last_sent < subscription.feed_record.last_updated:
-                new_contents = feed.get_updates_since(subscription.last_sent)
-
-                for item in new_contents:
-                    changes, change_time = feed.get_changes_to(item, subscription.last_sent)
+                for item, changes, change_time in self.get_feed_updates(subscription, library):
                     content_changes[item][0].update(changes)
                     content_changes[item][1] = max(content_changes[item][1], change_time)
 
@@ -285,17 +438,46 @@ class SubscriptionDispatcher (object):
                            'subscriber':subscriber,
                            'subscriptions': subscriptions,
                            'content_updates':content_updates,
-                           'SITE': Site.objects.get_current()})
+                           'SITE': self.get_site()})
         return context
 
+    def get_site(self):
+        """The current site, looked up once per dispatcher."""
+        if self.site is None:
+            self.site = Site.objects.get_current()
+        return self.site
+
+    def get_cached_template(self, template_name):
+        """
+        Load the named template once per dispatcher.  Returns None if there is
+        no such template.
+        """
+        if template_name not in self.templates:
+            try:
+                self.templates[template_name] = get_template(template_name)
+            except TemplateDoesNotExist:
+                self.templates[template_name] = None
+        return self.templates[template_name]
+
     def render(self, subscriber, subscriptions, content_updates, library=None):
         """
         Render the given content updates to a template for the subscriber.
         """
-        template = get_template(self.template_name)
+        template = self.get_cached_template(self.template_name)
         context = self.get_context_data(subscriber, subscriptions, content_updates, library)
         return template.render(context)
 
+    def render_summary(self):
+        """Describe how long rendering the deliveries has taken."""
+        if not self.render_times:
+            return 'Rendered no digests'
+
+        total = sum(self.render_times)
+        return ('Rendered %s digests in %.2fs (mean %.1fms, max %.1fms)' %
+                (len(self.render_times), total,
+                 1000 * total / len(self.render_times),
+                 1000 * max(self.render_times)))
+
     def deliver_to(self, subscriber, delivery_text):
         """
         Send the delivery_text to the subscriber by whatever method is
@@ -316,21 +498,89 @@ class SubscriptionDispatcher (object):
                 subscription.last_sent = subscription.feed_record.last_updated
                 subscription.save()
 
-    def dispatch_subscriptions_for(self, subscriber, library=None):
+    def dispatch_all(self, subscribers, library=None, checkpoint=None):
+        """
+        Dispatch the subscriptions for each of the subscribers.  All of the
+        subscriptions (and their feed records) are loaded up front, and each
+        distinct feed's updates are only looked up once.
+
+        If a ``checkpoint`` is given, it is advanced past each batch of
+        subscribers once their deliveries have been sent, so subscribers
+        should be given in order of primary key.
+        """
+        if library is None:
+            library = ContentFeedLibrary()
+
+        subscribers = list(subscribers)
+        subscriptions_by_subscriber = defaultdict(list)
+        for subscription in Subscription.objects\
+                .filter(subscriber__in=[subscriber.pk for subscriber in subscribers])\
+                .select_related('feed_record'):
+            subscriptions_by_subscriber[subscription.subscriber_id].append(subscription)
+
+        for subscriber in subscribers:
+            self.dispatch_subscriptions_for(
+                subscriber, library,
+                subscriptions=subscriptions_by_subscriber[subscriber.pk])
+
+            # When nothing is pending, everyone up to here has been delivered
+            # to; save that whenever a batch has gone out.
+            if checkpoint is not None and not self.pending \
+                    and self.delivered != checkpoint.delivered:
+                checkpoint.advance(subscriber.pk, self.delivered)
+
+        self.flush()
+        if checkpoint is not None and subscribers:
+            checkpoint.advance(subscribers[-1].pk, self.delivered)
+
+        log.debug('Looked up %s distinct feed updates for %s subscribers' %
+                  (len(self.feed_updates or {}), len(subscribers)))
+
+    def dispatch_subscriptions_for(self, subscriber, library=None, subscriptions=None):
         log.debug('Dispatching subscriptions for %s' % (subscriber))
 
         if library is None:
             library = ContentFeedLibrary()
 
-        subscriptions = subscriber.subscriptions.all()
+        if subscriptions is None:
+            subscriptions = subscriber.subscriptions.all()
 
         content_updates = self.get_content_updates_for(subscriptions, library)
         if content_updates:
+            start = time.time()
             delivery = self.render(subscriber, subscriptions, content_updates, library)
-            self.deliver_to(subscriber, delivery)
+            self.render_times.append(time.time() - start)
+            self.pending.append((subscriber, subscriptions, content_updates, delivery))
+            if len(self.pending) >= (self.batch_size or 1):
+                self.flush()
+
+    def flush(self):
+        """
+        Deliver the pending deliveries, and then record them and bring their
+        subscriptions' last_sent up to date.  Returns the number delivered.
+        """
+        pending, self.pending = self.pending, []
+        if not pending:
+            return 0
+        self.delivered += len(pending)
+
+        self.deliver_batch([(subscriber, delivery)
+                            for subscriber, _, _, delivery in pending])
+        for subscriber, subscriptions, content_updates, delivery in pending:
             self.record_delivery(subscriber, subscriptions,
                                  content_updates, delivery)
             self.update_subscriptions(subscriptions)
+        self.save_records()
+
+        return len(pending)
+
+    def deliver_batch(self, deliveries):
+        """
+        Deliver each (subscriber, delivery) pair.  Dispatchers that can send
+        many deliveries at once more cheaply should override this.
+        """
+        for subscriber, delivery in deliveries:
+            self.deliver_to(subscriber, delivery)
 
     def record_delivery(self, subscriber, subscriptions, content_updates, delivery):
         """
@@ -338,14 +588,29 @@ class SubscriptionDispatcher (object):
         as having been sent.
         """
         content_updates = dict([(unicode(key), value) for key, value in content_updates.items()])
-        content = 'Content updates:\n%s\nMessage:\n%s' % (json.dumps(content_updates, indent=2, cls=DjangoJSONEncoder), delivery)
+        content = u'Content updates:\n%s\nMessage:\n%s' % (json.dumps(content_updates, indent=2, cls=DjangoJSONEncoder), delivery)
+
+        # Every subscription in the delivery, and often many subscribers,
+        # share the same content; store it once.
+        digest = DeliveryBody.make_digest(content)
+        if digest not in self.bodies:
+            self.bodies[digest] = DeliveryBody.store(content)
+        body = self.bodies[digest]
+
+        now = datetime.now()
         for subscription in subscriptions:
-            SubscriptionDispatchRecord.objects.create(
-                when=datetime.now(),
+            self.records.append(SubscriptionDispatchRecord(
+                when=now,
                 subscription=subscription,
                 dispatcher=self.__class__.__name__,
-                content=content
-            )
+                body=body
+            ))
+
+    def save_records(self):
+        """Save the dispatch records made by record_delivery all at once."""
+        records, self.records = self.records, []
+        if records:
+            SubscriptionDispatchRecord.objects.bulk_create(records)
 
 
 class SubscriptionEmailer (SubscriptionDispatcher):
@@ -353,7 +618,11 @@ class SubscriptionEmailer (SubscriptionDispatcher):
     html_template_name = 'subscriptions/subscription_email.html'
     EMAIL_TITLE = "Councilmatic %(date)s"
 
-    def send_email(self, you, emailbodies, emailsubject=None):
+    connection = None
+    """The mail connection to send messages over.  If None, the default
+       connection is used (and opened and closed for each batch)."""
+
+    def make_email(self, you, emailbodies, emailsubject=None):
         subject = emailsubject or self.EMAIL_TITLE % {'date': date.today()}
         message = emailbodies['text']
         html_message = emailbodies['html']
@@ -367,13 +636,16 @@ class SubscriptionEmailer (SubscriptionDispatcher):
             subject,
             message,
             from_email,
-            to=recipient_list)#,
-            # connection=connection)
+            to=recipient_list,
+            connection=self.connection)
 
         if html_message:
             msg.attach_alternative(html_message, 'text/html')
 
-        msg.send()
+        return msg
+
+    def send_email(self, you, emailbodies, emailsubject=None):
+        self.make_email(you, emailbodies, emailsubject).send()
 
     def deliver_to(self, subscriber, delivery):
         """
@@ -383,17 +655,73 @@ class SubscriptionEmailer (SubscriptionDispatcher):
         email_body = delivery
         self.send_email(email_addr, email_body)
 
+    def deliver_batch(self, deliveries):
+        """
+        Send all of the emails in one go over a single mail connection.
+        """
+        messages = [self.make_email(subscriber.email, delivery)
+                    for subscriber, delivery in deliveries]
+        connection = self.connection or get_connection()
+        connection.send_messages(messages)
+
+    item_template_names = {
+        'text': 'subscriptions/item.txt',
+        'html': 'subscriptions/item.html',
+    }
+    """The templates for a single content item in each format.  The rendered
+       items are passed into the email templates as ``fragments``."""
+
+    def __init__(self, *args, **kwargs):
+        super(SubscriptionEmailer, self).__init__(*args, **kwargs)
+        self.fragments = {}
+        self.fragment_hits = 0
+
+    def render_fragments(self, item, item_updates):
+        """
+        Render each format of a content item and its updates.  Many digests
+        share the same item and updates, so the results are kept for the
+        lifetime of the emailer (i.e., one run).
+        """
+        try:
+            key = (item, tuple(item_updates))
+            hash(key)
+        except TypeError:
+            key = None
+
+        if key is not None and key in self.fragments:
+            self.fragment_hits += 1
+            return self.fragments[key]
+
+        # The item templates render search results by their objects.
+        item_object = getattr(item, 'object', None)
+        context = Context({'item': item_object or item,
+                           'item_updates': item_updates,
+                           'SITE': self.get_site()})
+
+        fragments = {}
+        for format, template_name in self.item_template_names.items():
+            template = self.get_cached_template(template_name)
+            if template is not None:
+                fragments[format] = mark_safe(template.render(context))
+
+        if key is not None:
+            self.fragments[key] = fragments
+        return fragments
+
+    def get_context_data(self, *args, **kwargs):
+        context = super(SubscriptionEmailer, self).get_context_data(*args, **kwargs)
+        context['content_updates'] = [
+            (item, item_updates, self.render_fragments(item, item_updates))
+            for item, item_updates in context['content_updates']]
+        return context
+
     def render(self, subscriber, subscriptions, content_updates, library=None):
         """
         Override the base render to render both text and html versions, if
         available.
         """
-        text_template = get_template(self.template_name)
-
-        try:
-            html_template = get_template(self.html_template_name)
-        except TemplateDoesNotExist:
-            html_template = None
+        text_template = self.get_cached_template(self.template_name)
+        html_template = self.get_cached_template(self.html_template_name)
 
         context = self.get_context_data(subscriber, subscriptions, content_updates, library)
         return {
@@ -401,3 +729,7 @@ class SubscriptionEmailer (SubscriptionDispatcher):
             'html': html_template.render(context) if html_template else None
         }
 
+    def render_summary(self):
+        summary = super(SubscriptionEmailer, self).render_summary()
+        return '%s; %s item fragments rendered, %s reused' % (
+            summary, len(self.fragments), self.fragment_hits)
@@ -1,3 +1,5 @@
+import json
+
 import django.forms
 from django.contrib import auth
 
@@ -5,23 +7,56 @@ import subscriptions.models as models
 
 
 class SubscriptionForm (django.forms.ModelForm):
+    """
+    Subscribes a subscriber to a content feed.  The feed is given by the name
+    it's registered with in the library and its (JSON-encoded) parameters,
+    and its record is only looked up (or created) when the subscription is
+    saved, so that showing the form doesn't write anything.
+    """
 
-    # TODO: This form currently takes the feed_record ID, which means that the
-    # feed record has to be created before the form is served/processed.  This
-    # is an artifact of the old way that we were doing things, where this was
-    # thought a necessity.  Now, with the simpler content feeds system, we can
-    # update this form to take in a feed name and feed parameters, and create
-    # the feed record before creating the subscription.  This will save on
-    # unused, lingering database records that would have to get cleaned up by
-    # a cron job.
-    #
-    # So, change this form to use feed name/params and to use a two-step save
-    # process.
+    feed_name = django.forms.CharField(widget=django.forms.HiddenInput())
+    feed_params = django.forms.CharField(widget=django.forms.HiddenInput())
 
     class Meta:
         model = models.Subscription
-        exclude = ('last_sent',)
+        exclude = ('last_sent', 'feed_record')
         widgets = {
-            'feed_record' : django.forms.HiddenInput(),
             'subscriber' : django.forms.HiddenInput(),
         }
+
+    def __init__(self, *args, **kwargs):
+        library = kwargs.pop('library', None)
+        if library is None:
+            from councilmatic.subscriptions.feeds import ContentFeedLibrary
+            library = ContentFeedLibrary()
+        self.library = library
+
+        super(SubscriptionForm, self).__init__(*args, **kwargs)
+
+    @staticmethod
+    def feed_data(feed, library):
+        """Return the form data that identify the given feed."""
+        return {'feed_name': library.get_feed_name(feed),
+                'feed_params': json.dumps(feed.get_params(), default=unicode)}
+
+    def clean(self):
+        from councilmatic.subscriptions.feeds import ContentFeed
+
+        cleaned_data = super(SubscriptionForm, self).clean()
+        if 'feed_name' not in cleaned_data or 'feed_params' not in cleaned_data:
+            return cleaned_data
+
+        try:
+            ContentFeedClass = self.library.feeds[cleaned_data['feed_name']]
+            params = json.loads(cleaned_data['feed_params'])
+            kwargs = dict((str(name), value) for name, value in params.items())
+            self.feed = ContentFeedClass(**kwargs)
+        except (KeyError, ValueError, TypeError, AttributeError,
+                ContentFeed.IsObsolete):
+            raise django.forms.ValidationError('Unknown content feed')
+
+        return cleaned_data
+
+    def save(self, commit=True):
+        self.instance.feed_record = self.library.get_record(self.feed)
+        return super(SubscriptionForm, self).save(commit)
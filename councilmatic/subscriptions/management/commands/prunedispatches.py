@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+import datetime
+import optparse
+
+from councilmatic.subscriptions.models import SubscriptionDispatchRecord
+
+
+class Command(BaseCommand):
+    help = "Delete the records of old subscription deliveries."
+    option_list = BaseCommand.option_list + (
+            optparse.make_option('--days',
+                action='store',
+                type='int',
+                dest='days',
+                default=90,
+                help='Keep the records of deliveries made in this many days'),
+            )
+
+    def handle(self, *args, **options):
+        days = options.get('days', 90)
+        if days < 0:
+            raise CommandError('--days must not be negative')
+
+        before = datetime.datetime.now() - datetime.timedelta(days=days)
+        pruned = SubscriptionDispatchRecord.prune(before)
+        self.stdout.write('Deleted %s dispatch records from before %s\n' %
+                          (pruned, before.date()))
@@ -1,18 +1,121 @@
+from django.core.mail import get_connection
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+import logging
+import multiprocessing
+import optparse
 
 from councilmatic.subscriptions.feeds import import_all_feeds
 from councilmatic.subscriptions.feeds import SubscriptionEmailer
-from councilmatic.subscriptions.models import Subscriber
+from councilmatic.subscriptions.models import DispatchCheckpoint, Subscriber
+
+log = logging.getLogger(__name__)
+
+
+def dispatch_shard(shard, shards, batch_size, chunk_size=500):
+    """
+    Send the updates for every subscriber in the shard (the ones whose key
+    modulo ``shards`` is ``shard``), over a single mail connection, resuming
+    from the shard's checkpoint if an earlier run was interrupted.  Returns
+    the number of messages sent.
+    """
+    checkpoint = DispatchCheckpoint.resume_or_start(shard, shards)
+    if checkpoint.last_subscriber_id:
+        log.info('Resuming shard %s of %s after subscriber %s' %
+                 (shard + 1, shards, checkpoint.last_subscriber_id))
+
+    subscriber_ids = [pk for pk in Subscriber.objects
+                          .filter(pk__gt=checkpoint.last_subscriber_id)
+                          .order_by('pk').values_list('pk', flat=True)
+                      if pk % shards == shard]
+
+    dispatcher = SubscriptionEmailer(batch_size=batch_size)
+    dispatcher.delivered = checkpoint.delivered
+    dispatcher.connection = get_connection()
+    dispatcher.connection.open()
+    try:
+        for start in range(0, len(subscriber_ids), chunk_size):
+            chunk = subscriber_ids[start:start + chunk_size]
+            subscribers = Subscriber.objects.filter(pk__in=chunk).order_by('pk')
+            dispatcher.dispatch_all(subscribers, checkpoint=checkpoint)
+    finally:
+        dispatcher.connection.close()
+
+    log.info('Shard %s of %s: %s' % (shard + 1, shards, dispatcher.render_summary()))
+    checkpoint.finish()
+    return checkpoint.delivered
+
+
+def run_shard(shard, shards, batch_size, results):
+    # Each worker process needs its own database connection.
+    connection.close()
+    import_all_feeds()
+    try:
+        results.put((shard, dispatch_shard(shard, shards, batch_size)))
+    except:
+        log.exception('Shard %s of %s stopped; run again to resume it' %
+                      (shard + 1, shards))
+        results.put((shard, None))
+        raise
+
 
 class Command(BaseCommand):
     help = "Send a digest of the new items in the users' subscription lists."
+    option_list = BaseCommand.option_list + (
+            optparse.make_option('--processes',
+                action='store',
+                type='int',
+                dest='processes',
+                default=1,
+                help='The number of worker processes to send with.  To resume '
+                     'an interrupted run, use the same number of processes.'),
+            optparse.make_option('--batch-size',
+                action='store',
+                type='int',
+                dest='batch_size',
+                default=50,
+                help='The number of messages to send at a time'),
+            optparse.make_option('--restart',
+                action='store_true',
+                dest='restart',
+                default=False,
+                help='Abandon any interrupted run instead of resuming it'),
+            )
 
     def handle(self, *args, **options):
         # Assuming that the feeds have been updated
+        processes = options.get('processes', 1)
+        batch_size = options.get('batch_size', 50)
+        if processes < 1 or batch_size < 1:
+            raise CommandError('--processes and --batch-size must be at least 1')
+
+        if options.get('restart'):
+            DispatchCheckpoint.objects.filter(finished__isnull=True).delete()
 
         import_all_feeds()
-        dispatcher = SubscriptionEmailer()
 
-        subscribers = Subscriber.objects.all()
-        for subscriber in subscribers:
-            dispatcher.dispatch_subscriptions_for(subscriber)
+        if processes == 1:
+            delivered = dispatch_shard(0, 1, batch_size)
+        else:
+            # Don't share this process' database connection with the workers.
+            connection.close()
+
+            results = multiprocessing.Queue()
+            workers = [multiprocessing.Process(target=run_shard,
+                                               args=(shard, processes, batch_size, results))
+                       for shard in range(processes)]
+            for worker in workers:
+                worker.start()
+
+            totals = dict(results.get() for worker in workers)
+            for worker in workers:
+                worker.join()
+
+            failed = [shard for shard, total in totals.items() if total is None]
+            if failed:
+                raise CommandError('%s of %s shards failed; run again with '
+                                   '--processes=%s to resume them' %
+                                   (len(failed), processes, processes))
+            delivered = sum(totals.values())
+
+        log.info('Sent %s subscription updates' % delivered)
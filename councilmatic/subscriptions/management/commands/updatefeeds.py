@@ -1,12 +1,25 @@
 from django.core.management.base import BaseCommand, CommandError
+import logging
+import optparse
 
 from councilmatic.subscriptions.feeds import import_all_feeds
 from councilmatic.subscriptions.feeds import ContentFeedRecordUpdater
+from councilmatic.subscriptions.models import ContentChange
 from councilmatic.subscriptions.models import ContentFeedRecord
 
+log = logging.getLogger(__name__)
+
 
 class Command(BaseCommand):
     help = "Update the meta-information for the subscription content feeds."
+    option_list = BaseCommand.option_list + (
+            optparse.make_option('--incremental',
+                action='store_true',
+                dest='incremental',
+                default=False,
+                help='Only update the feeds that the content changed since '
+                     'the last update could affect'),
+            )
 
     def get_records(self):
         records = ContentFeedRecord.objects.all()
@@ -16,6 +29,22 @@ class Command(BaseCommand):
         # Make sure that the library knows about all the types of feeds.
         import_all_feeds()
 
+        # Note where the changes stand now; anything that changes while the
+        # feeds are updating will be picked up next time.
+        changes = ContentChange.objects.order_by('-pk')[:1]
+        last_change_id = changes[0].pk if changes else 0
+
         records = self.get_records()
         updater = ContentFeedRecordUpdater()
-        updater.update_all(records)
+
+        if options.get('incremental'):
+            changed_content = ContentChange.get_changed_content(
+                ContentChange.objects.filter(pk__lte=last_change_id))
+            updated = updater.update_changed(records, changed_content)
+            log.info('Updated %s feeds for %s changed items' %
+                     (updated, len(changed_content)))
+        else:
+            updater.update_all(records)
+
+        # Either way, every feed is now up to date with the changes so far.
+        ContentChange.objects.filter(pk__lte=last_change_id).delete()
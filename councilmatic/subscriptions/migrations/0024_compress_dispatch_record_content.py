@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import base64
+import datetime
+import hashlib
+import zlib
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Move the content of existing dispatch records into shared, compressed delivery bodies."
+        Record = orm['subscriptions.SubscriptionDispatchRecord']
+        Body = orm['subscriptions.DeliveryBody']
+
+        bodies = {}
+        record_ids = list(Record.objects.filter(body__isnull=True)
+                          .order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(record_ids), 500):
+            chunk = record_ids[start:start + 500]
+            for record in Record.objects.filter(pk__in=chunk):
+                digest = hashlib.sha1(record.content.encode('utf-8')).hexdigest()
+                if digest not in bodies:
+                    body, _ = Body.objects.get_or_create(digest=digest, defaults={
+                        'data': base64.b64encode(zlib.compress(record.content.encode('utf-8')))})
+                    bodies[digest] = body.pk
+                Record.objects.filter(pk=record.pk).update(body=bodies[digest], content='')
+
+    def backwards(self, orm):
+        "Copy the delivery bodies back into their dispatch records."
+        Record = orm['subscriptions.SubscriptionDispatchRecord']
+        for body in orm['subscriptions.DeliveryBody'].objects.all():
+            content = zlib.decompress(base64.b64decode(body.data)).decode('utf-8')
+            Record.objects.filter(body=body).update(content=content, body=None)
+
+    models = {
+        u'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        u'auth.permission': {
+            'Meta': {'ordering': "(u'content_type__app_label', u'content_type__model', u'codename')", 'unique_together': "((u'content_type', u'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        u'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'subscriptions.contentfeedparameter': {
+            'Meta': {'object_name': 'ContentFeedParameter'},
+            'feed_record': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'feed_params'", 'to': u"orm['subscriptions.ContentFeedRecord']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'value': ('django.db.models.fields.TextField', [], {})
+        },
+        u'subscriptions.contentfeedrecord': {
+            'Meta': {'object_name': 'ContentFeedRecord'},
+            'feed_name': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_updated': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(1, 1, 1, 0, 0)'})
+        },
+        u'subscriptions.deliverybody': {
+            'Meta': {'object_name': 'DeliveryBody'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'data': ('django.db.models.fields.TextField', [], {}),
+            'digest': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '40'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        u'subscriptions.dispatchcheckpoint': {
+            'Meta': {'object_name': 'DispatchCheckpoint'},
+            'delivered': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'finished': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_subscriber_id': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'shard': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'shards': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'started': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'})
+        },
+        u'subscriptions.subscriber': {
+            'Meta': {'object_name': 'Subscriber', '_ormbases': [u'auth.User']},
+            u'user_ptr': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['auth.User']", 'unique': 'True', 'primary_key': 'True'})
+        },
+        u'subscriptions.subscription': {
+            'Meta': {'object_name': 'Subscription'},
+            'feed_record': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['subscriptions.ContentFeedRecord']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_sent': ('django.db.models.fields.DateTimeField', [], {'blank': 'True'}),
+            'subscriber': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'subscriptions'", 'to': u"orm['subscriptions.Subscriber']"})
+        },
+        u'subscriptions.subscriptiondispatchrecord': {
+            'Meta': {'object_name': 'SubscriptionDispatchRecord'},
+            'body': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'dispatches'", 'null': 'True', 'to': u"orm['subscriptions.DeliveryBody']"}),
+            'content': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'dispatcher': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'subscription': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'dispatches'", 'to': u"orm['subscriptions.Subscription']"}),
+            'when': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'})
+        }
+    }
+
+    complete_apps = ['subscriptions']
+    symmetrical = True
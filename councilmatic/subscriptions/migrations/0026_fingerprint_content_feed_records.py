@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import datetime
+import hashlib
+import json
+from collections import defaultdict
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+from django.utils.encoding import smart_unicode
+
+
+def make_fingerprint(feed_name, params):
+    canonical = json.dumps([smart_unicode(feed_name),
+                            sorted((smart_unicode(name), smart_unicode(value))
+                                   for name, value in params.items())])
+    return hashlib.sha1(canonical).hexdigest()
+
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Fingerprint each feed record, merging the records of identical feeds."
+        Record = orm['subscriptions.ContentFeedRecord']
+        Subscription = orm['subscriptions.Subscription']
+        Dispatch = orm['subscriptions.SubscriptionDispatchRecord']
+
+        params = defaultdict(dict)
+        for record_id, name, value in orm['subscriptions.ContentFeedParameter'].objects\
+                .values_list('feed_record', 'name', 'value'):
+            params[record_id][name] = value
+
+        records_by_fingerprint = defaultdict(list)
+        for record in Record.objects.filter(fingerprint__isnull=True).order_by('pk'):
+            fingerprint = make_fingerprint(record.feed_name, params[record.pk])
+            records_by_fingerprint[fingerprint].append(record)
+
+        for fingerprint, records in records_by_fingerprint.items():
+            keeper, duplicates = records[0], records[1:]
+            if duplicates:
+                duplicate_ids = [record.pk for record in duplicates]
+
+                # A subscriber may be subscribed to more than one of the
+                # merged records; keep just one of their subscriptions (with
+                # the others' dispatch history), so that they don't get each
+                # update more than once.
+                survivors = {}
+                for subscription in Subscription.objects\
+                        .filter(feed_record__in=[record.pk for record in records])\
+                        .order_by('pk'):
+                    survivor = survivors.setdefault(subscription.subscriber_id, subscription)
+                    if survivor is not subscription:
+                        Dispatch.objects.filter(subscription=subscription)\
+                                        .update(subscription=survivor)
+                        subscription.delete()
+
+                Subscription.objects.filter(feed_record__in=duplicate_ids)\
+                                    .update(feed_record=keeper)
+                keeper.last_updated = max(record.last_updated for record in records)
+                Record.objects.filter(pk__in=duplicate_ids).delete()
+
+            keeper.fingerprint = fingerprint
+            keeper.save()
+
+    def backwards(self, orm):
+        "Forget the fingerprints; merged records stay merged."
+        orm['subscriptions.ContentFeedRecord'].objects.update(fingerprint=None)
+
+    models = {
+        u'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        u'auth.permission': {
+            'Meta': {'ordering': "(u'content_type__app_label', u'content_type__model', u'codename')", 'unique_together': "((u'content_type', u'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        u'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'subscriptions.contentfeedparameter': {
+            'Meta': {'object_name': 'ContentFeedParameter'},
+            'feed_record': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'feed_params'", 'to': u"orm['subscriptions.ContentFeedRecord']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'value': ('django.db.models.fields.TextField', [], {})
+        },
+        u'subscriptions.contentfeedrecord': {
+            'Meta': {'object_name': 'ContentFeedRecord'},
+            'feed_name': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'fingerprint': ('django.db.models.fields.CharField', [], {'max_length': '40', 'unique': 'True', 'null': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_updated': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(1, 1, 1, 0, 0)'})
+        },
+        u'subscriptions.deliverybody': {
+            'Meta': {'object_name': 'DeliveryBody'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'data': ('django.db.models.fields.TextField', [], {}),
+            'digest': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '40'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        u'subscriptions.dispatchcheckpoint': {
+            'Meta': {'object_name': 'DispatchCheckpoint'},
+            'delivered': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'finished': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_subscriber_id': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'shard': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'shards': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'started': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'})
+        },
+        u'subscriptions.subscriber': {
+            'Meta': {'object_name': 'Subscriber', '_ormbases': [u'auth.User']},
+            u'user_ptr': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['auth.User']", 'unique': 'True', 'primary_key': 'True'})
+        },
+        u'subscriptions.subscription': {
+            'Meta': {'object_name': 'Subscription'},
+            'feed_record': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['subscriptions.ContentFeedRecord']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_sent': ('django.db.models.fields.DateTimeField', [], {'blank': 'True'}),
+            'subscriber': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'subscriptions'", 'to': u"orm['subscriptions.Subscriber']"})
+        },
+        u'subscriptions.subscriptiondispatchrecord': {
+            'Meta': {'object_name': 'SubscriptionDispatchRecord'},
+            'body': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'dispatches'", 'null': 'True', 'to': u"orm['subscriptions.DeliveryBody']"}),
+            'content': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'dispatcher': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'subscription': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'dispatches'", 'to': u"orm['subscriptions.Subscription']"}),
+            'when': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'})
+        }
+    }
+
+    complete_apps = ['subscriptions']
+    symmetrical = True
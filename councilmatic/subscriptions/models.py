@@ -1,11 +1,17 @@
+import base64
 import datetime
+import hashlib
+import json
 import logging
+import zlib
+from collections import defaultdict
 from django.db import models
 
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.db import transaction, DatabaseError, IntegrityError
+from django.utils.encoding import smart_unicode
 from django.utils.translation import ugettext as _
 import haystack.query as haystack
 
@@ -41,9 +47,23 @@ class ContentFeedRecord (models.Model):
     """The set of parameters used to retrieve the content feed from the
        library"""
 
+    fingerprint = models.CharField(max_length=40, unique=True, null=True)
+    """A hash of the feed name and parameters, identifying the feed"""
+
     last_updated = models.DateTimeField(default=datetime.datetime.min)
     """The stored value of the last time content in the feed was updated."""
 
+    @staticmethod
+    def make_fingerprint(feed_name, params):
+        """
+        Hash a feed name and its { name : value } parameters.  Parameters are
+        compared as they will be stored, so their order and types don't matter.
+        """
+        canonical = json.dumps([smart_unicode(feed_name),
+                                sorted((smart_unicode(name), smart_unicode(value))
+                                       for name, value in params.items())])
+        return hashlib.sha1(canonical).hexdigest()
+
     def __unicode__(self):
         string = u'a %s feed: ' % (self.feed_name,)
         params = ['%s = %s' % (p.name, p.value) for p in self.feed_params.all()]
@@ -51,6 +71,9 @@ class ContentFeedRecord (models.Model):
         return string
 
     def is_equivalent_to(self, other):
+        if self.fingerprint and other.fingerprint:
+            return self.fingerprint == other.fingerprint
+
         if self.feed_name != other.feed_name:
             return False
 
@@ -70,6 +93,44 @@ class ContentFeedParameter (models.Model):
     value = models.TextField()
 
 
+class ContentChange (models.Model):
+    """
+    A note that some content has changed since the feeds were last updated.
+    Incremental feed updates only look at the feeds that these could affect.
+    """
+
+    content_type = models.ForeignKey(ContentType)
+    content_id = models.PositiveIntegerField()
+    content = generic.GenericForeignKey('content_type', 'content_id')
+    changed = models.DateTimeField(default=datetime.datetime.now, db_index=True)
+
+    def __unicode__(self):
+        return u'%s %s changed at %s' % (self.content_type, self.content_id, self.changed)
+
+    @classmethod
+    def record(cls, obj):
+        """Note that the given content object has changed."""
+        return cls.objects.create(
+            content_type=ContentType.objects.get_for_model(obj),
+            content_id=obj.pk)
+
+    @classmethod
+    def get_changed_content(cls, changes):
+        """
+        Return the (distinct) content objects that the given changes refer to,
+        fetching them with one query per type of content.
+        """
+        ids_by_type = defaultdict(set)
+        for content_type_id, content_id in changes.values_list('content_type', 'content_id'):
+            ids_by_type[content_type_id].add(content_id)
+
+        content = []
+        for content_type_id, ids in ids_by_type.items():
+            Model = ContentType.objects.get_for_id(content_type_id).model_class()
+            content.extend(Model.objects.filter(pk__in=ids))
+        return content
+
+
 # Subscriber
 
 class SubscriberManager (models.Manager):
@@ -114,13 +175,6 @@ class Subscriber (User):
             subscription.save()
         return subscription
 
-    def preloaded_subscriptions(self, library):
-        if not hasattr(self, '_preloaded_subscriptions'):
-            self._preloaded_subscriptions = self.subscriptions.select_related() \
-                .select_related('feed_record') \
-                .prefetch_related('feed_record__feed_params')
-        return self._preloaded_subscriptions
-
     def subscription(self, feed, library=None):
         """Returns the subscription to the given content feed."""
         if library is None:
@@ -130,28 +184,12 @@ class Subscriber (User):
         log.debug('Checking whether %s is subscribed to %s at %s' %
                   (self, feed, library))
 
-        record = library.get_record(feed)
-        try:
-            subs = filter(
-                lambda sub: sub.feed_record.feed_name == record.feed_name,
-                self.preloaded_subscriptions(library)
-            )
-
-            if not subs:
-                log.debug('No subscription record found with the name %s' %
-                          (record.feed_name,))
-                return None
-
-            other_params = [(p.name, p.value) for p in record.feed_params.all()]
-            for sub in subs:
-                self_params = [(p.name, p.value) for p in sub.feed_record.feed_params.all()]
-                log.debug('Checking parameters %r against %r' %
-                          (self_params, other_params))
-                if self_params == other_params:
-                    return sub
-
-        except Subscription.DoesNotExist:
+        fingerprint = library.get_fingerprint(feed)
+        subs = self.subscriptions.filter(feed_record__fingerprint=fingerprint)\
+                                 .select_related('feed_record')[:1]
+        if not subs:
             return None
+        return subs[0]
 
 
 from django.dispatch import receiver
@@ -195,10 +233,147 @@ class Subscription (models.Model):
         super(Subscription, self).save(*args, **kwargs)
 
 
+class DeliveryBody (models.Model):
+    """
+    The content of a delivery, compressed, and stored once no matter how many
+    dispatch records share it.  Bodies are keyed by a hash of their content.
+    """
+
+    digest = models.CharField(max_length=40, unique=True)
+    data = models.TextField()
+    """The zlib-compressed content, base64-encoded"""
+
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.digest
+
+    @staticmethod
+    def make_digest(content):
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def compress(content):
+        return base64.b64encode(zlib.compress(content.encode('utf-8')))
+
+    @property
+    def content(self):
+        return zlib.decompress(base64.b64decode(self.data)).decode('utf-8')
+
+    @classmethod
+    def store(cls, content):
+        """
+        Return the body with the given content, creating it if there isn't one
+        already.
+        """
+        digest = cls.make_digest(content)
+        try:
+            return cls.objects.get(digest=digest)
+        except cls.DoesNotExist:
+            pass
+
+        try:
+            sid = transaction.savepoint()
+            body = cls.objects.create(digest=digest, data=cls.compress(content))
+            transaction.savepoint_commit(sid)
+            return body
+        except IntegrityError:
+            # Someone else stored the same content first.
+            transaction.savepoint_rollback(sid)
+            return cls.objects.get(digest=digest)
+
+    @classmethod
+    def unused(cls):
+        """The bodies that no dispatch record refers to any more."""
+        return cls.objects.filter(dispatches__isnull=True)
+
+
 class SubscriptionDispatchRecord (models.Model):
     """Records a subscription delivery"""
 
     subscription = models.ForeignKey('Subscription', related_name='dispatches')
-    when = models.DateTimeField()
-    content = models.TextField()
+    when = models.DateTimeField(db_index=True)
+    body = models.ForeignKey('DeliveryBody', related_name='dispatches', null=True)
+    content = models.TextField(blank=True)
+    """The content of records made before there were delivery bodies"""
+
     dispatcher = models.CharField(max_length=256)
+
+    def get_content(self):
+        if self.body_id is not None:
+            return self.body.content
+        return self.content
+    get_content.short_description = 'content'
+
+    @classmethod
+    def prune(cls, before):
+        """
+        Delete the records of deliveries made before the given time, and the
+        bodies that are no longer used.  The latest record of each
+        subscription is kept, so that it's still known to have been sent.
+        Returns the number of records deleted.
+        """
+        latest = cls.objects.order_by()\
+            .values('subscription').annotate(latest=models.Max('pk'))\
+            .values_list('latest', flat=True)
+        keep = set(latest)
+
+        old_ids = [pk for pk in cls.objects.filter(when__lt=before)
+                                   .values_list('pk', flat=True)
+                   if pk not in keep]
+        for start in range(0, len(old_ids), 500):
+            cls.objects.filter(pk__in=old_ids[start:start + 500]).delete()
+
+        DeliveryBody.unused().delete()
+        return len(old_ids)
+
+
+class DispatchCheckpoint (models.Model):
+    """
+    Records how far a dispatch run has gotten through its share of the
+    subscribers, so that an interrupted run can pick up where it stopped.
+    Subscribers are dispatched in order of primary key, and a run with N
+    shards gives each shard the subscribers whose key modulo N is its number.
+    """
+
+    shard = models.IntegerField(default=0)
+    shards = models.IntegerField(default=1)
+    last_subscriber_id = models.IntegerField(default=0)
+    """The key of the last subscriber whose dispatch is complete"""
+
+    delivered = models.IntegerField(default=0)
+    started = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return u'shard %s of %s, up to subscriber %s' % (
+            self.shard + 1, self.shards, self.last_subscriber_id)
+
+    @classmethod
+    def resume_or_start(cls, shard, shards):
+        """
+        Return the unfinished checkpoint for the given shard, if one was
+        started today, or a new checkpoint.  Unfinished checkpoints from
+        earlier days' runs are discarded; the subscribers they didn't get to
+        are sent everything new since their last update by the new run.
+        """
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        unfinished = cls.objects\
+            .filter(shard=shard, shards=shards, finished__isnull=True)
+        unfinished.filter(started__lt=today).delete()
+
+        current = unfinished.filter(started__gte=today).order_by('-started')[:1]
+        if current:
+            return current[0]
+        return cls.objects.create(shard=shard, shards=shards)
+
+    def advance(self, last_subscriber_id, delivered):
+        """Record the last subscriber done, and the deliveries made so far."""
+        self.last_subscriber_id = last_subscriber_id
+        self.delivered = delivered
+        self.save()
+
+    def finish(self):
+        self.finished = datetime.datetime.now()
+        self.save()
@@ -3,9 +3,10 @@ from django.core import mail
 from nose.tools import *
 from councilmatic.subscriptions.feeds import ContentFeed
 from councilmatic.subscriptions.feeds import ContentFeedLibrary
+from councilmatic.subscriptions.feeds import SubscriptionEmailer
 from councilmatic.subscriptions.management.commands import sendfeedupdates
 from councilmatic.subscriptions.management.commands import updatefeeds
-from councilmatic.subscriptions.models import Subscriber, ContentFeedRecord
+from councilmatic.subscriptions.models import Subscriber, ContentFeedRecord, DispatchCheckpoint
 
 
 @istest
@@ -94,3 +95,104 @@ def test_subscription_flow():
     send.handle()
 
     assert_equal(len(mail.outbox), 1)
+
+
+class Test_sendfeedupdates_dispatchShard:
+
+    def setup(self):
+        Subscriber.objects.all().delete()
+        ContentFeedRecord.objects.all().delete()
+        DispatchCheckpoint.objects.all().delete()
+        del mail.outbox[:]
+
+        class OneItemFeed (ContentFeed):
+            def get_content(self):
+                return [1]
+
+            def get_params(self):
+                return {}
+
+            def get_updates_since(self, previous):
+                return [1]
+
+            def get_last_updated_time(self):
+                return datetime.datetime(2011, 12, 13)
+
+            def get_changes_to(self, item, since):
+                return {'value': item}, datetime.datetime(2011, 12, 13)
+
+            def get_label(self):
+                return 'One item'
+
+        library = ContentFeedLibrary(shared=True)
+        library.register(OneItemFeed, 'one item')
+        feed = OneItemFeed()
+
+        self.subscribers = []
+        for i in range(5):
+            subscriber = Subscriber.objects.create(
+                username='user%s' % i, email='user%s@example.com' % i)
+            subscription = subscriber.subscribe(feed, library=library)
+            subscription.last_sent = datetime.datetime(2011, 11, 11)
+            subscription.save()
+            self.subscribers.append(subscriber)
+
+        record = library.get_record(feed)
+        record.last_updated = datetime.datetime(2011, 12, 13)
+        record.save()
+
+    @istest
+    def sends_everyone_their_updates_in_batches(self):
+        delivered = sendfeedupdates.dispatch_shard(0, 1, batch_size=2)
+
+        assert_equal(delivered, 5)
+        assert_equal(sorted(message.to[0] for message in mail.outbox),
+                     ['user%s@example.com' % i for i in range(5)])
+
+        checkpoint = DispatchCheckpoint.objects.get()
+        assert_is_not_none(checkpoint.finished)
+        assert_equal(checkpoint.last_subscriber_id, self.subscribers[-1].pk)
+
+    @istest
+    def resumes_an_interrupted_run_where_it_stopped(self):
+        DispatchCheckpoint.objects.create(
+            shard=0, shards=1, delivered=2,
+            last_subscriber_id=self.subscribers[1].pk)
+
+        delivered = sendfeedupdates.dispatch_shard(0, 1, batch_size=2)
+
+        assert_equal(delivered, 5)
+        assert_equal(sorted(message.to[0] for message in mail.outbox),
+                     ['user%s@example.com' % i for i in range(2, 5)])
+
+    @istest
+    def starts_over_instead_of_resuming_a_run_from_an_earlier_day(self):
+        checkpoint = DispatchCheckpoint.objects.create(
+            shard=0, shards=1, delivered=2,
+            last_subscriber_id=self.subscribers[1].pk)
+        DispatchCheckpoint.objects.filter(pk=checkpoint.pk).update(
+            started=datetime.datetime.now() - datetime.timedelta(days=1))
+
+        delivered = sendfeedupdates.dispatch_shard(0, 1, batch_size=2)
+
+        assert_equal(delivered, 5)
+        assert_equal(len(mail.outbox), 5)
+        assert_equal(DispatchCheckpoint.objects.filter(pk=checkpoint.pk).count(), 0)
+
+    @istest
+    def splits_subscribers_between_shards(self):
+        sendfeedupdates.dispatch_shard(0, 2, batch_size=2)
+        sendfeedupdates.dispatch_shard(1, 2, batch_size=2)
+
+        assert_equal(len(mail.outbox), 5)
+
+    @istest
+    def renders_items_shared_between_digests_once(self):
+        dispatcher = SubscriptionEmailer(batch_size=2)
+        dispatcher.dispatch_all(Subscriber.objects.order_by('pk'))
+
+        assert_equal(len(mail.outbox), 5)
+        assert_equal(len(dispatcher.fragments), 1)
+        assert_equal(dispatcher.fragment_hits, 4)
+        assert_equal(len(dispatcher.render_times), 5)
+        assert_equal(len(set(message.body for message in mail.outbox)), 1)
@@ -2,6 +2,7 @@
 """
 
 import datetime
+import json
 import pickle
 
 from django.test import TestCase
@@ -10,6 +11,7 @@ from logging import CRITICAL, DEBUG, ERROR, INFO, WARN
 from mock import Mock
 from nose.tools import *
 
+from councilmatic.subscriptions.cache import LRUCache
 from councilmatic.subscriptions.feeds import ContentFeed
 from councilmatic.subscriptions.feeds import ContentFeedLibrary
 from councilmatic.subscriptions.feeds import ContentFeedRecordCleaner
@@ -18,8 +20,10 @@ from councilmatic.subscriptions.feeds import SubscriptionDispatcher
 from councilmatic.subscriptions.forms import SubscriptionForm
 from councilmatic.subscriptions.models import ContentFeedParameter
 from councilmatic.subscriptions.models import ContentFeedRecord
+from councilmatic.subscriptions.models import DeliveryBody
 from councilmatic.subscriptions.models import Subscriber
 from councilmatic.subscriptions.models import Subscription
+from councilmatic.subscriptions.models import SubscriptionDispatchRecord
 from councilmatic.subscriptions.models import SerializedObjectField
 from councilmatic.subscriptions.views import SingleSubscriptionMixin
 
@@ -163,6 +167,100 @@ class Test_Subscriber_isSubscribed (TestCase):
         assert subscription is None
 
 
+class Test_LRUCache:
+
+    @istest
+    def evicts_the_least_recently_used_entries(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        assert_equal(cache.get('a'), 1)
+        assert_is_none(cache.get('b'))
+        assert_equal(cache.get('c'), 3)
+        assert_equal(cache.stats(), {'size': 2, 'maxsize': 2, 'hits': 3,
+                                     'misses': 1, 'evictions': 1,
+                                     'hit_rate': 0.75})
+
+    @istest
+    def keeps_a_library_from_growing_without_bound(self):
+        library = ContentFeedLibrary(shared=False)
+        library.register(ListItemFeed, 'li')
+        library._record_cache.maxsize = library._feed_cache.maxsize = 3
+
+        for i in range(10):
+            library.get_record(ListItemFeed('[%s]' % i))
+
+        assert_equal(library.cache_stats()['records']['size'], 3)
+        assert_equal(library.cache_stats()['records']['evictions'], 7)
+
+
+class Test_ContentFeedLibrary_findRecord (TestCase):
+
+    def setUp(self):
+        self.library = ContentFeedLibrary(shared=False)
+        self.library.register(ListItemFeed, 'list feed')
+
+    def test_returns_none_without_creating_a_record(self):
+        assert_is_none(self.library.find_record(ListItemFeed('[1,2,3]')))
+        assert_equal(ContentFeedRecord.objects.count(), 0)
+
+    def test_finds_records_for_equal_feeds_from_other_libraries(self):
+        record = self.library.get_record(ListItemFeed('[1,2,3]'))
+
+        library2 = ContentFeedLibrary(shared=False)
+        library2.register(ListItemFeed, 'list feed')
+
+        assert_equal(library2.find_record(ListItemFeed('[1,2,3]')), record)
+        assert_equal(library2.get_record(ListItemFeed('[1,2,3]')), record)
+        assert_equal(ContentFeedRecord.objects.count(), 1)
+
+    def test_replaces_cached_records_deleted_by_other_processes(self):
+        feed = ListItemFeed('[1,2,3]')
+        record = self.library.get_record(feed)
+
+        # As cleanfeeds would, from another process's library.
+        ContentFeedRecord.objects.filter(pk=record.pk).delete()
+
+        new_record = self.library.get_record(feed)
+        assert_true(ContentFeedRecord.objects.filter(pk=new_record.pk).exists())
+        assert_equal(new_record.feed_params.count(), len(feed.get_params()))
+
+    def test_finds_records_in_one_query(self):
+        feed = ListItemFeed('[1,2,3]')
+        self.library.get_record(feed)
+
+        library2 = ContentFeedLibrary(shared=False)
+        library2.register(ListItemFeed, 'list feed')
+        with self.assertNumQueries(1):
+            library2.get_record(feed)
+        with self.assertNumQueries(1):
+            library2.get_record(feed)
+
+    def test_refreshes_the_last_updated_time_of_cached_records(self):
+        feed = ListItemFeed('[1,2,3]')
+        record = self.library.get_record(feed)
+
+        # As updatefeeds would, from another process.
+        ContentFeedRecord.objects.filter(pk=record.pk)\
+            .update(last_updated=datetime.datetime(2012, 1, 1))
+
+        assert_equal(self.library.find_record(feed).last_updated,
+                     datetime.datetime(2012, 1, 1))
+
+    def test_looks_up_a_subscription_in_one_query(self):
+        subscriber = Subscriber.objects.create()
+        subscriber.subscribe(ListItemFeed('[1,2,3]'), self.library)
+
+        library2 = ContentFeedLibrary(shared=False)
+        library2.register(ListItemFeed, 'list feed')
+        with self.assertNumQueries(1):
+            subscription = subscriber.subscription(ListItemFeed('[1,2,3]'), library2)
+        assert_is_not_none(subscription)
+
+
 class Test_ContentFeedLibrary_caching:
 
     @istest
@@ -290,6 +388,40 @@ class Test_ContentFeedUpdater_updateAll (TestCase):
         assert_equal(self.feeds[0].get_last_updated_time.call_count, 1)
 
 
+class Test_ContentFeedUpdater_updateChanged (TestCase):
+
+    def setUp(self):
+        class MatchingListItemFeed (ListItemFeed):
+            def could_match(feed, changed_content, last_updated):
+                return any(item in feed.items for item in changed_content)
+
+        library = self.library = ContentFeedLibrary(shared=False)
+        library.register(MatchingListItemFeed, 'list feed')
+
+        self.feeds = [ MatchingListItemFeed("[1, 2]"),
+                       MatchingListItemFeed("[3, 4]") ]
+        self.feed_records = [library.get_record(feed) for feed in self.feeds]
+
+        for feed in self.feeds:
+            feed.get_last_updated_time = Mock(return_value=datetime.datetime(2011, 8, 4))
+
+    @istest
+    def only_updates_the_feeds_that_could_match_the_changes(self):
+        updater = ContentFeedRecordUpdater()
+
+        updated = updater.update_changed(self.feed_records, [3], self.library)
+
+        assert_equal(updated, 1)
+        assert_equal(self.feeds[0].get_last_updated_time.call_count, 0)
+        assert_equal(self.feeds[1].get_last_updated_time.call_count, 1)
+
+    @istest
+    def updates_nothing_when_nothing_has_changed(self):
+        updater = ContentFeedRecordUpdater()
+
+        assert_equal(updater.update_changed(self.feed_records, [], self.library), 0)
+
+
 class Test_ContentFeedCleaner_clean (TestCase):
 
     def setUp(self):
@@ -306,6 +438,7 @@ class Test_ContentFeedCleaner_clean (TestCase):
         subscriber = Subscriber.objects.create()
         subscriber.subscribe(feeds[0], library)
 
+        self.feeds = feeds
         self.keeper = feed_records[0]
         self.tosser = feed_records[1]
 
@@ -322,6 +455,14 @@ class Test_ContentFeedCleaner_clean (TestCase):
         assert_in(self.keeper, feed_records)
         assert_not_in(self.tosser, feed_records)
 
+    @istest
+    def forgets_the_removed_records_in_the_library(self):
+        cleaner = ContentFeedRecordCleaner()
+        cleaner.clean(self.library)
+
+        assert_equal(self.library.find_record(self.feeds[0]), self.keeper)
+        assert_is_none(self.library.find_record(self.feeds[1]))
+
 
 class Test_SerializedObjectField_toPython (TestCase):
 
@@ -408,10 +549,12 @@ class Test_SingleSubscriptionMixin_getContextData:
     @istest
     def configures_the_form_correctly_when_not_subscribed(self):
         # i.e.:
-        #  * the form subscriber and feed_record are set to primary keys
-        #    instead of objects of types Subscriber and ContentFeedRecord
+        #  * the form subscriber is set to a primary key instead of a
+        #    Subscriber, and the feed is given by its name and parameters
         #  * their is no last_sent field on the form (it should be set
         #    automatically)
+        #  * no feed record is created just to show the form
+        ContentFeedRecord.objects.all().delete()
 
         class Subscriber (Mock):
             def subscription(self, feed, library):
@@ -429,9 +572,11 @@ class Test_SingleSubscriptionMixin_getContextData:
         data = self.view.get_context_data()
         form = data['subscription_form']
 
-        assert_is_instance(form.data['feed_record'], (int, basestring))
+        assert_equal(form.data['feed_name'], 'my list item feed')
+        assert_equal(json.loads(form.data['feed_params']), {'items': '[1, 2, 3]'})
         assert_is_instance(form.data['subscriber'], (int, basestring))
         assert_not_in('last_sent', form.fields)
+        assert_equal(ContentFeedRecord.objects.count(), 0)
 
 
 class Test_SubscriptionDispatcher_dispatch:
@@ -472,6 +617,114 @@ class Test_SubscriptionDispatcher_dispatch:
                      datetime.datetime(2011, 8, 4, 6, 50))
 
 
+class Test_SubscriptionDispatcher_dispatchAll:
+
+    def setup(self):
+        Subscriber.objects.all().delete()
+        ContentFeedRecord.objects.all().delete()
+
+        self.library = ContentFeedLibrary(shared=False)
+        self.library.register(ListItemFeed, 'my list items')
+
+        self.lookups = []
+        class CountingListItemFeed (ListItemFeed):
+            def get_updates_since(feed, since):
+                self.lookups.append(since)
+                return feed.items
+
+            def get_changes_to(feed, item, since):
+                return {'value': item}, datetime.datetime(2011, 8, 4)
+        self.library.register(CountingListItemFeed, 'counting list items')
+
+        self.feed = CountingListItemFeed('[1, 2, 3]')
+        record = self.library.get_record(self.feed)
+        record.last_updated = datetime.datetime(2011, 8, 4)
+        record.save()
+
+        self.subscribers = []
+        for last_sent in [datetime.datetime(2011, 1, 1)] * 3 + [datetime.datetime(2011, 2, 1)]:
+            subscriber = Subscriber.objects.create(username='user%s' % len(self.subscribers))
+            subscription = subscriber.subscribe(self.feed, library=self.library)
+            subscription.last_sent = last_sent
+            subscription.save()
+            self.subscribers.append(subscriber)
+
+    @istest
+    def looks_up_each_distinct_feed_update_once(self):
+        dispatcher = SubscriptionDispatcher()
+        dispatcher.render = Mock(return_value='')
+        dispatcher.deliver_to = Mock()
+        dispatcher.record_delivery = Mock()
+
+        dispatcher.dispatch_all(self.subscribers, self.library)
+
+        assert_equal(dispatcher.deliver_to.call_count, 4)
+        assert_equal(sorted(self.lookups), [datetime.datetime(2011, 1, 1),
+                                            datetime.datetime(2011, 2, 1)])
+
+    @istest
+    def delivers_the_same_changes_to_each_subscriber(self):
+        dispatcher = SubscriptionDispatcher()
+        dispatcher.render = Mock(return_value='')
+        dispatcher.deliver_to = Mock()
+        dispatcher.record_delivery = Mock()
+
+        dispatcher.dispatch_all(self.subscribers, self.library)
+
+        for call in dispatcher.render.call_args_list:
+            subscriber, subscriptions, content_updates = call[0][:3]
+            assert_equal(dict((item, changes) for item, (changes, when)
+                              in content_updates.items()),
+                         {1: {'value': 1}, 2: {'value': 2}, 3: {'value': 3}})
+
+
+class Test_SubscriptionDispatcher_recordDelivery (TestCase):
+
+    def setUp(self):
+        self.library = ContentFeedLibrary(shared=False)
+        self.library.register(ListItemFeed, 'list feed')
+
+        self.subscribers = []
+        for i in range(2):
+            subscriber = Subscriber.objects.create(username='user%s' % i)
+            subscriber.subscribe(ListItemFeed('[1]'), self.library)
+            subscriber.subscribe(ListItemFeed('[2]'), self.library)
+            self.subscribers.append(subscriber)
+
+        self.content_updates = {1: ({'value': 1}, datetime.datetime(2011, 8, 4))}
+
+    def record_deliveries(self):
+        dispatcher = SubscriptionDispatcher()
+        for subscriber in self.subscribers:
+            dispatcher.record_delivery(subscriber, subscriber.subscriptions.all(),
+                                       self.content_updates, u'The message')
+        dispatcher.save_records()
+
+    def test_stores_identical_content_once(self):
+        self.record_deliveries()
+
+        assert_equal(SubscriptionDispatchRecord.objects.count(), 4)
+        assert_equal(DeliveryBody.objects.count(), 1)
+
+        record = SubscriptionDispatchRecord.objects.all()[0]
+        assert_in(u'Message:\nThe message', record.get_content())
+
+    def test_prunes_old_records_but_the_latest_for_each_subscription(self):
+        self.record_deliveries()
+        self.record_deliveries()
+        SubscriptionDispatchRecord.objects.update(when=datetime.datetime(2011, 1, 1))
+
+        pruned = SubscriptionDispatchRecord.prune(datetime.datetime(2012, 1, 1))
+
+        assert_equal(pruned, 4)
+        assert_equal(SubscriptionDispatchRecord.objects.count(), 4)
+        assert_equal(DeliveryBody.objects.count(), 1)
+
+        SubscriptionDispatchRecord.objects.all().delete()
+        SubscriptionDispatchRecord.prune(datetime.datetime(2012, 1, 1))
+        assert_equal(DeliveryBody.objects.count(), 0)
+
+
 class Test_SubscriptionForm_save:
 
     def setup(self):
@@ -484,15 +737,38 @@ class Test_SubscriptionForm_save:
 
         self.subscriber = Subscriber.objects.create()
         self.feed = ListItemFeed('[1, 2, 3]')
-        self.feed_record = self.library.get_record(self.feed)
+
+    def form(self):
+        data = SubscriptionForm.feed_data(self.feed, self.library)
+        data['subscriber'] = self.subscriber.pk
+        return SubscriptionForm(data, library=self.library)
 
     @istest
     def creates_a_subscription_for_the_subscriber_to_the_feed(self):
-        form = SubscriptionForm({'subscriber': self.subscriber.pk,
-                                 'feed_record': self.feed_record.pk})
+        form = self.form()
 
         assert form.is_valid(), 'The form had errors: %r' % (form.errors,)
         form.save()
         subscription = self.subscriber.subscription(self.feed, self.library)
 
         assert subscription is not None
+
+    @istest
+    def uses_the_existing_record_for_the_feed(self):
+        record = self.library.get_record(self.feed)
+
+        form = self.form()
+        assert form.is_valid(), 'The form had errors: %r' % (form.errors,)
+        subscription = form.save()
+
+        assert_equal(subscription.feed_record, record)
+        assert_equal(ContentFeedRecord.objects.count(), 1)
+
+    @istest
+    def rejects_feeds_that_are_not_in_the_library(self):
+        form = SubscriptionForm({'subscriber': self.subscriber.pk,
+                                 'feed_name': 'no such feed',
+                                 'feed_params': '{}'},
+                                library=self.library)
+
+        assert_false(form.is_valid())
@@ -46,11 +46,11 @@ class SingleSubscriptionMixin (object):
             subscription = self.get_subscription(feed)
 
             if subscription is None:
+                # The feed's record is created when the form is submitted.
                 library = self.get_content_feed_library()
-                form = forms.SubscriptionForm(
-                    {'feed_record': library.get_record(feed).pk,
-                     'subscriber': subscriber.pk})
-                return form
+                data = forms.SubscriptionForm.feed_data(feed, library)
+                data['subscriber'] = subscriber.pk
+                return forms.SubscriptionForm(data, library=library)
 
         return None
 
@@ -71,6 +71,7 @@ class SingleSubscriptionMixin (object):
 
 class CreateSubscriptionView (views.CreateView):
     model = models.Subscription
+    form_class = forms.SubscriptionForm
 
     def get_success_url(self):
         return self.request.REQUEST['success']
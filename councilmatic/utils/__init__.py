@@ -1,79 +1,75 @@
-import datetime
-import json
-import os
+import logging
+import subprocess
 import tempfile
-import requests
+import threading
 import urllib
 
+log = logging.getLogger(__name__)
+
 # Adapted from Scraperwiki utils
 
-def pdftoxml(pdfdata):
-    """converts pdf file to xml file"""
+class PdfConversionTimeout (Exception):
+    pass
+
+def _communicate(proc, data, timeout, name):
+    """sends the data to the process and returns its (stdout, stderr), killing
+       it and raising PdfConversionTimeout if it takes longer than timeout
+       seconds (some PDFs are pathological)"""
+    timed_out = threading.Event()
+    def kill():
+        timed_out.set()
+        proc.kill()
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        output, errors = proc.communicate(data)
+    finally:
+        timer.cancel()
+
+    if timed_out.is_set():
+        raise PdfConversionTimeout('%s took longer than %s seconds' % (name, timeout))
+    return output, errors
+
+def pdftoxml(pdfdata, timeout=60):
+    """converts pdf data to xml, read from pdftohtml's stdout; pdftohtml has
+       to seek around in its input, so the pdf data still goes through a
+       temporary file"""
     pdffout = tempfile.NamedTemporaryFile(suffix='.pdf')
     pdffout.write(pdfdata)
     pdffout.flush()
 
-    xmlin = tempfile.NamedTemporaryFile(mode='r', suffix='.xml')
-    tmpxml = xmlin.name # "temph.xml"
-    cmd = '/usr/bin/pdftohtml -xml -nodrm -zoom 1.5 -enc UTF-8 -noframes "%s" "%s"' % (pdffout.name, os.path.splitext(tmpxml)[0])
-    cmd = cmd + " >/dev/null 2>&1" # can't turn off output, so throw away even stderr yeuch
-    os.system(cmd)
+    cmd = ['pdftohtml', '-xml', '-stdout', '-nodrm', '-zoom', '1.5', '-enc', 'UTF-8',
+           '-noframes', pdffout.name]
+    # can't turn off output, so throw away even stderr yeuch
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        xmldata, errors = _communicate(proc, None, timeout, 'pdftohtml')
+    finally:
+        pdffout.close()
 
-    pdffout.close()
-    #xmlfin = open(tmpxml)
-    xmldata = xmlin.read()
-    xmlin.close()
     return xmldata
 
-def pdftotxt(pdfdata):
-    """converts pdf file to txt file"""
-    pdffout = tempfile.NamedTemporaryFile(suffix='.pdf')
-    pdffout.write(pdfdata)
-    pdffout.flush()
+def pdftotxt(pdfdata, timeout=60, layout=True):
+    """converts pdf data to text by streaming it through pdftotext's stdin and
+       stdout; no temporary files, and no shell"""
+    cmd = ['pdftotext', '-enc', 'UTF-8'] + (['-layout'] if layout else []) + ['-', '-']
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    txtdata, errors = _communicate(proc, pdfdata, timeout, 'pdftotext')
 
-    txtin = tempfile.NamedTemporaryFile(mode='r', suffix='.txt')
-    tmptxt = txtin.name # "temph.xml"
-    cmd = '/usr/bin/pdftotext -enc UTF-8 -layout "%s" "%s"' % (pdffout.name, txtin.name)
-    cmd = cmd + " >/dev/null 2>&1" # can't turn off output, so throw away even stderr yeuch
-    os.system(cmd)
+    if proc.returncode != 0:
+        # Same as an image-only PDF: there's no text to be had.
+        log.warning('pdftotext exited with status %s: %s' % (proc.returncode, errors.strip()))
+        return u''
 
-    pdffout.close()
-    txtdata = txtin.read()
-    txtin.close()
-    return txtdata
+    return txtdata.decode('utf-8', 'replace')
 
 
 class TooManyGeocodeRequests (Exception):
     pass
 
-_geocode_day = datetime.date.today()
-_geocode_count = 0
-def geocode(address, bounds, retries=5):
-    """attempts to geocode an address"""
-    global _geocode_day
-    global _geocode_count
-
-    today = datetime.date.today()
-    if _geocode_day != today:
-        _geocode_count = 0
-        _geocode_day = today
-
-    if _geocode_count > 2000:
-        raise TooManyGeocodeRequests("You're making a lot of geocoding requests.  You should consider slowing down, maybe?")
-
-    # Here's the default geocode request. Uses a reasonable bounding box.
-    response = requests.get(
-        'http://maps.googleapis.com/maps/api/geocode/json',
-        params={'address': address, 'sensor': 'false', 'bounds':'{0},{1}|{2},{3}'.format(*bounds)})
-
-    _geocode_count += 1
-
-    if response.status_code != 200 and retries > 0:
-        return geocode(address, bounds, retries-1)
-    if response.status_code != 200:
-        return None
-
-    response.encoding = 'UTF8'
-    result = json.loads(response.text)
-
-    return result
+def geocode(address, bounds):
+    """attempts to geocode an address, using the geocoding cache and the
+       geocoder configured in the settings (see utils.geocoding)"""
+    from utils.geocoding import get_geocoder
+    return get_geocoder().geocode(address, bounds)
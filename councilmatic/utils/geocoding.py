@@ -0,0 +1,266 @@
+"""
+Geocoding of the addresses that are mentioned in legislation.
+
+Results (including addresses that could not be found) are kept in the
+database, keyed on a normalized form of the address, so each address is only
+ever sent to the geocoding service once.  Errors from the service are not
+kept, so those addresses are tried again next time.  Requests made by all processes count against a single daily
+quota, also kept in the database.
+
+The service itself is pluggable; set ``LEGISLATION['GEOCODER']`` to the dotted
+path of a backend class, and ``LEGISLATION['GEOCODER_OPTIONS']`` to the keyword
+arguments it should be constructed with.  Backends return responses shaped
+like the Google geocoding API's.
+
+"""
+import datetime
+import json
+import logging
+import re
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils.importlib import import_module
+
+from utils import TooManyGeocodeRequests
+
+log = logging.getLogger(__name__)
+
+
+# Responses that are a definite answer about the address, and so are safe to
+# cache.  Any other status (OVER_QUERY_LIMIT, REQUEST_DENIED, INVALID_REQUEST,
+# UNKNOWN_ERROR) is a problem with the request or the service, not the address.
+CACHED_STATUSES = ('OK', 'ZERO_RESULTS')
+
+PUNCTUATION_RE = re.compile(r'[^\w\s]', re.UNICODE)
+
+def normalize_address(address):
+    """
+    Reduce an address to a canonical form for caching, so that differences in
+    case, punctuation, and spacing don't cause repeat requests.
+    """
+    address = PUNCTUATION_RE.sub(' ', address.lower())
+    return u' '.join(address.split())
+
+
+class GoogleGeocoder (object):
+    """
+    Geocode addresses with the Google geocoding API.  Requests share a pooled
+    HTTP session, and transient failures are retried with a backoff.
+    """
+    url = 'http://maps.googleapis.com/maps/api/geocode/json'
+
+    def __init__(self, retries=5, backoff=0.5, pool_size=10, timeout=10):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def lookup(self, address, bounds):
+        """
+        Return the geocoder's response for the address, or None if the service
+        could not be reached or did not give a definite answer.
+        """
+        params = {'address': address, 'sensor': 'false',
+                  'bounds': '{0},{1}|{2},{3}'.format(*bounds)}
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+            try:
+                response = self.session.get(self.url, params=params,
+                                            timeout=self.timeout)
+            except requests.RequestException as e:
+                log.debug('Geocoding request for %r failed: %s' % (address, e))
+                continue
+
+            if response.status_code == 200:
+                response.encoding = 'UTF8'
+                result = json.loads(response.text)
+                if result.get('status') in CACHED_STATUSES:
+                    return result
+                log.debug('Geocoding request for %r failed with status %s' %
+                          (address, result.get('status')))
+
+        return None
+
+
+class LocalGeocoder (object):
+    """
+    Geocode addresses from a fixed table of { address : (formatted address,
+    lat, lng) }, without going to the network.  Useful for tests and for
+    development without a geocoding quota.
+    """
+
+    def __init__(self, places=None):
+        self.places = dict((normalize_address(address), place)
+                           for address, place in (places or {}).items())
+        self.lookups = []
+
+    def lookup(self, address, bounds):
+        self.lookups.append(address)
+        place = self.places.get(normalize_address(address))
+        if place is None:
+            return {'status': 'ZERO_RESULTS', 'results': []}
+
+        formatted_address, lat, lng = place
+        return {'status': 'OK', 'results': [{
+            'formatted_address': formatted_address,
+            'geometry': {'location': {'lat': lat, 'lng': lng}},
+        }]}
+
+
+class RateLimiter (object):
+    """
+    Space calls to ``wait`` at least ``1 / rate`` seconds apart, across all the
+    threads that share the limiter.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Geocoder (object):
+    """
+    Geocode addresses through a backend, with a persistent cache in front of
+    it, a shared daily quota, and a limit on the request rate.
+    """
+
+    def __init__(self, backend, bounds, daily_limit=2000, rate=10, workers=4):
+        self.backend = backend
+        self.bounds = bounds
+        self.daily_limit = daily_limit
+        self.rate_limiter = RateLimiter(rate)
+        self.workers = workers
+
+    def geocode(self, address, bounds=None):
+        """
+        Return the geocoder response for a single address, or None if it could
+        not be looked up.
+        """
+        return self.geocode_many([address], bounds)[address]
+
+    def geocode_many(self, addresses, bounds=None):
+        """
+        Geocode a number of addresses, sending the ones that aren't cached to
+        the backend concurrently.  Returns a dictionary of { address :
+        response or None }.
+        """
+        from utils.models import GeocodedAddress
+
+        normalized = dict((address, normalize_address(address))
+                          for address in addresses)
+        cached = dict((entry.normalized_address, entry.response_data())
+                      for entry in GeocodedAddress.objects.filter(
+                          normalized_address__in=set(normalized.values())))
+
+        # Look up each new address once, however many ways it's written.
+        misses = {}
+        for address in addresses:
+            key = normalized[address]
+            if key not in cached:
+                misses.setdefault(key, address)
+
+        if misses:
+            self.reserve(len(misses))
+            responses = self.lookup_all(misses.values(), bounds or self.bounds)
+
+            for key, address in misses.items():
+                response = responses[address]
+                cached[key] = response
+                if response is not None and \
+                   response.get('status') in CACHED_STATUSES:
+                    GeocodedAddress.store(key, address, response)
+
+        return dict((address, cached[key]) for address, key in normalized.items())
+
+    def lookup_all(self, addresses, bounds):
+        def lookup(address):
+            self.rate_limiter.wait()
+            return self.backend.lookup(address, bounds)
+
+        if self.workers > 1 and len(addresses) > 1:
+            pool = ThreadPool(min(self.workers, len(addresses)))
+            try:
+                responses = pool.map(lookup, addresses)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            responses = map(lookup, addresses)
+
+        return dict(zip(addresses, responses))
+
+    def reserve(self, count):
+        """
+        Count ``count`` requests against today's quota, or raise
+        TooManyGeocodeRequests if that would go over it.
+        """
+        from utils.models import GeocodeQuota
+
+        today = datetime.date.today()
+        try:
+            sid = transaction.savepoint()
+            GeocodeQuota.objects.get_or_create(day=today)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Another process created today's counter first.
+            transaction.savepoint_rollback(sid)
+
+        # Increment first and check after, so concurrent processes can't both
+        # squeeze under the limit.
+        quota = GeocodeQuota.objects.filter(day=today)
+        quota.update(requests=F('requests') + count)
+        if quota.get().requests > self.daily_limit:
+            quota.update(requests=F('requests') - count)
+            raise TooManyGeocodeRequests("You're making a lot of geocoding requests.  You should consider slowing down, maybe?")
+
+
+def load_backend():
+    backend_name = settings.LEGISLATION.get('GEOCODER', 'utils.geocoding.GoogleGeocoder')
+    module, attr = backend_name.rsplit('.', 1)
+
+    try:
+        GeocoderBackend = getattr(import_module(module), attr)
+    except (ImportError, AttributeError) as e:
+        raise ImproperlyConfigured('Error importing geocoder %s: "%s"' % (backend_name, e))
+
+    options = settings.LEGISLATION.get('GEOCODER_OPTIONS', {})
+    return GeocoderBackend(**options)
+
+
+_geocoder = None
+_geocoder_lock = threading.Lock()
+def get_geocoder():
+    """Return the geocoder configured in the settings."""
+    global _geocoder
+
+    with _geocoder_lock:
+        if _geocoder is None:
+            _geocoder = Geocoder(
+                load_backend(), settings.LEGISLATION['ADDRESS_BOUNDS'],
+                **settings.LEGISLATION.get('GEOCODING_LIMITS', {}))
+        return _geocoder
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'GeocodedAddress'
+        db.create_table(u'utils_geocodedaddress', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('created_datetime', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, blank=True)),
+            ('updated_datetime', self.gf('django.db.models.fields.DateTimeField')(auto_now=True, blank=True)),
+            ('normalized_address', self.gf('django.db.models.fields.CharField')(unique=True, max_length=2048)),
+            ('address', self.gf('django.db.models.fields.CharField')(max_length=2048)),
+            ('status', self.gf('django.db.models.fields.CharField')(max_length=32)),
+            ('response', self.gf('django.db.models.fields.TextField')()),
+        ))
+        db.send_create_signal(u'utils', ['GeocodedAddress'])
+
+        # Adding model 'GeocodeQuota'
+        db.create_table(u'utils_geocodequota', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('day', self.gf('django.db.models.fields.DateField')(unique=True)),
+            ('requests', self.gf('django.db.models.fields.IntegerField')(default=0)),
+        ))
+        db.send_create_signal(u'utils', ['GeocodeQuota'])
+
+    def backwards(self, orm):
+        # Deleting model 'GeocodedAddress'
+        db.delete_table(u'utils_geocodedaddress')
+
+        # Deleting model 'GeocodeQuota'
+        db.delete_table(u'utils_geocodequota')
+
+    models = {
+        u'utils.geocodedaddress': {
+            'Meta': {'object_name': 'GeocodedAddress'},
+            'address': ('django.db.models.fields.CharField', [], {'max_length': '2048'}),
+            'created_datetime': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'normalized_address': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '2048'}),
+            'response': ('django.db.models.fields.TextField', [], {}),
+            'status': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'updated_datetime': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'})
+        },
+        u'utils.geocodequota': {
+            'Meta': {'object_name': 'GeocodeQuota'},
+            'day': ('django.db.models.fields.DateField', [], {'unique': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'requests': ('django.db.models.fields.IntegerField', [], {'default': '0'})
+        }
+    }
+
+    complete_apps = ['utils']
@@ -1,4 +1,5 @@
-from django.db import models
+import json
+from django.db import IntegrityError, models, transaction
 
 class TimestampedModelMixin (models.Model):
     created_datetime = models.DateTimeField(auto_now_add=True)
@@ -6,3 +7,45 @@ class TimestampedModelMixin (models.Model):
 
     class Meta:
         abstract = True
+
+
+class GeocodedAddress (TimestampedModelMixin, models.Model):
+    """
+    A cached geocoder response, keyed on the normalized address.  Responses
+    that found nothing are stored too, so that we don't keep asking.
+    """
+    normalized_address = models.CharField(max_length=2048, unique=True)
+    address = models.CharField(max_length=2048)
+    status = models.CharField(max_length=32)
+    response = models.TextField()
+
+    def __unicode__(self):
+        return u'{0} ({1})'.format(self.address, self.status)
+
+    def response_data(self):
+        return json.loads(self.response)
+
+    @classmethod
+    def store(cls, normalized_address, address, response):
+        attrs = {'address': address,
+                 'status': response.get('status', ''),
+                 'response': json.dumps(response)}
+        try:
+            sid = transaction.savepoint()
+            entry, created = cls.objects.get_or_create(
+                normalized_address=normalized_address, defaults=attrs)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Someone else geocoded the same address at the same time.
+            transaction.savepoint_rollback(sid)
+            entry = cls.objects.get(normalized_address=normalized_address)
+        return entry
+
+
+class GeocodeQuota (models.Model):
+    """The number of geocoding requests made (by any process) on a day."""
+    day = models.DateField(unique=True)
+    requests = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return u'{0} geocoding requests on {1}'.format(self.requests, self.day)
@@ -0,0 +1,66 @@
+import datetime
+from django.test import TestCase
+
+from utils import TooManyGeocodeRequests
+from utils.geocoding import Geocoder, LocalGeocoder, normalize_address
+from utils.models import GeocodedAddress, GeocodeQuota
+
+
+class GeocoderTests (TestCase):
+    def setUp(self):
+        self.backend = LocalGeocoder({
+            '1234 Market St': ('1234 Market St, Philadelphia, PA', 39.95, -75.16),
+            '1 S Broad St': ('1 S Broad St, Philadelphia, PA', 39.95, -75.16),
+        })
+        self.geocoder = Geocoder(self.backend, [0, 0, 1, 1], rate=0)
+
+    def test_NormalizesCasePunctuationAndSpacing(self):
+        self.assertEqual(normalize_address(u' 1234  Market St. '),
+                         normalize_address(u'1234 market st'))
+
+    def test_CachesResponsesAcrossGeocoders(self):
+        self.geocoder.geocode('1234 Market St')
+        other = Geocoder(self.backend, [0, 0, 1, 1], rate=0)
+        gc = other.geocode('1234 MARKET ST.')
+
+        self.assertEqual(gc['status'], 'OK')
+        self.assertEqual(self.backend.lookups, ['1234 Market St'])
+
+    def test_CachesAddressesThatCannotBeFound(self):
+        self.geocoder.geocode('Nowhere Rd')
+        gc = self.geocoder.geocode('Nowhere Rd')
+
+        self.assertEqual(gc['status'], 'ZERO_RESULTS')
+        self.assertEqual(self.backend.lookups, ['Nowhere Rd'])
+
+    def test_DoesNotCacheErrorsFromTheService(self):
+        class DeniedGeocoder (LocalGeocoder):
+            def lookup(self, address, bounds):
+                self.lookups.append(address)
+                return {'status': 'REQUEST_DENIED', 'results': []}
+
+        backend = DeniedGeocoder()
+        geocoder = Geocoder(backend, [0, 0, 1, 1], rate=0)
+        geocoder.geocode('1234 Market St')
+        geocoder.geocode('1234 Market St')
+
+        self.assertEqual(backend.lookups, ['1234 Market St', '1234 Market St'])
+        self.assertEqual(GeocodedAddress.objects.count(), 0)
+
+    def test_GeocodesABatchOfAddressesTogether(self):
+        gcs = self.geocoder.geocode_many(['1234 Market St', '1 S Broad St',
+                                          '1234 market st', 'Nowhere Rd'])
+
+        self.assertEqual(len(gcs), 4)
+        self.assertEqual(gcs['1234 market st'], gcs['1234 Market St'])
+        self.assertEqual(sorted(self.backend.lookups),
+                         sorted(['1234 Market St', '1 S Broad St', 'Nowhere Rd']))
+        self.assertEqual(GeocodedAddress.objects.count(), 3)
+        self.assertEqual(GeocodeQuota.objects.get(day=datetime.date.today()).requests, 3)
+
+    def test_RefusesToGoOverTheDailyQuota(self):
+        GeocodeQuota.objects.create(day=datetime.date.today(), requests=2000)
+
+        self.assertRaises(TooManyGeocodeRequests,
+                          self.geocoder.geocode, '1234 Market St')
+        self.assertEqual(self.backend.lookups, [])
@@ -1,11 +1,10 @@
 import json
 import logging as log
-from collections import defaultdict, namedtuple
+from collections import defaultdict
 from django.contrib.syndication.views import Feed as DjangoFeed
 from django.shortcuts import get_object_or_404
 from django.views import generic as views
-from django.core.cache import cache
-from django.core.urlresolvers import reverse_lazy
+from django.core.urlresolvers import reverse, reverse_lazy
 from django.utils.translation import ugettext as _
 from haystack.query import SearchQuerySet, RelatedSearchQuerySet
 import datetime
@@ -24,18 +23,6 @@ import subscriptions.models
 import subscriptions.views
 
 
-def get_or_cache(cache_key, getter_func):
-    """
-    Retrieve a value from the cache. If no value is cached for the key, cache
-    and return the value returned by running the getter_func with no arguments.
-    """
-    val = cache.get(cache_key)
-    if val is None:
-        val = getter_func()
-        cache.set(cache_key, val)
-    return val
-
-
 class NewLegislationFeed (DjangoFeed):
     title = u'New Legislation'
     link = 'http://localhost:8000'
@@ -125,33 +112,19 @@ class AppDashboardView (BaseDashboardMixin,
                        prefetch_related('references_in_legislation'))
 
     def get_recent_topics(self):
-        # get the month weeks of legislation
-        now = datetime.date.today()
         one_month = datetime.timedelta(days=31)
-        date_string = now-one_month
-
-        topic_count_query = """SELECT phillyleg_metadata_topic.id, phillyleg_metadata_topic.topic, Count(phillyleg_legfilemetadata.legfile_id) AS leg_count FROM phillyleg_metadata_topic
-        JOIN phillyleg_legfilemetadata_topics ON phillyleg_legfilemetadata_topics.metadata_topic_id = phillyleg_metadata_topic.id
-        JOIN phillyleg_legfilemetadata ON phillyleg_legfilemetadata.id = phillyleg_legfilemetadata_topics.legfilemetadata_id
-        JOIN phillyleg_legfile ON phillyleg_legfile.key = phillyleg_legfilemetadata.legfile_id
-        WHERE phillyleg_legfile.intro_date > '{date_string}' AND phillyleg_metadata_topic.topic != 'Routine'
-        GROUP BY phillyleg_metadata_topic.topic, phillyleg_metadata_topic.id
-        ORDER BY leg_count DESC""".format(date_string=date_string)
-
-        return list(phillyleg.models.MetaData_Topic.objects.raw(topic_count_query))
-
+        return phillyleg.models.TopicTrend.top_topics(
+            since=datetime.date.today() - one_month)
 
     def get_context_data(self, **kwargs):
 
-        recent_topics_query = self.get_recent_topics()
-        recent_topics = []
-
-        for t in recent_topics_query:
-            percent_width = 100 * (float(t.leg_count) / float(recent_topics_query[0].leg_count))
-            recent_topics.append({'topic': t.topic, 'leg_count': t.leg_count, 'percent_width': percent_width})
+        recent_topics = self.get_recent_topics()
+        for t in recent_topics:
+            t['percent_width'] = 100 * (float(t['leg_count']) / float(recent_topics[0]['leg_count']))
 
         context_data = super(AppDashboardView, self).get_context_data(**kwargs)
         context_data['recent_topics'] = recent_topics
+        context_data['topic_trends_version'] = phillyleg.models.TopicTrend.version()
         return context_data
 
 class CouncilMembersView(views.TemplateView):
@@ -196,16 +169,7 @@ class CouncilMemberDetailView (BaseDashboardMixin,
         return self.object.district
 
     def get_topics(self):
-        topic_count_query = """SELECT phillyleg_metadata_topic.id, phillyleg_metadata_topic.topic, Count(phillyleg_legfilemetadata.legfile_id) AS leg_count FROM phillyleg_metadata_topic
-        JOIN phillyleg_legfilemetadata_topics ON phillyleg_legfilemetadata_topics.metadata_topic_id = phillyleg_metadata_topic.id
-        JOIN phillyleg_legfilemetadata ON phillyleg_legfilemetadata.id = phillyleg_legfilemetadata_topics.legfilemetadata_id
-        JOIN phillyleg_legfile ON phillyleg_legfile.key = phillyleg_legfilemetadata.legfile_id
-        JOIN phillyleg_legfile_sponsors ON phillyleg_legfile_sponsors.legfile_id = phillyleg_legfile.key
-        WHERE phillyleg_metadata_topic.topic != 'Routine' AND phillyleg_legfile_sponsors.councilmember_id = {sponsor_id}
-        GROUP BY phillyleg_metadata_topic.topic, phillyleg_metadata_topic.id
-        ORDER BY leg_count DESC""".format(sponsor_id=self.object.id)
-
-        return phillyleg.models.MetaData_Topic.objects.raw(topic_count_query)
+        return phillyleg.models.TopicTrend.top_topics(sponsor=self.object)
 
     def get_context_data(self, **kwargs):
         district = self.get_district()
@@ -239,50 +203,75 @@ class SearcherMixin (object):
         self.results = self.form.search().order_by('-order_date')
 
     def _get_search_results(self, query_params):
-        class SQSProxy (object):
-            """
-            Make a SearchQuerySet look enough like a QuerySet for a ListView
-            not to notice the difference.
-            """
-            def __init__(self, sqs):
-                self.sqs = sqs
-            def __len__(self):
-                return self.sqs.count()
-            count = __len__
-            def __iter__(self):
-                return (result.object for result in self.sqs.load_all())
-            def __getitem__(self, key):
-                if isinstance(key, slice):
-                    # Collect all the results in the slice, storing the id
-                    # and the model of the object.
-                    ResultSummary = namedtuple('ResultSummary', 'model id')
-                    results = [ResultSummary(result.model, str(result.file_id)) for result in
-                               self.sqs[key] if result is not None]
-
-                    # For each model, do a query for the objects of that model
-                    # type and map them by key.
-                    models = set([result.model for result in results])
-                    objs_by_id = {}
-                    for model in models:
-                        ids = [result.id for result in results if result.model is model]
-                        objs = model.objects.filter(id__in=ids)\
-                            .select_related('metadata')\
-                            .prefetch_related('metadata__topics')\
-                            .prefetch_related('metadata__locations')
-                        objs_by_id.update(
-                            {str(obj.id): obj for obj in objs}
-                        )
-
-                    # To preserve search query order, pull the objects out of
-                    # the map according to the order of the results.
-                    return [objs_by_id[result.id] for result in results if result.id in objs_by_id]
-                else:
-                    return self.sqs[key].object
-
         objs = SQSProxy(self.results)
         return objs
 
 
+class SQSProxy (object):
+    """
+    Make a SearchQuerySet look enough like a QuerySet for a ListView not to
+    notice the difference.  Results are turned into model objects with one
+    query per model (plus any prefetching) for each slice.  When the fields
+    stored in the search index are enough, use ``stored`` to get the search
+    results themselves without touching the database.
+    """
+    chunk_size = 100
+
+    hydrators = {
+        LegFile: lambda qs: qs.select_related('metadata')
+                              .prefetch_related('metadata__topics')
+                              .prefetch_related('metadata__locations'),
+    }
+    """Map of { model : function to add prefetching to a queryset of the model }"""
+
+    def __init__(self, sqs):
+        self.sqs = sqs
+        self._count = None
+
+    def __len__(self):
+        if self._count is None:
+            self._count = self.sqs.count()
+        return self._count
+    count = __len__
+
+    def __iter__(self):
+        for start in xrange(0, len(self), self.chunk_size):
+            for obj in self[start:start + self.chunk_size]:
+                yield obj
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.hydrate(self.stored(key))
+        else:
+            objs = self.hydrate([self.sqs[key]])
+            if not objs:
+                raise IndexError(key)
+            return objs[0]
+
+    def stored(self, key):
+        """Return the search results in the given slice, as they're stored."""
+        return [result for result in self.sqs[key] if result is not None]
+
+    def hydrate(self, results):
+        """
+        Fetch the model objects for the given search results, with one query
+        for each model, and return them in the same order as the results.
+        """
+        pks_by_model = defaultdict(list)
+        for result in results:
+            pks_by_model[result.model].append(result.pk)
+
+        objs = {}
+        for model, pks in pks_by_model.items():
+            queryset = model.objects.filter(pk__in=pks)
+            if model in self.hydrators:
+                queryset = self.hydrators[model](queryset)
+            objs.update(((model, unicode(obj.pk)), obj) for obj in queryset)
+
+        return [objs[result.model, unicode(result.pk)] for result in results
+                if (result.model, unicode(result.pk)) in objs]
+
+
 class LegFileListFeedView (SearcherMixin, DjangoFeed):
     def get_object(self, request, *args, **kwargs):
         self._init_haystack_search(request)
@@ -291,7 +280,23 @@ class LegFileListFeedView (SearcherMixin, DjangoFeed):
         return search_queryset
 
     def items(self, obj):
-        return obj[:100]
+        # The feed only needs what's stored in the search index.
+        return obj.stored(slice(0, 100))
+
+    def item_title(self, result):
+        if result.model_name == 'legfile':
+            return u'{0} {1}'.format(result.file_type, result.file_id)
+        else:
+            return u'Minutes of {0}'.format(result.order_date)
+
+    def item_description(self, result):
+        return result.title or u''
+
+    def item_link(self, result):
+        if result.model_name == 'legfile':
+            return reverse('legislation_detail', args=[result.pk])
+        else:
+            return reverse('minutes_detail', args=[result.pk])
 
     def title(self, obj):
         'testing'
@@ -375,18 +380,7 @@ class SearchView (SearcherMixin,
         context['bookmark_cache_key'] = bookmark_cache_key
         context['bookmark_data'] = bookmark_data
 
-        context['topics'] = get_or_cache('search_topics',
-            lambda: [(topic.topic, topic.topic)
-                     for topic in MetaData_Topic.objects.all().order_by('topic')])
-        context['statuses'] = get_or_cache('search_statuses',
-            lambda: legfile_choices('status'))
-        context['controlling_bodies'] = get_or_cache('search_controlling_bodies',
-            lambda: legfile_choices('controlling_body'))
-        context['file_types'] = get_or_cache('search_file_types',
-            lambda: legfile_choices('type'))
-        context['sponsors'] = get_or_cache('search_sponsors',
-            lambda: [(member.real_name, member.real_name)
-                     for member in CouncilMember.objects.all().order_by('real_name')])
+        context.update(phillyleg.models.get_search_choices())
         
         log.debug(context)
         return context
@@ -448,13 +442,6 @@ class LegislationDetailView (SearchBarMixin,
 #        return legfile
 
 
-def legfile_choices(field):
-    value_objs = LegFile.objects.values(field).distinct().order_by(field)
-    values = [(value_obj[field], value_obj[field])
-          for value_obj in value_objs]
-    return values
-
-
 class SiteMapView (views.TemplateView):
     template_name = 'councilmatic/sitemap.xml'
 
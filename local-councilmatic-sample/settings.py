@@ -211,6 +211,15 @@ INSTALLED_APPS = (
     'django.contrib.gis',
 ) + PROJECT_SPECIFIC_APPS + COUNCILMATIC_APPS + COMMUNITY_APPS
 
+################################################################################
+#
+# Scraping
+#
+
+# The file in which the scrapers keep the text extracted from PDFs between
+# runs (unless a scraper's pdf_cache_path option says otherwise).
+PDF_CACHE_PATH = rel_path('pdf_cache.sqlite3')
+
 ################################################################################
 #
 # Testing and administration